@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+benchmark_cvs_fetch.py [-n files]
+
+Times fetching files from a local CVS repository one at a time with
+CVSClient.cat_file, and all at once with CVSClient.cat_files. The repository
+is created in a temporary directory and contains the given number of files
+(20 by default). This requires cvs, and must be run from a development tree
+with a settings_local.py.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n files]')
+    parser.add_option('-n', '--files', type='int', default=20,
+                      help='the number of files in the repository')
+    options, args = parser.parse_args()
+
+    root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            '..', '..'))
+    sys.path.insert(0, root_dir)
+    sys.path.insert(0, os.path.join(root_dir, 'reviewboard'))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reviewboard.settings')
+
+    from reviewboard.scmtools.cvs import CVSClient
+
+    tempdir = tempfile.mkdtemp(prefix='rb-cvs-benchmark-')
+
+    try:
+        cvsroot = os.path.join(tempdir, 'cvsroot')
+        files = _make_repository(tempdir, cvsroot, options.files)
+        client = CVSClient(cvsroot, cvsroot, None)
+
+        print 'Fetching %d file(s)' % len(files)
+        print
+        print '%-20s %10s' % ('Method', 'Seconds')
+
+        start = time.time()
+
+        for filename, revision in files:
+            client.cat_file(filename, revision)
+
+        print '%-20s %10.2f' % ('cat_file', time.time() - start)
+
+        start = time.time()
+        client.cat_files(files)
+        print '%-20s %10.2f' % ('cat_files', time.time() - start)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def _make_repository(tempdir, cvsroot, num_files):
+    import_dir = os.path.join(tempdir, 'import')
+    os.mkdir(import_dir)
+    files = []
+
+    for i in xrange(num_files):
+        filename = 'file%d.txt' % i
+
+        f = open(os.path.join(import_dir, filename), 'w')
+        f.write(''.join(['line %d of file %d\n' % (j, i)
+                         for j in xrange(100)]))
+        f.close()
+
+        files.append(('benchmark/%s' % filename, '1.1'))
+
+    subprocess.check_call(['cvs', '-Q', '-d', cvsroot, 'init'])
+    subprocess.check_call(['cvs', '-Q', '-d', cvsroot, 'import',
+                           '-m', 'Initial import.',
+                           'benchmark', 'vendor', 'start'],
+                          cwd=import_dir)
+
+    return files
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+benchmark_diff_parser.py [-s size] [-f files]
+
+Times parsing a generated diff (50 MB by default) with DiffParser and
+GitDiffParser. The diff can contain one huge file, or be split across
+several files. This must be run from a development tree with a
+settings_local.py.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+
+def main():
+    parser = OptionParser(usage='%prog [-s size] [-f files]')
+    parser.add_option('-s', '--size', type='int', default=50,
+                      help='the size of the generated diff, in megabytes')
+    parser.add_option('-f', '--files', type='int', default=1,
+                      help='the number of files in the generated diff')
+    options, args = parser.parse_args()
+
+    root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            '..', '..'))
+    sys.path.insert(0, root_dir)
+    sys.path.insert(0, os.path.join(root_dir, 'reviewboard'))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reviewboard.settings')
+
+    from reviewboard.diffviewer.parser import DiffParser
+    from reviewboard.scmtools.git import GitDiffParser
+
+    data = _make_diff(options.size * 1024 * 1024, options.files)
+
+    print 'Parsing a %.1f MB diff containing %d file(s)' % (
+        len(data) / (1024.0 * 1024.0), options.files)
+    print
+    print '%-20s %10s %10s' % ('Parser', 'Seconds', 'MB/second')
+
+    for parser_cls in (DiffParser, GitDiffParser):
+        start = time.time()
+        files = parser_cls(data).parse()
+
+        # Make sure the content for each file has been built.
+        for f in files:
+            f.data
+
+        elapsed = time.time() - start
+
+        print '%-20s %10.2f %10.1f' % (parser_cls.__name__, elapsed,
+                                       len(data) / (1024.0 * 1024.0) /
+                                       elapsed)
+
+
+def _make_diff(size, num_files):
+    file_size = size // num_files
+    hunk = ''.join([
+        ' context line %d of the file\n'
+        '-old line %d\n'
+        '+new line %d\n' % (i, i, i)
+        for i in xrange(10)
+    ])
+    hunk = '@@ -1,20 +1,20 @@\n' + hunk
+    hunks = hunk * max(1, file_size // len(hunk))
+
+    return ''.join([
+        'diff --git a/file%d.c b/file%d.c\n'
+        'index 1234567..89abcde 100644\n'
+        '--- a/file%d.c\t(revision 1)\n'
+        '+++ b/file%d.c\t(working copy)\n'
+        '%s' % (i, i, i, i, hunks)
+        for i in xrange(num_files)
+    ])
+
+
+if __name__ == '__main__':
+    main()
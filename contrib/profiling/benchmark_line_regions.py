@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+benchmark_line_regions.py [-n pairs] [-s seed]
+
+Reports how many pairs of changed lines per second can have their changed
+regions computed, using a plain SequenceMatcher (the old approach) and
+using get_line_changed_regions, with and without its cache.
+
+The pairs of lines are made by randomly editing lines from Review Board's
+own source files. This must be run from a development tree with a
+settings_local.py.
+"""
+
+import os
+import random
+import sys
+import time
+from difflib import SequenceMatcher
+from optparse import OptionParser
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n pairs] [-s seed]')
+    parser.add_option('-n', '--pairs', type='int', default=20000,
+                      help='the number of pairs of lines to compare')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='the random seed used to generate the pairs')
+    options, args = parser.parse_args()
+
+    root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            '..', '..'))
+    sys.path.insert(0, root_dir)
+    sys.path.insert(0, os.path.join(root_dir, 'reviewboard'))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reviewboard.settings')
+
+    from reviewboard.diffviewer import chunk_generator
+
+    pairs = _make_pairs(os.path.join(root_dir, 'reviewboard'),
+                        options.pairs, options.seed)
+
+    print '%-34s %14s' % ('Method', 'Lines/second')
+
+    _report('SequenceMatcher', _get_regions_with_sequence_matcher, pairs)
+
+    def get_regions_uncached(oldline, newline):
+        chunk_generator._line_changed_regions_cache.clear()
+        return chunk_generator.get_line_changed_regions(oldline, newline)
+
+    _report('get_line_changed_regions', get_regions_uncached, pairs)
+
+    chunk_generator._line_changed_regions_cache.clear()
+    chunk_generator.MAX_LINE_REGIONS_CACHE_SIZE = len(pairs)
+
+    for oldline, newline in pairs:
+        chunk_generator.get_line_changed_regions(oldline, newline)
+
+    _report('get_line_changed_regions (cached)',
+            chunk_generator.get_line_changed_regions, pairs)
+
+
+def _report(name, func, pairs):
+    start = time.time()
+
+    for oldline, newline in pairs:
+        func(oldline, newline)
+
+    print '%-34s %14.0f' % (name, len(pairs) / (time.time() - start))
+
+
+def _make_pairs(source_dir, num_pairs, seed):
+    lines = []
+
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        for filename in filenames:
+            if filename.endswith('.py'):
+                f = open(os.path.join(dirpath, filename), 'r')
+                lines.extend(line for line in f if len(line.strip()) > 10)
+                f.close()
+
+    rand = random.Random(seed)
+    insertions = ['', 'x', 'foo_bar', '(self, a)', ' ', 'None']
+    pairs = []
+
+    while len(pairs) < num_pairs:
+        oldline = rand.choice(lines)
+        i = rand.randint(0, len(oldline))
+        j = i + rand.randint(0, 10)
+        newline = oldline[:i] + rand.choice(insertions) + oldline[j:]
+
+        if newline != oldline:
+            pairs.append((oldline, newline))
+
+    return pairs
+
+
+def _get_regions_with_sequence_matcher(oldline, newline):
+    differ = SequenceMatcher(None, oldline, newline)
+
+    if differ.ratio() < 0.6:
+        return (None, None)
+
+    oldchanges = []
+    newchanges = []
+    back = (0, 0)
+
+    for tag, i1, i2, j1, j2 in differ.get_opcodes():
+        if tag == 'equal':
+            if (i2 - i1 < 3) or (j2 - j1 < 3):
+                back = (j2 - j1, i2 - i1)
+            continue
+
+        oldstart, oldend = i1 - back[0], i2
+        newstart, newend = j1 - back[1], j2
+
+        if oldchanges != [] and oldstart <= oldchanges[-1][1] < oldend:
+            oldchanges[-1] = (oldchanges[-1][0], oldend)
+        elif not oldline[oldstart:oldend].isspace():
+            oldchanges.append((oldstart, oldend))
+
+        if newchanges != [] and newstart <= newchanges[-1][1] < newend:
+            newchanges[-1] = (newchanges[-1][0], newend)
+        elif not newline[newstart:newend].isspace():
+            newchanges.append((newstart, newend))
+
+        back = (0, 0)
+
+    return oldchanges, newchanges
+
+
+if __name__ == '__main__':
+    main()
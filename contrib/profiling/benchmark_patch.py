@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+"""
+benchmark_patch.py [-n iterations]
+
+Compares the built-in patch engine against GNU patch, using the diffs and
+source files in reviewboard/diffviewer/testdata. This must be run from a
+development tree with a settings_local.py.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+
+def main():
+    parser = OptionParser(usage='%prog [-n iterations]')
+    parser.add_option('-n', '--iterations', type='int', default=100,
+                      help='the number of times to apply each diff')
+    options, args = parser.parse_args()
+
+    root_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            '..', '..'))
+    sys.path.insert(0, root_dir)
+    sys.path.insert(0, os.path.join(root_dir, 'reviewboard'))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'reviewboard.settings')
+
+    from reviewboard.diffviewer.diffutils import (_patch_with_subprocess,
+                                                  convert_line_endings)
+    from reviewboard.diffviewer.patcher import apply_unified_diff
+
+    testdata_dir = os.path.join(root_dir, 'reviewboard', 'diffviewer',
+                                'testdata')
+    diffs_dir = os.path.join(testdata_dir, 'diffs', 'unified')
+
+    print '%-30s %12s %12s %8s' % ('File', 'patch (ms)', 'builtin (ms)',
+                                  'Speedup')
+
+    total_subprocess = total_builtin = 0
+
+    for diff_name in sorted(os.listdir(diffs_dir)):
+        filename = diff_name[:-len('.diff')]
+        orig_path = os.path.join(testdata_dir, 'orig_src', filename)
+
+        if not os.path.exists(orig_path):
+            continue
+
+        diff = convert_line_endings(_read(os.path.join(diffs_dir, diff_name)))
+        orig = convert_line_endings(_read(orig_path))
+
+        start = time.time()
+
+        for i in xrange(options.iterations):
+            expected = _patch_with_subprocess(diff, orig, filename)
+
+        subprocess_time = time.time() - start
+        start = time.time()
+
+        for i in xrange(options.iterations):
+            result = apply_unified_diff(diff, orig)
+
+        builtin_time = time.time() - start
+
+        if result != expected:
+            sys.stderr.write('The engines disagree on %s!\n' % filename)
+            sys.exit(1)
+
+        total_subprocess += subprocess_time
+        total_builtin += builtin_time
+
+        print '%-30s %12.3f %12.3f %7.1fx' % (
+            filename,
+            1000 * subprocess_time / options.iterations,
+            1000 * builtin_time / options.iterations,
+            subprocess_time / builtin_time)
+
+    print
+    print '%-30s %12.3f %12.3f %7.1fx' % (
+        'Total',
+        1000 * total_subprocess / options.iterations,
+        1000 * total_builtin / options.iterations,
+        total_subprocess / total_builtin)
+
+
+def _read(path):
+    f = open(path, 'r')
+    data = f.read()
+    f.close()
+
+    return data
+
+
+if __name__ == '__main__':
+    main()
@@ -532,6 +532,61 @@ class DiffSettingsForm(SiteSettingsForm):
                     'to disable size restrictions.'),
         widget=forms.TextInput(attrs={'size': '15'}))
 
+    diffviewer_patch_engine = forms.ChoiceField(
+        label=_('Patch engine'),
+        choices=(
+            ('builtin', _('Built-in')),
+            ('patch', _('GNU patch')),
+        ),
+        help_text=_('The method used to apply diffs to files. The built-in '
+                    'engine is faster, and falls back on GNU patch for any '
+                    'diffs it cannot apply.'))
+
+    diffviewer_chunk_executor = forms.ChoiceField(
+        label=_('Concurrent diff generation'),
+        choices=(
+            ('', _('Disabled')),
+            ('thread', _('Thread pool')),
+            ('process', _('Process pool')),
+        ),
+        help_text=_('Generates uncached diffs for multiple files at once. '
+                    'Thread pools are best when most of the time is spent '
+                    'fetching files from repositories. Process pools are '
+                    'best when most of the time is spent computing diffs '
+                    'and syntax highlighting.'),
+        required=False)
+
+    diffviewer_chunk_executor_max_workers = forms.IntegerField(
+        label=_('Concurrent diff workers'),
+        help_text=_('The maximum number of threads or processes used to '
+                    'generate diffs concurrently.'),
+        min_value=1,
+        initial=4,
+        widget=forms.TextInput(attrs={'size': '5'}))
+
+    diffviewer_warm_caches_on_upload = forms.BooleanField(
+        label=_('Prepare diffs in the background when uploaded'),
+        help_text=_('Fetches the files and generates the diffs for newly '
+                    'uploaded diffs in the background, so that they are '
+                    'ready by the time they are first viewed.'),
+        required=False)
+
+    diffviewer_warm_caches_max_workers = forms.IntegerField(
+        label=_('Background diff workers'),
+        help_text=_('The maximum number of uploaded diffs prepared in the '
+                    'background at once.'),
+        min_value=1,
+        initial=4,
+        widget=forms.TextInput(attrs={'size': '5'}))
+
+    diffviewer_warm_caches_max_workers_per_repository = forms.IntegerField(
+        label=_('Background diff workers per repository'),
+        help_text=_('The maximum number of uploaded diffs prepared in the '
+                    'background at once for any one repository.'),
+        min_value=1,
+        initial=2,
+        widget=forms.TextInput(attrs={'size': '5'}))
+
     def load(self):
         # TODO: Move this check into a dependencies module so we can catch it
         #       when the user starts up Review Board.
@@ -576,7 +631,13 @@ class DiffSettingsForm(SiteSettingsForm):
                 'fields': ('diffviewer_max_diff_size',
                            'diffviewer_context_num_lines',
                            'diffviewer_paginate_by',
-                           'diffviewer_paginate_orphans')
+                           'diffviewer_paginate_orphans',
+                           'diffviewer_patch_engine',
+                           'diffviewer_chunk_executor',
+                           'diffviewer_chunk_executor_max_workers',
+                           'diffviewer_warm_caches_on_upload',
+                           'diffviewer_warm_caches_max_workers',
+                           'diffviewer_warm_caches_max_workers_per_repository')
             }
         )
 
@@ -117,13 +117,19 @@ defaults.update({
     'auth_x509_username_field':            'SSL_CLIENT_S_DN_CN',
     'auth_x509_username_regex':            '',
     'auth_x509_autocreate_users':          False,
+    'diffviewer_chunk_executor':           '',
+    'diffviewer_chunk_executor_max_workers': 4,
     'diffviewer_context_num_lines':        5,
     'diffviewer_include_space_patterns':   [],
     'diffviewer_max_diff_size':            0,
     'diffviewer_paginate_by':              20,
     'diffviewer_paginate_orphans':         10,
+    'diffviewer_patch_engine':             'builtin',
     'diffviewer_syntax_highlighting':      True,
     'diffviewer_syntax_highlighting_threshold': 0,
+    'diffviewer_warm_caches_on_upload':    False,
+    'diffviewer_warm_caches_max_workers':  4,
+    'diffviewer_warm_caches_max_workers_per_repository': 2,
     'diffviewer_show_trailing_whitespace': True,
     'mail_send_review_mail':               False,
     'mail_send_new_user_mail':             False,
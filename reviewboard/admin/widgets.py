@@ -14,6 +14,8 @@ from reviewboard.admin.cache_stats import get_cache_stats
 from reviewboard.attachments.models import FileAttachment
 from reviewboard.changedescs.models import ChangeDescription
 from reviewboard.diffviewer.models import DiffSet
+from reviewboard.hostingsvcs.models import HostingServiceAccount
+from reviewboard.hostingsvcs.ratelimit import get_rate_limits
 from reviewboard.reviews.models import (ReviewRequest, Group,
                                         Comment, Review, Screenshot,
                                         ReviewRequestDraft)
@@ -274,6 +276,30 @@ class ServerCacheWidget(Widget):
         }
 
 
+class HostingServiceRateLimitsWidget(Widget):
+    """Hosting service rate limits widget.
+
+    Displays the API requests remaining for each hosting service account
+    with a rate limit, along with the background requests that have been
+    skipped to keep the rest for interactive use.
+    """
+    title = 'Hosting Service Rate Limits'
+    template = 'admin/widgets/w-hosting-service-rate-limits.html'
+    cache_data = False
+
+    def generate_data(self, request):
+        accounts = list(HostingServiceAccount.objects.all())
+        rate_limits = get_rate_limits(accounts)
+
+        for rate_limit in rate_limits:
+            rate_limit['reset'] = \
+                datetime.datetime.fromtimestamp(rate_limit['reset'])
+
+        return {
+            'rate_limits': rate_limits,
+        }
+
+
 class NewsWidget(Widget):
     """News widget.
 
@@ -487,5 +513,6 @@ register(ReviewRequestStatusesWidget)
 register(RecentActionsWidget)
 register(ReviewGroupsWidget)
 register(ServerCacheWidget)
+register(HostingServiceRateLimitsWidget)
 register(NewsWidget)
 register(DatabaseStatsWidget)
@@ -1,23 +1,46 @@
 import fnmatch
+import hashlib
+import os
 import re
 from difflib import SequenceMatcher
 
+from django.core.cache import cache
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _, get_language
 from djblets.log import log_timed
 from djblets.siteconfig.models import SiteConfiguration
-from djblets.util.misc import cache_memoize
+from djblets.util.misc import cache_memoize, make_cache_key
 from pygments import highlight
 from pygments.lexers import get_lexer_for_filename
 from pygments.formatters import HtmlFormatter
+from pygments.util import ClassNotFound
 
 from reviewboard.diffviewer.differ import get_differ
 from reviewboard.diffviewer.diffutils import (get_original_file,
                                               get_patched_file)
+from reviewboard.diffviewer.models import FileDiffOpcodes
 from reviewboard.diffviewer.opcode_generator import get_diff_opcode_generator
 
 
+# The maximum number of pairs of lines to cache changed regions for. The
+# cache is cleared when it fills up.
+MAX_LINE_REGIONS_CACHE_SIZE = 10000
+
+# The maximum amount of work to spend matching up the characters of two
+# changed lines, measured as the product of the lengths of the parts of the
+# lines between their common prefix and suffix.
+MAX_LINE_REGIONS_WORK = 100000
+
+# The maximum number of filenames to cache Pygments lexers for. The cache
+# is cleared when it fills up.
+MAX_LEXER_CACHE_SIZE = 1000
+
+
+_line_changed_regions_cache = {}
+_lexer_cache = {}
+
+
 class NoWrapperHtmlFormatter(HtmlFormatter):
     """An HTML Formatter for Pygments that doesn't wrap items in a div."""
     def __init__(self, *args, **kwargs):
@@ -91,6 +114,7 @@ class DiffChunkGenerator(object):
         self.force_interdiff = force_interdiff
         self.enable_syntax_highlighting = enable_syntax_highlighting
         self.differ = None
+        self._header_lines = [[], []]
 
         self.filename = filediff.source_file
 
@@ -129,15 +153,30 @@ class DiffChunkGenerator(object):
         returned. Otherwise, new chunks will be generated, stored in cache,
         and returned.
         """
-        if (self.filediff.binary or
-                self.filediff.deleted or
-                self.filediff.source_revision == ''):
+        if not self.has_chunks():
             return []
 
-        return cache_memoize(self.make_cache_key(),
-                             lambda: list(self._get_chunks_uncached()),
+        return cache_memoize(self.make_cache_key(), self.get_chunks_uncached,
                              large_data=True)
 
+    def get_chunks_uncached(self):
+        """Returns the list of chunks, bypassing the cache."""
+        return list(self._get_chunks_uncached())
+
+    def has_chunks(self):
+        """Returns whether there are any chunks to generate.
+
+        Binary and deleted files, and files that have moved with no
+        additional changes, have no chunks.
+        """
+        return not (self.filediff.binary or
+                    self.filediff.deleted or
+                    self.filediff.source_revision == '')
+
+    def has_cached_chunks(self):
+        """Returns whether the chunks for the diff are in the cache."""
+        return cache.has_key(make_cache_key(self.make_cache_key()))
+
     def _get_chunks_uncached(self):
         """Returns the list of chunks, bypassing the cache."""
         old = get_original_file(self.filediff, self.request)
@@ -187,8 +226,6 @@ class DiffChunkGenerator(object):
                 tool.normalize_path_for_display(self.filediff.dest_file)
 
             try:
-                # TODO: Try to figure out the right lexer for these files
-                #       once instead of twice.
                 markup_a = self._apply_pygments(old or '', source_file)
                 markup_b = self._apply_pygments(new or '', dest_file)
             except:
@@ -201,17 +238,6 @@ class DiffChunkGenerator(object):
             markup_b = self.NEWLINES_RE.split(escape(new))
 
         siteconfig = SiteConfiguration.objects.get_current()
-        ignore_space = True
-
-        for pattern in siteconfig.get('diffviewer_include_space_patterns'):
-            if fnmatch.fnmatch(self.filename, pattern):
-                ignore_space = False
-                break
-
-        self.differ = get_differ(a, b, ignore_space=ignore_space,
-                                 compat_version=self.diffset.diffcompat)
-        self.differ.add_interesting_lines_for_headers(self.filename)
-
         context_num_lines = siteconfig.get("diffviewer_context_num_lines")
         collapse_threshold = 2 * context_num_lines + 3
 
@@ -228,11 +254,8 @@ class DiffChunkGenerator(object):
                 request=self.request)
 
         line_num = 1
-        opcodes_generator = get_diff_opcode_generator(self.differ,
-                                                      self.filediff,
-                                                      self.interfilediff)
 
-        for tag, i1, i2, j1, j2, meta in opcodes_generator:
+        for tag, i1, i2, j1, j2, meta in self._get_opcodes(a, b):
             old_lines = markup_a[i1:i2]
             new_lines = markup_b[j1:j2]
             num_lines = max(len(old_lines), len(new_lines))
@@ -268,6 +291,81 @@ class DiffChunkGenerator(object):
 
         log_timer.done()
 
+    def _get_opcodes(self, a, b):
+        """Returns the opcodes for the diff.
+
+        The opcodes are loaded from the FileDiffOpcodes stored for the diff,
+        if any. Otherwise, they're generated by the differ and
+        DiffOpcodeGenerator, and then stored so that chunks can later be
+        rebuilt (for instance, with another language or without syntax
+        highlighting) without diffing the files again.
+
+        This also sets the header lines used by _get_interesting_headers.
+        """
+        siteconfig = SiteConfiguration.objects.get_current()
+        ignore_space = True
+
+        for pattern in siteconfig.get('diffviewer_include_space_patterns'):
+            if fnmatch.fnmatch(self.filename, pattern):
+                ignore_space = False
+                break
+
+        opcodes_query = {
+            'filediff': self.filediff,
+            'interfilediff': self.interfilediff,
+            'force_interdiff': self.force_interdiff,
+            'diffcompat': self.diffset.diffcompat,
+            'ignore_space': ignore_space,
+        }
+
+        # FileDiffs that haven't been saved (such as those being previewed)
+        # can't have stored opcodes.
+        can_store = (self.filediff.pk is not None and
+                     (self.interfilediff is None or
+                      self.interfilediff.pk is not None))
+
+        if can_store:
+            content_hash = FileDiffOpcodes.make_content_hash(a, b)
+            stored_opcodes = \
+                FileDiffOpcodes.objects.filter(**opcodes_query)[:1]
+
+            for stored in stored_opcodes:
+                if stored.content_hash == content_hash:
+                    opcodes, headers = stored.get_opcodes()
+                    self._header_lines = [
+                        [(linenum, a[linenum]) for linenum in headers[0]],
+                        [(linenum, b[linenum]) for linenum in headers[1]],
+                    ]
+
+                    return opcodes
+
+                # The files no longer match what was stored. This can
+                # happen if the repository was changed to point elsewhere.
+                stored.delete()
+
+        self.differ = get_differ(a, b, ignore_space=ignore_space,
+                                 compat_version=self.diffset.diffcompat)
+        self.differ.add_interesting_lines_for_headers(self.filename)
+
+        opcodes = list(get_diff_opcode_generator(self.differ,
+                                                 self.filediff,
+                                                 self.interfilediff))
+        self._header_lines = [
+            self.differ.get_interesting_lines('header', False),
+            self.differ.get_interesting_lines('header', True),
+        ]
+
+        if can_store:
+            stored = FileDiffOpcodes(content_hash=content_hash,
+                                     **opcodes_query)
+            stored.set_opcodes(opcodes, [
+                [linenum for linenum, line in header_lines]
+                for header_lines in self._header_lines
+            ])
+            stored.save()
+
+        return opcodes
+
     def _get_enable_syntax_highlighting(self, old, new, a, b):
         """Returns whether or not we'll be enabling syntax highlighting.
 
@@ -389,8 +487,7 @@ class DiffChunkGenerator(object):
         This scans for all headers that fall within the specified range
         of the specified lines on both the original and modified files.
         """
-        possible_functions = \
-            self.differ.get_interesting_lines('header', is_modified_file)
+        possible_functions = self._header_lines[int(is_modified_file)]
 
         if not possible_functions:
             raise StopIteration
@@ -425,14 +522,28 @@ class DiffChunkGenerator(object):
     def _apply_pygments(self, data, filename):
         """Applies Pygments syntax-highlighting to a file's contents.
 
-        The resulting HTML will be returned as a list of lines.
+        The resulting HTML will be returned as a list of lines, or None if
+        there's no lexer for the file.
+
+        The lines are cached based on the lexer and a hash of the file's
+        contents, so a given revision of a file is only highlighted once,
+        even when shown in several diffs or interdiffs.
         """
-        lexer = get_lexer_for_filename(filename,
-                                       stripnl=False,
-                                       encoding='utf-8')
-        lexer.add_filter('codetagify')
+        lexer = get_lexer_for_filename_cached(filename)
+
+        if lexer is None:
+            return None
+
+        if isinstance(data, unicode):
+            data_hash = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        else:
+            data_hash = hashlib.sha1(data).hexdigest()
 
-        return highlight(data, lexer, NoWrapperHtmlFormatter()).splitlines()
+        return cache_memoize(
+            'diff-highlight-%s-%s' % (type(lexer).__name__, data_hash),
+            lambda: highlight(data, lexer,
+                              NoWrapperHtmlFormatter()).splitlines(),
+            large_data=True)
 
     def _convert_to_utf8(self, s, enc):
         """Returns the passed string as a unicode string.
@@ -470,48 +581,194 @@ class DiffChunkGenerator(object):
 
     def _get_line_changed_regions(self, oldline, newline):
         """Returns regions of changes between two similar lines."""
-        if oldline is None or newline is None:
-            return (None, None)
+        return get_line_changed_regions(oldline, newline)
 
-        # Use the SequenceMatcher directly. It seems to give us better results
-        # for this. We should investigate steps to move to the new differ.
-        differ = SequenceMatcher(None, oldline, newline)
 
-        # This thresholds our results -- we don't want to show inter-line diffs
-        # if most of the line has changed, unless those lines are very short.
+def get_lexer_for_filename_cached(filename):
+    """Returns a Pygments lexer for a filename, or None if there isn't one.
 
-        # FIXME: just a plain, linear threshold is pretty crummy here.  Short
-        # changes in a short line get lost.  I haven't yet thought of a fancy
-        # nonlinear test.
-        if differ.ratio() < 0.6:
-            return (None, None)
+    Looking up a lexer means matching the filename against the patterns of
+    every registered lexer, so lexers are looked up once per base filename
+    and then reused.
+    """
+    basename = os.path.basename(filename)
 
-        oldchanges = []
-        newchanges = []
-        back = (0, 0)
+    try:
+        return _lexer_cache[basename]
+    except KeyError:
+        pass
+
+    try:
+        lexer = get_lexer_for_filename(basename,
+                                       stripnl=False,
+                                       encoding='utf-8')
+        lexer.add_filter('codetagify')
+    except ClassNotFound:
+        lexer = None
+
+    if len(_lexer_cache) >= MAX_LEXER_CACHE_SIZE:
+        _lexer_cache.clear()
+
+    _lexer_cache[basename] = lexer
+
+    return lexer
+
+
+def get_line_changed_regions(oldline, newline):
+    """Returns regions of changes between two similar lines.
+
+    The results are cached in memory, keyed on the two lines, so the regions
+    for a pair of lines are only computed once per process, no matter how
+    many diffs or interdiffs the lines appear in.
+    """
+    if oldline is None or newline is None:
+        return (None, None)
+
+    key = (oldline, newline)
+
+    try:
+        oldchanges, newchanges = _line_changed_regions_cache[key]
+    except KeyError:
+        if len(_line_changed_regions_cache) >= MAX_LINE_REGIONS_CACHE_SIZE:
+            _line_changed_regions_cache.clear()
+
+        oldchanges, newchanges = _compute_line_changed_regions(oldline,
+                                                               newline)
+
+        if oldchanges is not None:
+            oldchanges = tuple(oldchanges)
+            newchanges = tuple(newchanges)
+
+        _line_changed_regions_cache[key] = (oldchanges, newchanges)
+
+    if oldchanges is None:
+        return (None, None)
+
+    return list(oldchanges), list(newchanges)
+
+
+def _compute_line_changed_regions(oldline, newline):
+    """Computes the regions of changes between two similar lines.
+
+    The common prefix and suffix of the lines are found first, and only the
+    part in between is passed to a SequenceMatcher. If that part is too
+    large to match character by character (see MAX_LINE_REGIONS_WORK), it's
+    treated as a single changed region.
+    """
+    old_len = len(oldline)
+    new_len = len(newline)
+    prefix_len = _get_common_prefix_len(oldline, newline)
+    suffix_len = _get_common_suffix_len(oldline, newline,
+                                        min(old_len, new_len) - prefix_len)
+    old_end = old_len - suffix_len
+    new_end = new_len - suffix_len
+    matched = prefix_len + suffix_len
+    opcodes = []
+
+    if prefix_len > 0:
+        opcodes.append(('equal', 0, prefix_len, 0, prefix_len))
+
+    if prefix_len == old_end or prefix_len == new_end:
+        # This is a simple insertion or deletion (or no change at all).
+        if prefix_len != old_end or prefix_len != new_end:
+            opcodes.append(('replace', prefix_len, old_end,
+                            prefix_len, new_end))
+    elif ((old_end - prefix_len) * (new_end - prefix_len) <=
+          MAX_LINE_REGIONS_WORK):
+        # Use the SequenceMatcher directly. It seems to give us better
+        # results for this. We should investigate steps to move to the new
+        # differ.
+        differ = SequenceMatcher(None, oldline[prefix_len:old_end],
+                                 newline[prefix_len:new_end])
 
         for tag, i1, i2, j1, j2 in differ.get_opcodes():
-            if tag == 'equal':
-                if (i2 - i1 < 3) or (j2 - j1 < 3):
-                    back = (j2 - j1, i2 - i1)
-                continue
+            opcodes.append((tag, prefix_len + i1, prefix_len + i2,
+                            prefix_len + j1, prefix_len + j2))
+
+        for block in differ.get_matching_blocks():
+            matched += block[2]
+    else:
+        opcodes.append(('replace', prefix_len, old_end, prefix_len, new_end))
+
+    if suffix_len > 0:
+        opcodes.append(('equal', old_end, old_len, new_end, new_len))
+
+    # This thresholds our results -- we don't want to show inter-line diffs
+    # if most of the line has changed, unless those lines are very short.
+
+    # FIXME: just a plain, linear threshold is pretty crummy here.  Short
+    # changes in a short line get lost.  I haven't yet thought of a fancy
+    # nonlinear test.
+    if old_len + new_len > 0 and 2.0 * matched / (old_len + new_len) < 0.6:
+        return (None, None)
+
+    oldchanges = []
+    newchanges = []
+    back = (0, 0)
+
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag == 'equal':
+            if (i2 - i1 < 3) or (j2 - j1 < 3):
+                back = (j2 - j1, i2 - i1)
+            continue
+
+        oldstart, oldend = i1 - back[0], i2
+        newstart, newend = j1 - back[1], j2
+
+        if oldchanges != [] and oldstart <= oldchanges[-1][1] < oldend:
+            oldchanges[-1] = (oldchanges[-1][0], oldend)
+        elif not oldline[oldstart:oldend].isspace():
+            oldchanges.append((oldstart, oldend))
+
+        if newchanges != [] and newstart <= newchanges[-1][1] < newend:
+            newchanges[-1] = (newchanges[-1][0], newend)
+        elif not newline[newstart:newend].isspace():
+            newchanges.append((newstart, newend))
+
+        back = (0, 0)
 
-            oldstart, oldend = i1 - back[0], i2
-            newstart, newend = j1 - back[1], j2
+    return oldchanges, newchanges
 
-            if oldchanges != [] and oldstart <= oldchanges[-1][1] < oldend:
-                oldchanges[-1] = (oldchanges[-1][0], oldend)
-            elif not oldline[oldstart:oldend].isspace():
-                oldchanges.append((oldstart, oldend))
 
-            if newchanges != [] and newstart <= newchanges[-1][1] < newend:
-                newchanges[-1] = (newchanges[-1][0], newend)
-            elif not newline[newstart:newend].isspace():
-                newchanges.append((newstart, newend))
+def _get_common_prefix_len(a, b):
+    """Returns the length of the common prefix of two strings.
 
-            back = (0, 0)
+    This does a binary search using slice comparisons, which is much faster
+    than comparing one character at a time in Python.
+    """
+    lo = 0
+    hi = min(len(a), len(b))
+
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+def _get_common_suffix_len(a, b, max_len):
+    """Returns the length of the common suffix of two strings.
+
+    At most max_len characters are considered. See _get_common_prefix_len.
+    """
+    a_len = len(a)
+    b_len = len(b)
+    lo = 0
+    hi = max_len
+
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+
+        if a[a_len - mid:a_len - lo] == b[b_len - mid:b_len - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
 
-        return oldchanges, newchanges
+    return lo
 
 
 def compute_chunk_last_header(lines, numlines, meta, last_header=None):
@@ -66,19 +66,42 @@ class Differ(object):
         raise NotImplementedError
 
 
+_myers_differ_class = None
+
+
+def get_myers_differ_class():
+    """Returns the differ class used for the current diff compat version.
+
+    This defaults to FastMyersDiffer, which produces the same opcodes as
+    MyersDiffer, but faster.
+    """
+    if _myers_differ_class is None:
+        from reviewboard.diffviewer.fastmyersdiff import FastMyersDiffer
+        return FastMyersDiffer
+
+    return _myers_differ_class
+
+
+def set_myers_differ_class(differ):
+    """Sets the differ class used for the current diff compat version."""
+    global _myers_differ_class
+
+    assert differ
+    _myers_differ_class = differ
+
+
 def get_differ(a, b, ignore_space=False,
                compat_version=DEFAULT_DIFF_COMPAT_VERSION):
     """Returns a differ for with the given settings.
 
-    By default, this will return the MyersDiffer. Older differs can be used
-    by specifying a compat_version, but this is only for *really* ancient
-    diffs, currently.
+    By default, this will return the class from get_myers_differ_class.
+    Older differs can be used by specifying a compat_version, but this is
+    only for *really* ancient diffs, currently.
     """
     cls = None
 
     if compat_version == 1:
-        from reviewboard.diffviewer.myersdiff import MyersDiffer
-        cls = MyersDiffer
+        cls = get_myers_differ_class()
     elif compat_version == 0:
         from reviewboard.diffviewer.smdiff import SMDiffer
         cls = SMDiffer
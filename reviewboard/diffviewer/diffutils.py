@@ -1,17 +1,33 @@
 from __future__ import with_statement
+import hashlib
+import logging
+import multiprocessing
 import os
 import re
 import subprocess
 import tempfile
-
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.core.cache import cache
+from django.db import connections
+from django.utils import translation
+from django.utils.http import urlquote
 from django.utils.translation import ugettext as _
 from djblets.log import log_timed
 from djblets.siteconfig.models import SiteConfiguration
 from djblets.util.contextmanagers import controlled_subprocess
+from djblets.util.misc import cache_memoize, make_cache_key
 
 from reviewboard.accounts.models import Profile
 from reviewboard.admin.checks import get_can_enable_syntax_highlighting
-from reviewboard.scmtools.core import PRE_CREATION, HEAD
+from reviewboard.diffviewer.errors import PatchError
+from reviewboard.diffviewer.models import FileDiff, FileDiffData
+from reviewboard.diffviewer.patcher import apply_unified_diff
+from reviewboard.hostingsvcs.ratelimit import (PRIORITY_BACKGROUND,
+                                               request_priority)
+from reviewboard.scmtools.core import KeyedThreadPool, PRE_CREATION, HEAD
 
 
 NEWLINE_CONVERSION_RE = re.compile(r'\r(\r?\n)?')
@@ -20,6 +36,97 @@ ALPHANUM_RE = re.compile(r'\w')
 WHITESPACE_RE = re.compile(r'\s')
 
 
+# The maximum combined size, in bytes, of the original and patched file
+# buffers kept in memory by each process. The least recently used buffers
+# are evicted once this is exceeded.
+MAX_FILE_BUFFER_CACHE_SIZE = 64 * 1024 * 1024
+
+
+# The number of times a cache warming worker looks up newly uploaded
+# FileDiffs before giving up, and the number of seconds between attempts.
+# The upload may not have been committed yet when the worker starts.
+WARM_CACHES_MAX_ATTEMPTS = 5
+WARM_CACHES_RETRY_DELAY = 1
+
+# The statistics kept on cache warming. See get_diff_cache_warming_stats.
+WARM_CACHES_STATS = ('scheduled', 'warmed', 'failed', 'warm_first_views',
+                     'cold_first_views')
+
+
+# The maximum number of seconds to wait for a process pool to generate the
+# chunks for a page of files. If it takes longer, the pool is assumed to be
+# broken (for instance, if a worker was killed) and is replaced.
+CHUNK_PROCESS_POOL_TIMEOUT = 5 * 60
+
+
+# Worker pools used for generating diff chunks, keyed off the executor type
+# and the number of workers.
+_chunk_pools = {}
+_chunk_pools_lock = threading.Lock()
+
+# Worker pools used for warming caches for uploaded diffs, keyed off the
+# number of workers and the number of workers per repository.
+_warm_caches_pools = {}
+_warm_caches_lock = threading.Lock()
+
+
+class FileBufferCache(object):
+    """An in-memory cache of file buffers, bounded by their total size.
+
+    This sits in front of the main cache, so that the same original or
+    patched file needed several times while rendering a diff (for the
+    diff itself, interdiffs, and the raw file API) is only fetched from
+    the main cache once per process.
+
+    Once the total size of the buffers exceeds max_size, the least
+    recently used buffers are evicted. Buffers larger than max_size are
+    never stored.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._buffers = {}
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the buffer for a key, or None if it isn't cached."""
+        with self._lock:
+            data = self._buffers.get(key)
+
+            if data is not None:
+                self._keys.remove(key)
+                self._keys.append(key)
+
+            return data
+
+    def set(self, key, data):
+        """Stores the buffer for a key, evicting older buffers as needed."""
+        if len(data) > self.max_size:
+            return
+
+        with self._lock:
+            if key in self._buffers:
+                return
+
+            self._buffers[key] = data
+            self._keys.append(key)
+            self.size += len(data)
+
+            while self.size > self.max_size:
+                self.size -= len(self._buffers.pop(self._keys.pop(0)))
+
+    def clear(self):
+        """Removes all buffers from the cache."""
+        with self._lock:
+            self._buffers.clear()
+            del self._keys[:]
+            self.size = 0
+
+
+_file_buffer_cache = FileBufferCache(MAX_FILE_BUFFER_CACHE_SIZE)
+
+
 def convert_line_endings(data):
     # Files without a trailing newline come out of Perforce (and possibly
     # other systems) with a trailing \r. Diff will see the \r and
@@ -43,9 +150,13 @@ def convert_line_endings(data):
 
 
 def patch(diff, file, filename, request=None):
-    """Apply a diff to a file.  Delegates out to `patch` because noone
-       except Larry Wall knows how to patch."""
+    """Apply a diff to a file.
 
+    By default, this uses the built-in patch engine, which applies the diff
+    in memory. If the built-in engine can't apply the diff, or if the
+    ``diffviewer_patch_engine`` setting is set to ``patch``, this delegates
+    out to `patch`, because noone except Larry Wall knows how to patch.
+    """
     log_timer = log_timed("Patching file %s" % filename,
                           request=request)
 
@@ -53,6 +164,28 @@ def patch(diff, file, filename, request=None):
         # Someone uploaded an unchanged file. Return the one we're patching.
         return file
 
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    if siteconfig.get('diffviewer_patch_engine') != 'patch':
+        try:
+            data = apply_unified_diff(convert_line_endings(diff),
+                                      convert_line_endings(file))
+            log_timer.done()
+
+            return data
+        except PatchError, e:
+            logging.debug("The built-in patch engine couldn't apply the "
+                          "diff to %s (%s). Falling back on patch.",
+                          filename, e)
+
+    data = _patch_with_subprocess(diff, file, filename)
+    log_timer.done()
+
+    return data
+
+
+def _patch_with_subprocess(diff, file, filename):
+    """Apply a diff to a file using the `patch` tool."""
     # Prepare the temporary directory if none is available
     tempdir = tempfile.mkdtemp(prefix='reviewboard.')
 
@@ -81,8 +214,6 @@ def patch(diff, file, filename, request=None):
         f.write(diff)
         f.close()
 
-        log_timer.done()
-
         # FIXME: This doesn't provide any useful error report on why the patch
         # failed to apply, which makes it hard to debug.  We might also want to
         # have it clean up if DEBUG=False
@@ -105,8 +236,6 @@ def patch(diff, file, filename, request=None):
     os.unlink(newfile)
     os.rmdir(tempdir)
 
-    log_timer.done()
-
     return data
 
 
@@ -115,8 +244,43 @@ def get_original_file(filediff, request=None):
     Get a file either from the cache or the SCM, applying the parent diff if
     it exists.
 
+    The resulting buffer, with normalized line endings, is cached by the
+    repository, path, revision and parent diff it was built from, so
+    FileDiffs sharing the same original file share the cached buffer.
+
     SCM exceptions are passed back to the caller.
     """
+    if filediff.source_revision == PRE_CREATION and not filediff.parent_diff:
+        return ""
+
+    return _get_cached_file_buffer(
+        _make_original_file_cache_key(filediff),
+        lambda: _get_original_file_uncached(filediff, request))
+
+
+def get_patched_file(buffer, filediff, request=None):
+    """
+    Get the file resulting from applying a FileDiff's diff to a buffer.
+
+    The buffer is normally the result of get_original_file. The patched
+    file is cached by the contents of the buffer and the diff, so the
+    diff viewer, interdiffs and the patched file API all share the same
+    result.
+    """
+    key = 'diff-patched-file:%s:%s:%s:%s:%s' % (
+        filediff.diffset.repository.pk,
+        urlquote(filediff.source_file),
+        urlquote(filediff.source_revision),
+        hashlib.sha1(buffer).hexdigest(),
+        _get_diff_sha1(filediff.diff_hash_id, filediff.diff64))
+
+    return _get_cached_file_buffer(
+        key,
+        lambda: _get_patched_file_uncached(buffer, filediff, request))
+
+
+def _get_original_file_uncached(filediff, request):
+    """Fetches the original file and applies any parent diff, uncached."""
     data = ""
 
     if filediff.source_revision != PRE_CREATION:
@@ -128,15 +292,8 @@ def get_original_file(filediff, request=None):
             request=request)
 
         # Repository.get_file doesn't know or care about how we need line
-        # endings to work. So, we'll just transform every time.
-        #
-        # This is mostly only a problem if the diff chunks aren't in the
-        # cache, though if several people are working off the same file,
-        # we'll be doing extra work to convert those line endings for each
-        # of those instead of once.
-        #
-        # Only other option is to cache the resulting file, but then we're
-        # duplicating the cached contents.
+        # endings to work. The converted file is what ends up cached by
+        # get_original_file.
         data = convert_line_endings(data)
 
     # If there's a parent diff set, apply it to the buffer.
@@ -147,13 +304,58 @@ def get_original_file(filediff, request=None):
     return data
 
 
-def get_patched_file(buffer, filediff, request=None):
+def _get_patched_file_uncached(buffer, filediff, request):
+    """Applies a FileDiff's diff to a buffer, bypassing the cache."""
     tool = filediff.diffset.repository.get_scmtool()
     diff = tool.normalize_patch(filediff.diff, filediff.source_file,
                                 filediff.source_revision)
     return patch(diff, buffer, filediff.dest_file, request)
 
 
+def _make_original_file_cache_key(filediff):
+    """Returns the cache key for the original file of a FileDiff."""
+    diffset = filediff.diffset
+
+    return 'diff-original-file:%s:%s:%s:%s:%s' % (
+        diffset.repository.pk,
+        urlquote(filediff.source_file),
+        urlquote(filediff.source_revision),
+        urlquote(diffset.base_commit_id or ''),
+        _get_diff_sha1(filediff.parent_diff_hash_id,
+                       filediff.parent_diff64))
+
+
+def _get_diff_sha1(diff_hash_id, diff64):
+    """Returns the SHA1 of a diff stored on a FileDiff.
+
+    Migrated diffs are stored in a FileDiffData, which is keyed off the
+    SHA1 already, so the diff doesn't need to be loaded. Older diffs are
+    still stored on the FileDiff itself, and are hashed here. An empty
+    string is returned if there's no diff.
+    """
+    if diff_hash_id:
+        return diff_hash_id
+    elif diff64:
+        return hashlib.sha1(diff64).hexdigest()
+    else:
+        return ''
+
+
+def _get_cached_file_buffer(key, data_func):
+    """Returns a file buffer from the cache, building it if needed.
+
+    The in-memory FileBufferCache is checked first, followed by the main
+    cache. If neither has the buffer, data_func is called to build it.
+    """
+    data = _file_buffer_cache.get(key)
+
+    if data is None:
+        data = cache_memoize(key, data_func, large_data=True)
+        _file_buffer_cache.set(key, data)
+
+    return data
+
+
 def get_revision_str(revision):
     if revision == HEAD:
         return "HEAD"
@@ -163,50 +365,132 @@ def get_revision_str(revision):
         return _("Revision %s") % revision
 
 
-def get_diff_files(diffset, filediff=None, interdiffset=None, request=None):
-    """Generates a list of files that will be displayed in a diff.
+class FileDiffPartList(object):
+    """A lazily-loaded list of the parts of a diff to display.
 
-    This will go through the given diffset/interdiffset, or a given filediff
-    within that diffset, and generate the list of files that will be
-    displayed. This file list will contain a bunch of metadata on the files,
-    such as the index, original/modified names, revisions, associated
-    filediffs/diffsets, and so on.
-
-    This can be used along with populate_diff_chunks to build a full list
-    containing all diff chunks used for rendering a side-by-side diff.
+    This wraps a QuerySet of FileDiffs sorted for display, and provides
+    each as a (filediff, interfilediff, force_interdiff) part, like the
+    lists returned by get_diff_file_parts. FileDiffs are only loaded for
+    the ranges being accessed, so this can be passed to a Paginator without
+    loading every FileDiff in a DiffSet.
     """
-    if filediff:
-        filediffs = [filediff]
+    def __init__(self, filediffs):
+        self.filediffs = filediffs
 
-        if interdiffset:
-            log_timer = log_timed("Generating diff file info for "
-                                  "interdiffset ids %s-%s, filediff %s" %
-                                  (diffset.id, interdiffset.id, filediff.id),
-                                  request=request)
+    def count(self):
+        """Returns the number of parts in the list."""
+        return self.filediffs.count()
+
+    def index_of(self, filediff_id):
+        """Returns the index of the part for a FileDiff ID, or None."""
+        sort_orders = list(self.filediffs.filter(pk=filediff_id)
+                           .values_list('sort_order', flat=True))
+
+        if not sort_orders:
+            return None
+
+        return self.filediffs.filter(sort_order__lt=sort_orders[0]).count()
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for filediff in self.filediffs:
+            yield (filediff, None, False)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [
+                (filediff, None, False)
+                for filediff in self.filediffs[key]
+            ]
         else:
-            log_timer = log_timed("Generating diff file info for "
-                                  "diffset id %s, filediff %s" %
-                                  (diffset.id, filediff.id),
-                                  request=request)
+            return (self.filediffs[key], None, False)
+
+
+def compare_filenames(filename1, filename2):
+    """Compares two filenames for sorting files in the diff viewer.
+
+    Files are sorted by directory, then by name, and then by extension in
+    descending order, to make *.h be ahead of *.c/cpp.
+    """
+    basepath1, basename1 = _split_filename(filename1)
+    basepath2, basename2 = _split_filename(filename2)
+
+    if basepath1 != basepath2:
+        return cmp(basepath1, basepath2)
+
+    file1, ext1 = os.path.splitext(basename1)
+    file2, ext2 = os.path.splitext(basename2)
+
+    if file1 != file2:
+        return cmp(file1, file2)
     else:
-        filediffs = diffset.files.select_related().all()
+        return cmp(ext2, ext1)
 
-        if interdiffset:
-            log_timer = log_timed("Generating diff file info for "
-                                  "interdiffset ids %s-%s" %
-                                  (diffset.id, interdiffset.id),
-                                  request=request)
-        else:
-            log_timer = log_timed("Generating diff file info for "
-                                  "diffset id %s" % diffset.id,
-                                  request=request)
+
+def set_filediff_sort_order(filediffs):
+    """Sets the display sort order on a list of FileDiffs.
+
+    The FileDiffs are numbered in the order they're displayed in the diff
+    viewer, based on compare_filenames. They're not saved.
+    """
+    sorted_filediffs = sorted(
+        filediffs,
+        cmp=lambda x, y: compare_filenames(x.source_file, y.source_file))
+
+    for i, filediff in enumerate(sorted_filediffs):
+        filediff.sort_order = i
+
+
+def get_sorted_filediffs(diffset):
+    """Returns a QuerySet of the FileDiffs in a DiffSet, in display order.
+
+    The sort order is stored on each FileDiff when the DiffSet is created.
+    FileDiffs in older DiffSets are given a sort order the first time
+    they're needed.
+    """
+    filediffs = diffset.files.all()
+
+    if filediffs.filter(sort_order__isnull=True).exists():
+        logging.debug('Setting the sort order on FileDiffs in DiffSet %s'
+                      % diffset.pk)
+
+        unsorted_filediffs = list(filediffs.only('pk', 'source_file'))
+        set_filediff_sort_order(unsorted_filediffs)
+
+        for filediff in unsorted_filediffs:
+            filediffs.filter(pk=filediff.pk).update(
+                sort_order=filediff.sort_order)
+
+    return filediffs.order_by('sort_order', 'pk')
+
+
+def get_diff_file_parts(diffset, filediff=None, interdiffset=None):
+    """Returns the sorted parts of a diff that will be displayed.
+
+    Each part is a tuple of (filediff, interfilediff, force_interdiff),
+    and represents one file shown in the diff viewer.
+
+    For a whole DiffSet, this returns a FileDiffPartList, which only loads
+    the FileDiffs being accessed. For a single FileDiff, or for an
+    interdiff (where the files in both DiffSets must be compared), this
+    returns a list.
+    """
+    if filediff:
+        filediffs = [filediff]
+    elif interdiffset:
+        filediffs = diffset.files.select_related().all()
+    else:
+        return FileDiffPartList(get_sorted_filediffs(diffset)
+                                .select_related())
 
     # A map used to quickly look up the equivalent interfilediff given a
     # source file.
     interdiff_map = {}
 
     if interdiffset:
-        for interfilediff in interdiffset.files.all():
+        for interfilediff in interdiffset.files.select_related().all():
             if (not filediff or
                     filediff.source_file == interfilediff.source_file):
                 interdiff_map[interfilediff.source_file] = interfilediff
@@ -221,12 +505,18 @@ def get_diff_files(diffset, filediff=None, interdiffset=None, request=None):
     # reverted in the interdiff).
     has_interdiffset = interdiffset is not None
 
-    filediff_parts = [
-        (temp_filediff,
-         interdiff_map.pop(temp_filediff.source_file, None),
-         has_interdiffset)
-        for temp_filediff in filediffs
-    ]
+    parts = []
+
+    for temp_filediff in filediffs:
+        interfilediff = interdiff_map.pop(temp_filediff.source_file, None)
+
+        # When showing an interdiff, we only want to show files that
+        # have a difference.
+        if interfilediff and _filediffs_have_same_diff(temp_filediff,
+                                                       interfilediff):
+            continue
+
+        parts.append((temp_filediff, interfilediff, has_interdiffset))
 
     if interdiffset:
         # We've removed everything in the map that we've already found.
@@ -238,26 +528,171 @@ def get_diff_files(diffset, filediff=None, interdiffset=None, request=None):
         # the source filediff and not specify an interdiff. Keeps things
         # simple, code-wise, since we really have no need to special-case
         # this.
-        filediff_parts += [
+        parts += [
             (interdiff, None, False)
             for interdiff in interdiff_map.itervalues()
         ]
 
-    files = []
+    parts.sort(cmp=lambda x, y: compare_filenames(x[0].source_file,
+                                                  y[0].source_file))
 
-    for parts in filediff_parts:
-        filediff, interfilediff, force_interdiff = parts
+    return parts
 
-        newfile = (filediff.source_revision == PRE_CREATION)
 
+def prefetch_filediff_data(filediffs):
+    """Loads the diff data for a list of FileDiffs in a single query.
+
+    Accessing the diff, parent diff or line counts of a FileDiff loads its
+    FileDiffData, one query per FileDiff. This instead loads the
+    FileDiffData for all the FileDiffs at once and caches them on the
+    FileDiffs, so that building a page of the diff viewer takes the same
+    number of queries regardless of how many files are on it.
+    """
+    fields = (FileDiff._meta.get_field('diff_hash'),
+              FileDiff._meta.get_field('parent_diff_hash'))
+    hash_ids = set()
+
+    for filediff in filediffs:
+        for field in fields:
+            hash_id = getattr(filediff, field.attname)
+
+            if hash_id and not hasattr(filediff, field.get_cache_name()):
+                hash_ids.add(hash_id)
+
+    if not hash_ids:
+        return
+
+    filediff_data = FileDiffData.objects.in_bulk(list(hash_ids))
+
+    for filediff in filediffs:
+        for field in fields:
+            hash_id = getattr(filediff, field.attname)
+
+            if hash_id in filediff_data:
+                setattr(filediff, field.get_cache_name(),
+                        filediff_data[hash_id])
+
+
+def prefetch_original_files(filediffs, request=None):
+    """Fetches the original files for a list of FileDiffs in bulk.
+
+    The files for each repository are fetched with a single call to
+    Repository.get_files, and cached just as if they'd been fetched one at
+    a time, so that get_original_file doesn't need to go back to the
+    repository for each file.
+
+    Errors are logged and otherwise ignored. They'll come up again for the
+    affected files when get_original_file is called.
+    """
+    files_by_repository = {}
+
+    for filediff in filediffs:
+        diffset = filediff.diffset
+
+        if (not diffset.repository_id or
+            filediff.source_revision == PRE_CREATION or
+            _file_buffer_cache.get(
+                _make_original_file_cache_key(filediff)) is not None):
+            continue
+
+        key = (diffset.repository_id, diffset.base_commit_id)
+
+        if key not in files_by_repository:
+            files_by_repository[key] = (diffset.repository, set())
+
+        files_by_repository[key][1].add((filediff.source_file,
+                                         filediff.source_revision))
+
+    for (repository_id, base_commit_id), (repository, paths_and_revisions) \
+            in files_by_repository.iteritems():
+        if len(paths_and_revisions) < 2:
+            # There's nothing to gain over fetching a single file normally.
+            continue
+
+        try:
+            repository.get_files(sorted(paths_and_revisions),
+                                 base_commit_id=base_commit_id,
+                                 request=request)
+        except Exception, e:
+            logging.warning('Unable to prefetch %d files from repository '
+                            '%s: %s',
+                            len(paths_and_revisions), repository_id, e)
+
+
+def get_diff_file_part_index(parts, filediff_id):
+    """Returns the index of the part for a FileDiff ID, or None.
+
+    This works with the results of get_diff_file_parts.
+    """
+    if isinstance(parts, FileDiffPartList):
+        return parts.index_of(filediff_id)
+
+    for i, (filediff, interfilediff, force_interdiff) in enumerate(parts):
+        if filediff.pk == filediff_id:
+            return i
+
+    return None
+
+
+def get_diff_files(diffset, filediff=None, interdiffset=None, request=None,
+                   parts=None):
+    """Generates a list of files that will be displayed in a diff.
+
+    This will go through the given diffset/interdiffset, or a given filediff
+    within that diffset, and generate the list of files that will be
+    displayed. This file list will contain a bunch of metadata on the files,
+    such as the index, original/modified names, revisions, associated
+    filediffs/diffsets, and so on.
+
+    If parts is provided, only the files for those parts (as returned by
+    get_diff_file_parts, or a slice of them) are generated. This is used
+    to build only the files for one page of the diff viewer.
+
+    This can be used along with populate_diff_chunks to build a full list
+    containing all diff chunks used for rendering a side-by-side diff.
+    """
+    if filediff:
+        if interdiffset:
+            log_timer = log_timed("Generating diff file info for "
+                                  "interdiffset ids %s-%s, filediff %s" %
+                                  (diffset.id, interdiffset.id, filediff.id),
+                                  request=request)
+        else:
+            log_timer = log_timed("Generating diff file info for "
+                                  "diffset id %s, filediff %s" %
+                                  (diffset.id, filediff.id),
+                                  request=request)
+    else:
         if interdiffset:
-            # First, find out if we want to even process this one.
-            # We only process if there's a difference in files.
+            log_timer = log_timed("Generating diff file info for "
+                                  "interdiffset ids %s-%s" %
+                                  (diffset.id, interdiffset.id),
+                                  request=request)
+        else:
+            log_timer = log_timed("Generating diff file info for "
+                                  "diffset id %s" % diffset.id,
+                                  request=request)
+
+    if parts is None:
+        parts = get_diff_file_parts(diffset, filediff, interdiffset)
 
-            if (filediff and interfilediff and
-                    filediff.diff == interfilediff.diff):
-                continue
+    parts = list(parts)
+    prefetch_filediff_data([
+        part_filediff
+        for part in parts
+        for part_filediff in part[:2]
+        if part_filediff is not None
+    ])
+
+    # Looking up the SCMTool for each file can be expensive, so only do
+    # it once per repository.
+    tools = {}
+    files = []
 
+    for filediff, interfilediff, force_interdiff in parts:
+        newfile = (filediff.source_revision == PRE_CREATION)
+
+        if interdiffset:
             source_revision = _("Diff Revision %s") % diffset.revision
 
             if not interfilediff and force_interdiff:
@@ -273,16 +708,14 @@ def get_diff_files(diffset, filediff=None, interdiffset=None, request=None):
             else:
                 dest_revision = _("New Change")
 
-        i = filediff.source_file.rfind('/')
+        basepath, basename = _split_filename(filediff.source_file)
 
-        if i != -1:
-            basepath = filediff.source_file[:i]
-            basename = filediff.source_file[i + 1:]
-        else:
-            basepath = ""
-            basename = filediff.source_file
+        repository = filediff.diffset.repository
 
-        tool = filediff.diffset.repository.get_scmtool()
+        if repository.pk not in tools:
+            tools[repository.pk] = repository.get_scmtool()
+
+        tool = tools[repository.pk]
         depot_filename = tool.normalize_path_for_display(filediff.source_file)
         dest_filename = tool.normalize_path_for_display(filediff.dest_file)
 
@@ -306,27 +739,33 @@ def get_diff_files(diffset, filediff=None, interdiffset=None, request=None):
                             not filediff.parent_diff),
         })
 
-    def cmp_file(x, y):
-        # Sort based on basepath in asc order
-        if x["basepath"] != y["basepath"]:
-            return cmp(x["basepath"], y["basepath"])
-
-        # Sort based on filename in asc order, then based on extension in desc
-        # order, to make *.h be ahead of *.c/cpp
-        x_file, x_ext = os.path.splitext(x["basename"])
-        y_file, y_ext = os.path.splitext(y["basename"])
-        if x_file != y_file:
-            return cmp(x_file, y_file)
-        else:
-            return cmp(y_ext, x_ext)
-
-    files.sort(cmp_file)
-
     log_timer.done()
 
     return files
 
 
+def _filediffs_have_same_diff(filediff1, filediff2):
+    """Returns whether two FileDiffs have the same diff.
+
+    Diffs stored in a FileDiffData are keyed off their SHA1, so they can be
+    compared without loading them.
+    """
+    if filediff1.diff_hash_id and filediff2.diff_hash_id:
+        return filediff1.diff_hash_id == filediff2.diff_hash_id
+    else:
+        return filediff1.diff == filediff2.diff
+
+
+def _split_filename(filename):
+    """Splits a filename into its directory and base name."""
+    i = filename.rfind('/')
+
+    if i != -1:
+        return filename[:i], filename[i + 1:]
+    else:
+        return "", filename
+
+
 def populate_diff_chunks(files, enable_syntax_highlighting=True,
                          request=None):
     """Populates a list of diff files with chunk data.
@@ -334,16 +773,61 @@ def populate_diff_chunks(files, enable_syntax_highlighting=True,
     This accepts a list of files (generated by get_diff_files) and generates
     diff chunk data for each file in the list. The chunk data is stored in
     the file state.
+
+    By default, chunks are generated one file at a time. If the
+    ``diffviewer_chunk_executor`` setting is set to ``thread`` or
+    ``process``, any files without cached chunks are instead generated
+    concurrently across a pool of threads or processes. The resulting chunks
+    are cached just as they would be otherwise.
     """
     from reviewboard.diffviewer.chunk_generator import get_diff_chunk_generator
 
-    for diff_file in files:
-        generator = get_diff_chunk_generator(request,
-                                             diff_file['filediff'],
-                                             diff_file['interfilediff'],
-                                             diff_file['force_interdiff'],
-                                             enable_syntax_highlighting)
-        chunks = generator.get_chunks()
+    generators = [
+        get_diff_chunk_generator(request,
+                                 diff_file['filediff'],
+                                 diff_file['interfilediff'],
+                                 diff_file['force_interdiff'],
+                                 enable_syntax_highlighting)
+        for diff_file in files
+    ]
+
+    uncached = [
+        (i, generator)
+        for i, generator in enumerate(generators)
+        if generator.has_chunks() and not generator.has_cached_chunks()
+    ]
+
+    # Fetch the files needed to generate the uncached chunks all at once,
+    # rather than one at a time as each file's chunks are generated.
+    prefetch_original_files(
+        [
+            filediff
+            for i, generator in uncached
+            for filediff in (generator.filediff, generator.interfilediff)
+            if filediff is not None
+        ],
+        request=request)
+
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    if siteconfig.get('diffviewer_warm_caches_on_upload'):
+        _record_first_views(generators, uncached)
+
+    executor = siteconfig.get('diffviewer_chunk_executor')
+
+    if executor in ('thread', 'process'):
+        precomputed_chunks = _generate_chunks_concurrently(
+            uncached, executor,
+            siteconfig.get('diffviewer_chunk_executor_max_workers'),
+            request)
+    else:
+        precomputed_chunks = {}
+
+    for i, (diff_file, generator) in enumerate(zip(files, generators)):
+        if i in precomputed_chunks:
+            chunks = precomputed_chunks[i]
+        else:
+            chunks = generator.get_chunks()
 
         diff_file.update({
             'chunks': chunks,
@@ -368,6 +852,410 @@ def populate_diff_chunks(files, enable_syntax_highlighting=True,
         })
 
 
+def _generate_chunks_concurrently(uncached, executor, max_workers,
+                                  request=None):
+    """Generates chunks for uncached files across a pool of workers.
+
+    This takes a list of (index, generator) tuples for the generators that
+    have chunks to generate and don't already have them cached. Chunks are
+    cached as they're received, and are returned in a dictionary mapping
+    the index of each generator to its chunks.
+    """
+    if len(uncached) < 2:
+        # There's no point in using a pool for a single file.
+        return {}
+
+    log_timer = log_timed("Generating diff chunks for %d files using a %s "
+                          "pool" % (len(uncached), executor),
+                          request=request)
+
+    pool = _get_chunk_pool(executor, max_workers)
+
+    if executor == 'process':
+        # Neither the request nor the generators themselves can be sent to
+        # another process, so the workers rebuild the generators.
+        async_result = pool.map_async(_generate_chunks_in_process, [
+            (generator.filediff, generator.interfilediff,
+             generator.force_interdiff, generator.enable_syntax_highlighting)
+            for i, generator in uncached
+        ])
+
+        try:
+            results = async_result.get(CHUNK_PROCESS_POOL_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            logging.error('Timed out generating diff chunks in a process '
+                          'pool. Replacing the pool.',
+                          request=request)
+            _discard_chunk_pool(executor, max_workers, pool)
+            log_timer.done()
+
+            return {}
+    else:
+        results = pool.map(_generate_chunks_in_thread,
+                           [generator for i, generator in uncached])
+
+    precomputed_chunks = {}
+
+    for (i, generator), chunks in zip(uncached, results):
+        if chunks is None:
+            # The worker failed to generate the chunks. They'll be
+            # generated again in this process, which raises the error
+            # just as it would without a pool.
+            continue
+
+        cache_memoize(generator.make_cache_key(), lambda: chunks,
+                      large_data=True)
+        precomputed_chunks[i] = chunks
+
+    log_timer.done()
+
+    return precomputed_chunks
+
+
+def _generate_chunks_in_thread(generator):
+    """Generates chunks for a file within a thread pool worker."""
+    try:
+        return generator.get_chunks_uncached()
+    finally:
+        # Each thread opens its own database connections, which would
+        # otherwise stay open for the life of the thread.
+        for connection in connections.all():
+            connection.close()
+
+
+def _generate_chunks_in_process(args):
+    """Generates chunks for a file within a process pool worker.
+
+    This must be a module-level function, so that it can be used by a
+    process pool.
+
+    Any errors are logged, and None is returned in place of the chunks.
+    Errors can't be passed back to the parent process, as many of them
+    can't be unpickled there, which on Python 2 leaves the pool unable to
+    return any more results.
+    """
+    from reviewboard.diffviewer.chunk_generator import get_diff_chunk_generator
+
+    try:
+        generator = get_diff_chunk_generator(None, *args)
+
+        return generator.get_chunks_uncached()
+    except Exception, e:
+        logging.exception('Error generating diff chunks in a process pool '
+                          'worker: %s', e)
+
+        return None
+
+
+def _init_chunk_process_worker():
+    """Initializes a process pool worker.
+
+    The worker inherits the parent process's database connections and cache
+    client, which can't be shared. We drop the database connections without
+    closing them (which would close the parent's connection), so the worker
+    will open its own. Cache backends with connections (such as memcached)
+    provide close(), which makes them reconnect on next use.
+    """
+    for connection in connections.all():
+        connection.connection = None
+
+    if hasattr(cache, 'close'):
+        cache.close()
+
+
+def _get_chunk_pool(executor, max_workers):
+    """Returns a pool for generating chunks.
+
+    Pools are created on first use and kept around for the life of the
+    process, so that workers don't have to be spun up for every diff.
+
+    Process pool workers only know about the chunk generator class that was
+    set when they were forked, so a new process pool is created if the
+    class has changed since.
+    """
+    from reviewboard.diffviewer.chunk_generator import \
+        get_diff_chunk_generator_class
+
+    key = (executor, max_workers)
+    generator_cls = get_diff_chunk_generator_class()
+
+    with _chunk_pools_lock:
+        pool, pool_generator_cls = _chunk_pools.get(key, (None, None))
+
+        if (pool is not None and executor == 'process' and
+            pool_generator_cls is not generator_cls):
+            pool.close()
+            pool = None
+
+        if pool is None:
+            if executor == 'process':
+                pool = _create_chunk_process_pool(max_workers)
+            else:
+                pool = ThreadPool(processes=max_workers)
+
+            _chunk_pools[key] = (pool, generator_cls)
+
+    return pool
+
+
+def _create_chunk_process_pool(max_workers):
+    """Creates a process pool for generating chunks.
+
+    The workers are forked from a process that may be running other threads,
+    such as those of a threaded web server. A lock held by another thread
+    at the time of the fork would stay locked forever in the workers, so
+    the logging locks, which the workers need, are held while forking.
+    """
+    handlers = [
+        handler
+        for handler in (ref() for ref in logging._handlerList)
+        if handler is not None
+    ]
+
+    logging._acquireLock()
+
+    try:
+        for handler in handlers:
+            handler.acquire()
+
+        try:
+            return multiprocessing.Pool(
+                processes=max_workers,
+                initializer=_init_chunk_process_worker)
+        finally:
+            for handler in reversed(handlers):
+                handler.release()
+    finally:
+        logging._releaseLock()
+
+
+def _discard_chunk_pool(executor, max_workers, pool):
+    """Shuts down a broken pool, so that a new one is used next time."""
+    with _chunk_pools_lock:
+        if _chunk_pools.get((executor, max_workers), (None,))[0] is pool:
+            del _chunk_pools[(executor, max_workers)]
+
+    pool.terminate()
+
+
+def schedule_diff_cache_warming(filediffs):
+    """Warms the caches for newly uploaded FileDiffs in the background.
+
+    If the ``diffviewer_warm_caches_on_upload`` setting is enabled, this
+    hands the FileDiffs off to a pool of
+    ``diffviewer_warm_caches_max_workers`` threads and returns immediately.
+    The workers fetch the original files and generate the diff chunks, so
+    that the first person to view the diff doesn't have to wait for them.
+
+    At most ``diffviewer_warm_caches_max_workers_per_repository`` uploads
+    are warmed at once for any one repository, to limit the load on it.
+    Further uploads for the repository are queued without holding up
+    uploads for other repositories.
+    """
+    siteconfig = SiteConfiguration.objects.get_current()
+
+    if not siteconfig.get('diffviewer_warm_caches_on_upload'):
+        return
+
+    filediff_ids = [filediff.pk for filediff in filediffs if filediff.pk]
+
+    if not filediff_ids or not filediffs[0].diffset.repository_id:
+        return
+
+    pool = _get_warm_caches_pool(
+        siteconfig.get('diffviewer_warm_caches_max_workers'),
+        siteconfig.get('diffviewer_warm_caches_max_workers_per_repository'))
+
+    # This matches what the diff viewer uses for anyone who hasn't turned
+    # syntax highlighting off in their profile.
+    enable_syntax_highlighting = bool(
+        siteconfig.get('diffviewer_syntax_highlighting') and
+        get_can_enable_syntax_highlighting()[0])
+
+    _increment_warm_caches_stat('scheduled', len(filediff_ids))
+
+    # The chunks are cached for the uploader's language, which is the
+    # language people reviewing the diff are most likely to use.
+    pool.apply_async(filediffs[0].diffset.repository_id,
+                     _warm_diff_caches_in_thread,
+                     (filediff_ids, enable_syntax_highlighting,
+                      translation.get_language()))
+
+
+def warm_diff_caches(filediffs, enable_syntax_highlighting=True):
+    """Fetches the files and generates the chunks for a list of FileDiffs.
+
+    The original files are fetched in bulk, and the chunks are generated
+    and cached just as they would be when viewing the diff. Each FileDiff
+    that's warmed is marked as such, so that its first view can be counted
+    in the statistics returned by get_diff_cache_warming_stats.
+
+    Errors are logged and otherwise ignored.
+    """
+    from reviewboard.diffviewer.chunk_generator import get_diff_chunk_generator
+
+    prefetch_original_files(filediffs)
+
+    num_warmed = 0
+
+    for filediff in filediffs:
+        try:
+            get_diff_chunk_generator(None, filediff, None, False,
+                                     enable_syntax_highlighting).get_chunks()
+        except Exception, e:
+            logging.warning('Unable to warm the caches for FileDiff %s: %s',
+                            filediff.pk, e)
+        else:
+            cache.set(_make_warmed_filediff_cache_key(filediff.pk), True)
+            num_warmed += 1
+
+    _increment_warm_caches_stat('warmed', num_warmed)
+    _increment_warm_caches_stat('failed', len(filediffs) - num_warmed)
+
+
+def get_diff_cache_warming_stats():
+    """Returns statistics on warming the caches for uploaded diffs.
+
+    This returns a dictionary with the number of FileDiffs that were
+    scheduled to be warmed (``scheduled``), that were warmed (``warmed``)
+    and that couldn't be warmed (``failed``), along with the number of
+    warmed FileDiffs whose first view did (``warm_first_views``) or didn't
+    (``cold_first_views``) find their chunks in the cache.
+
+    The counts are stored in the cache, so that they're shared between
+    processes. They'll start over if the cache is cleared.
+    """
+    keys = dict([
+        (name, make_cache_key('diff-warm-caches-stats-%s' % name))
+        for name in WARM_CACHES_STATS
+    ])
+    values = cache.get_many(keys.values())
+
+    return dict([
+        (name, values.get(key, 0))
+        for name, key in keys.iteritems()
+    ])
+
+
+def _warm_diff_caches_in_thread(filediff_ids, enable_syntax_highlighting,
+                                language):
+    """Warms the caches for uploaded FileDiffs within a worker thread."""
+    translation.activate(language)
+
+    try:
+        for i in xrange(WARM_CACHES_MAX_ATTEMPTS):
+            filediffs = list(
+                FileDiff.objects.filter(pk__in=filediff_ids)
+                .select_related('diffset', 'diffset__repository'))
+
+            if len(filediffs) == len(filediff_ids):
+                break
+
+            # Start a new transaction on the next attempt, so that the
+            # upload can be seen once it's been committed.
+            _close_connections()
+            time.sleep(WARM_CACHES_RETRY_DELAY)
+        else:
+            logging.warning('Unable to warm the caches for FileDiffs %s: '
+                            'they were never saved',
+                            filediff_ids)
+            _increment_warm_caches_stat('failed', len(filediff_ids))
+            return
+
+        # Nobody is waiting on these files yet, so they shouldn't use up
+        # what's left of a hosting service's rate limit.
+        with request_priority(PRIORITY_BACKGROUND):
+            warm_diff_caches(filediffs, enable_syntax_highlighting)
+    except Exception, e:
+        logging.error('Unexpected error warming the caches for FileDiffs '
+                      '%s: %s',
+                      filediff_ids, e, exc_info=1)
+    finally:
+        translation.deactivate()
+
+        # Each thread opens its own database connections, which would
+        # otherwise stay open for the life of the thread.
+        _close_connections()
+
+
+def _close_connections():
+    """Closes the current thread's database connections."""
+    for connection in connections.all():
+        connection.close()
+
+
+def _record_first_views(generators, uncached):
+    """Records whether warmed FileDiffs were warm when first viewed.
+
+    This is called with the chunk generators for a page of the diff viewer,
+    and the (index, generator) tuples for those without cached chunks.
+    Each warmed FileDiff is only counted the first time it's viewed.
+    """
+    generators_by_key = dict([
+        (_make_warmed_filediff_cache_key(generator.filediff.pk), generator)
+        for generator in generators
+        if not generator.force_interdiff
+    ])
+
+    if not generators_by_key:
+        return
+
+    warmed_keys = cache.get_many(generators_by_key.keys()).keys()
+
+    if not warmed_keys:
+        return
+
+    cache.delete_many(warmed_keys)
+
+    uncached_generators = set([generator for i, generator in uncached])
+    num_cold = len([
+        key
+        for key in warmed_keys
+        if generators_by_key[key] in uncached_generators
+    ])
+
+    _increment_warm_caches_stat('warm_first_views',
+                                len(warmed_keys) - num_cold)
+    _increment_warm_caches_stat('cold_first_views', num_cold)
+
+
+def _make_warmed_filediff_cache_key(filediff_id):
+    """Makes a cache key for marking a FileDiff as warmed."""
+    return make_cache_key('diff-warmed-filediff-%s' % filediff_id)
+
+
+def _increment_warm_caches_stat(name, count):
+    """Adds to one of the statistics on cache warming."""
+    if count:
+        key = make_cache_key('diff-warm-caches-stats-%s' % name)
+        cache.add(key, 0)
+
+        try:
+            cache.incr(key, count)
+        except ValueError:
+            # The key was evicted after being added. Losing a count isn't
+            # worth retrying for.
+            pass
+
+
+def _get_warm_caches_pool(max_workers, max_repository_workers):
+    """Returns a pool for warming the caches for uploaded diffs.
+
+    Tasks are queued in the pool by repository ID. Pools are created on
+    first use and kept around for the life of the process.
+    """
+    key = (max_workers, max_repository_workers)
+
+    with _warm_caches_lock:
+        pool = _warm_caches_pools.get(key)
+
+        if pool is None:
+            pool = KeyedThreadPool(max_workers, max_repository_workers)
+            _warm_caches_pools[key] = pool
+
+    return pool
+
+
 def get_file_chunks_in_range(context, filediff, interfilediff,
                              first_line, num_lines):
     """
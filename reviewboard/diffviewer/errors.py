@@ -22,3 +22,8 @@ class DiffParserError(Exception):
     def __init__(self, msg, linenum):
         Exception.__init__(self, msg)
         self.linenum = linenum
+
+
+class PatchError(Exception):
+    """A diff couldn't be applied by the built-in patch engine."""
+    pass
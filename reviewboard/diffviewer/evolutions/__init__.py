@@ -7,4 +7,5 @@ SEQUENCE = [
     'diffsethistory_diff_updated',
     'filediffdata_line_counts',
     'diffset_base_commit_id',
+    'filediff_sort_order',
 ]
@@ -0,0 +1,7 @@
+from django_evolution.mutations import AddField
+from django.db import models
+
+
+MUTATIONS = [
+    AddField('FileDiff', 'sort_order', models.IntegerField, null=True)
+]
@@ -0,0 +1,401 @@
+"""A faster implementation of the Myers diff algorithm.
+
+FastMyersDiffer produces exactly the same opcodes as MyersDiffer, and is
+used in its place by get_differ. The difference is in how the line codes
+are stored and compared.
+
+Once confusing lines are discarded, the remaining line codes for each file
+are packed into an array of machine integers, and kept as a byte string.
+Runs of identical lines (the "snakes" followed by the diagonal search, and
+the common leading and trailing lines trimmed by each step of the LCS) are
+then found by comparing slices of those byte strings, which happens in C,
+rather than by comparing one line code at a time in Python. The hot loops
+also avoid repeated attribute lookups.
+"""
+from array import array
+
+from reviewboard.diffviewer.myersdiff import MyersDiffer
+
+
+#: The type code used for the line code arrays.
+LINE_CODE_TYPECODE = 'i'
+
+
+class FastMyersDiffer(MyersDiffer):
+    """An array-backed implementation of MyersDiffer.
+
+    This is a drop-in replacement for MyersDiffer. The search for the
+    shortest middle snake, the LCS and the discarding of confusing lines
+    all make the same decisions in the same order, so the resulting opcodes
+    are always identical.
+    """
+    #: The number of lines to compare one at a time before switching to
+    #: comparing blocks of lines.
+    LINEAR_SCAN_LIMIT = 4
+
+    def __init__(self, *args, **kwargs):
+        super(FastMyersDiffer, self).__init__(*args, **kwargs)
+
+        self._item_size = array(LINE_CODE_TYPECODE).itemsize
+        self._a_buf = self._b_buf = None
+
+    def _gen_diff_codes(self, lines, is_modified_file):
+        """Converts all unique lines of text into unique numbers.
+
+        This behaves the same as MyersDiffer._gen_diff_codes, but the
+        common case of a line that has already been seen (and has no
+        interesting line name) takes fewer lookups.
+        """
+        codes = []
+        append_code = codes.append
+        code_table = self.code_table
+        interesting_line_table = self.interesting_line_table
+        interesting_line_regexes = self.interesting_line_regexes
+        ignore_space = self.ignore_space
+
+        if is_modified_file:
+            interesting_lines = self.interesting_lines[1]
+        else:
+            interesting_lines = self.interesting_lines[0]
+
+        for linenum, raw_line in enumerate(lines):
+            stripped_line = raw_line.lstrip()
+
+            if ignore_space and stripped_line:
+                line = stripped_line
+            else:
+                line = raw_line
+
+            code = code_table.get(line)
+
+            if code is None:
+                self.last_code += 1
+                code = self.last_code
+                code_table[line] = code
+                interesting_line_name = None
+
+                if stripped_line:
+                    for name, regex in interesting_line_regexes:
+                        if regex.match(raw_line):
+                            interesting_line_name = name
+                            interesting_line_table[code] = name
+                            break
+            else:
+                interesting_line_name = interesting_line_table.get(code)
+
+            if interesting_line_name:
+                interesting_lines[interesting_line_name].append((linenum,
+                                                                 raw_line))
+
+            append_code(code)
+
+        return codes
+
+    def _discard_confusing_lines(self):
+        """Discards lines that can't be matched, or that match too often.
+
+        Once MyersDiffer has discarded the lines, the remaining line codes
+        are packed into byte strings for the block comparisons done by
+        _count_forward_matches and _count_backward_matches.
+
+        The lists of line codes are kept around as well, since indexing a
+        list is faster than indexing an array when comparing single lines.
+        """
+        super(FastMyersDiffer, self)._discard_confusing_lines()
+
+        self._a_buf = self._pack_line_codes(self.a_data)
+        self._b_buf = self._pack_line_codes(self.b_data)
+
+    def _pack_line_codes(self, data):
+        """Packs the undiscarded line codes into a byte string."""
+        return array(LINE_CODE_TYPECODE, data.undiscarded).tostring()
+
+    def _count_forward_matches(self, x, y, limit):
+        """Counts the matching line codes starting at x and y.
+
+        At most limit line codes are compared. Blocks of increasing size are
+        compared until one differs, and then the differing block is
+        narrowed down to the first mismatch.
+        """
+        a_buf = self._a_buf
+        b_buf = self._b_buf
+        item_size = self._item_size
+        matched = 0
+        step = 16
+        growing = True
+
+        while matched < limit:
+            if step > limit - matched:
+                step = limit - matched
+
+            a_start = (x + matched) * item_size
+            b_start = (y + matched) * item_size
+            size = step * item_size
+
+            if a_buf[a_start:a_start + size] == b_buf[b_start:b_start + size]:
+                matched += step
+
+                if growing:
+                    step *= 2
+            elif step == 1:
+                break
+            else:
+                step //= 2
+                growing = False
+
+        return matched
+
+    def _count_backward_matches(self, x, y, limit):
+        """Counts the matching line codes ending just before x and y.
+
+        This is the reverse of _count_forward_matches.
+        """
+        a_buf = self._a_buf
+        b_buf = self._b_buf
+        item_size = self._item_size
+        matched = 0
+        step = 16
+        growing = True
+
+        while matched < limit:
+            if step > limit - matched:
+                step = limit - matched
+
+            a_end = (x - matched) * item_size
+            b_end = (y - matched) * item_size
+            size = step * item_size
+
+            if a_buf[a_end - size:a_end] == b_buf[b_end - size:b_end]:
+                matched += step
+
+                if growing:
+                    step *= 2
+            elif step == 1:
+                break
+            else:
+                step //= 2
+                growing = False
+
+        return matched
+
+    def _find_sms(self, a_lower, a_upper, b_lower, b_upper, find_minimal):
+        """Finds the Shortest Middle Snake.
+
+        This is the same search as MyersDiffer._find_sms, with the snakes
+        followed by _count_forward_matches and _count_backward_matches
+        once they're longer than a few lines.
+        """
+        a_undiscarded = self.a_data.undiscarded
+        b_undiscarded = self.b_data.undiscarded
+        count_forward_matches = self._count_forward_matches
+        count_backward_matches = self._count_backward_matches
+        linear_scan_limit = self.LINEAR_SCAN_LIMIT
+        snake_limit = self.SNAKE_LIMIT
+        max_lines = self.max_lines
+
+        down_vector = self.fdiag  # The vector for the (0, 0) to (x, y) search
+        up_vector = self.bdiag    # The vector for the (u, v) to (N, M) search
+        diagoff = self.downoff  # The same as self.upoff
+
+        down_k = a_lower - b_lower  # The k-line to start the forward search
+        up_k = a_upper - b_upper    # The k-line to start the reverse search
+        odd_delta = (down_k - up_k) % 2 != 0
+
+        down_vector[diagoff + down_k] = a_lower
+        up_vector[diagoff + up_k] = a_upper
+
+        dmin = a_lower - b_upper
+        dmax = a_upper - b_lower
+
+        down_min = down_max = down_k
+        up_min = up_max = up_k
+
+        cost = 0
+
+        while True:
+            cost += 1
+            big_snake = False
+
+            if down_min > dmin:
+                down_min -= 1
+                down_vector[diagoff + down_min - 1] = -1
+            else:
+                down_min += 1
+
+            if down_max < dmax:
+                down_max += 1
+                down_vector[diagoff + down_max + 1] = -1
+            else:
+                down_max -= 1
+
+            # Extend the forward path. i is the index of diagonal k in both
+            # vectors.
+            up_min_i = diagoff + up_min
+            up_max_i = diagoff + up_max
+
+            for i in xrange(diagoff + down_max, diagoff + down_min - 1, -2):
+                tlo = down_vector[i - 1]
+                thi = down_vector[i + 1]
+
+                if tlo >= thi:
+                    x = tlo + 1
+                else:
+                    x = thi
+
+                y = x - i + diagoff
+                old_x = x
+
+                # Find the end of the furthest reaching forward D-path in
+                # diagonal k
+                if x < a_upper and y < b_upper and \
+                   a_undiscarded[x] == b_undiscarded[y]:
+                    scan_end = x + linear_scan_limit
+
+                    while True:
+                        x += 1
+                        y += 1
+
+                        if x == a_upper or y == b_upper:
+                            break
+                        elif x == scan_end:
+                            matched = count_forward_matches(
+                                x, y, min(a_upper - x, b_upper - y))
+                            x += matched
+                            y += matched
+                            break
+                        elif a_undiscarded[x] != b_undiscarded[y]:
+                            break
+
+                    if x - old_x > snake_limit:
+                        big_snake = True
+
+                if (odd_delta and up_min_i <= i <= up_max_i and
+                        up_vector[i] <= x):
+                    return x, y, True, True
+
+                down_vector[i] = x
+
+            # Extend the reverse path
+            if up_min > dmin:
+                up_min -= 1
+                up_vector[diagoff + up_min - 1] = max_lines
+            else:
+                up_min += 1
+
+            if up_max < dmax:
+                up_max += 1
+                up_vector[diagoff + up_max + 1] = max_lines
+            else:
+                up_max -= 1
+
+            down_min_i = diagoff + down_min
+            down_max_i = diagoff + down_max
+
+            for i in xrange(diagoff + up_max, diagoff + up_min - 1, -2):
+                tlo = up_vector[i - 1]
+                thi = up_vector[i + 1]
+
+                if tlo < thi:
+                    x = tlo
+                else:
+                    x = thi - 1
+
+                y = x - i + diagoff
+                old_x = x
+
+                if x > a_lower and y > b_lower and \
+                   a_undiscarded[x - 1] == b_undiscarded[y - 1]:
+                    scan_end = x - linear_scan_limit
+
+                    while True:
+                        x -= 1
+                        y -= 1
+
+                        if x == a_lower or y == b_lower:
+                            break
+                        elif x == scan_end:
+                            matched = count_backward_matches(
+                                x, y, min(x - a_lower, y - b_lower))
+                            x -= matched
+                            y -= matched
+                            break
+                        elif a_undiscarded[x - 1] != b_undiscarded[y - 1]:
+                            break
+
+                    if old_x - x > snake_limit:
+                        big_snake = True
+
+                if (not odd_delta and down_min_i <= i <= down_max_i and
+                        x <= down_vector[i]):
+                    return x, y, True, True
+
+                up_vector[i] = x
+
+            if find_minimal:
+                continue
+
+            # Heuristics courtesy of GNU diff. See MyersDiffer._find_sms.
+            if cost > 200 and big_snake:
+                ret_x, ret_y, best = self._find_diagonal(
+                    down_min, down_max, down_k, 0,
+                    diagoff, down_vector,
+                    lambda x: x - a_lower,
+                    lambda x: a_lower + snake_limit <= x < a_upper,
+                    lambda y: b_lower + snake_limit <= y < b_upper,
+                    lambda i, k: i - k,
+                    1, cost)
+
+                if best > 0:
+                    return ret_x, ret_y, True, False
+
+                ret_x, ret_y, best = self._find_diagonal(
+                    up_min, up_max, up_k, best, diagoff,
+                    up_vector,
+                    lambda x: a_upper - x,
+                    lambda x: a_lower < x <= a_upper - snake_limit,
+                    lambda y: b_lower < y <= b_upper - snake_limit,
+                    lambda i, k: i + k,
+                    0, cost)
+
+                if best > 0:
+                    return ret_x, ret_y, False, True
+
+    def _lcs(self, a_lower, a_upper, b_lower, b_upper, find_minimal):
+        """The divide-and-conquer implementation of the LCS algorithm.
+
+        The common leading and trailing lines are skipped using block
+        comparisons, and the modified lines are marked without repeated
+        attribute lookups.
+        """
+        matched = self._count_forward_matches(
+            a_lower, b_lower, min(a_upper - a_lower, b_upper - b_lower))
+        a_lower += matched
+        b_lower += matched
+
+        matched = self._count_backward_matches(
+            a_upper, b_upper, min(a_upper - a_lower, b_upper - b_lower))
+        a_upper -= matched
+        b_upper -= matched
+
+        if a_lower == a_upper:
+            # Inserted lines.
+            modified = self.b_data.modified
+            real_indexes = self.b_data.real_indexes
+
+            for i in xrange(b_lower, b_upper):
+                modified[real_indexes[i]] = True
+        elif b_lower == b_upper:
+            # Deleted lines
+            modified = self.a_data.modified
+            real_indexes = self.a_data.real_indexes
+
+            for i in xrange(a_lower, a_upper):
+                modified[real_indexes[i]] = True
+        else:
+            # Find the middle snake and length of an optimal path for A and B
+            x, y, low_minimal, high_minimal = \
+                self._find_sms(a_lower, a_upper, b_lower, b_upper,
+                               find_minimal)
+
+            self._lcs(a_lower, x, b_lower, y, low_minimal)
+            self._lcs(x, a_upper, y, b_upper, high_minimal)
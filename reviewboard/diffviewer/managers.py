@@ -90,6 +90,8 @@ class DiffSetManager(models.Manager):
         The diff_file_contents and parent_diff_file_contents parameters are
         strings with the actual diff contents.
         """
+        from reviewboard.diffviewer.diffutils import \
+            schedule_diff_cache_warming, set_filediff_sort_order
         from reviewboard.diffviewer.models import FileDiff
 
         tool = repository.get_scmtool()
@@ -146,6 +148,8 @@ class DiffSetManager(models.Manager):
         if save:
             diffset.save()
 
+        filediffs = []
+
         for f in files:
             if f.origFile in parent_files:
                 parent_file = parent_files[f.origFile]
@@ -178,15 +182,22 @@ class DiffSetManager(models.Manager):
                                 binary=f.binary,
                                 status=status)
             filediff.set_line_counts(f.insert_count, f.delete_count)
+            filediffs.append(filediff)
+
+        set_filediff_sort_order(filediffs)
 
-            if save:
+        if save:
+            for filediff in filediffs:
                 filediff.save()
 
+            schedule_diff_cache_warming(filediffs)
+
         return diffset
 
     def _process_files(self, parser, basedir, repository, base_commit_id,
                        request, check_existence=False, limit_to=None):
         tool = repository.get_scmtool()
+        files = []
 
         for f in parser.parse():
             f2, revision = tool.parse_diff_revision(f.origFile, f.origInfo,
@@ -202,22 +213,36 @@ class DiffSetManager(models.Manager):
                 # ourselves a remote file existence check and some storage.
                 continue
 
-            # FIXME: this would be a good place to find permissions errors
-            if (revision != PRE_CREATION and
-                revision != UNKNOWN and
-                not f.binary and
-                not f.deleted and
-                not f.moved and
-                (check_existence and
-                 not repository.get_file_exists(filename, revision,
-                                                base_commit_id=base_commit_id,
-                                                request=request))):
-                raise FileNotFoundError(filename, revision, base_commit_id)
-
             f.origFile = filename
             f.origInfo = revision
 
-            yield f
+            files.append(f)
+
+        if check_existence:
+            # The existence of all the files is checked at once, so that
+            # repositories able to do so only need a single round trip.
+            check_files = [
+                f
+                for f in files
+                if (f.origInfo != PRE_CREATION and
+                    f.origInfo != UNKNOWN and
+                    not f.binary and
+                    not f.deleted and
+                    not f.moved)
+            ]
+
+            files_exist = repository.get_files_exist(
+                [(f.origFile, f.origInfo) for f in check_files],
+                base_commit_id=base_commit_id,
+                request=request)
+
+            # FIXME: this would be a good place to find permissions errors
+            for f, exists in zip(check_files, files_exist):
+                if not exists:
+                    raise FileNotFoundError(f.origFile, f.origInfo,
+                                            base_commit_id)
+
+        return files
 
     def _compare_files(self, filename1, filename2):
         """
@@ -1,5 +1,7 @@
 import hashlib
+import json
 import logging
+import zlib
 
 from django.db import models
 from django.utils import timezone
@@ -83,6 +85,10 @@ class FileDiff(models.Model):
     parent_diff_hash = models.ForeignKey('FileDiffData', null=True, blank=True,
                                          related_name='parent_filediff_set')
     status = models.CharField(_("status"), max_length=1, choices=STATUSES)
+    sort_order = models.IntegerField(
+        _('sort order'), null=True, blank=True,
+        help_text=_('The position of this file when displaying its diff '
+                    'set.'))
 
     @property
     def source_file_display(self):
@@ -236,6 +242,115 @@ class FileDiff(models.Model):
                                         self.dest_file, self.dest_detail)
 
 
+class FileDiffOpcodes(models.Model):
+    """
+    The stored opcodes for a diff of a file.
+
+    These are the opcodes generated by the differ and DiffOpcodeGenerator
+    (including whitespace and move information) for a FileDiff, or for an
+    interdiff between two FileDiffs, along with the line numbers of the
+    headers found in the files. They're used to build diff chunks without
+    running the differ again, regardless of the syntax highlighting or
+    language the chunks are rendered with.
+
+    The data is stored as compressed JSON.
+    """
+    filediff = models.ForeignKey(FileDiff, related_name='opcodes_set',
+                                 verbose_name=_('file diff'))
+    interfilediff = models.ForeignKey(FileDiff, null=True, blank=True,
+                                      related_name='interdiff_opcodes_set',
+                                      verbose_name=_('interdiff file diff'))
+    force_interdiff = models.BooleanField(_('force interdiff'), default=False)
+    diffcompat = models.IntegerField(_('differ compatibility version'))
+    ignore_space = models.BooleanField(_('ignore space'), default=True)
+    content_hash = models.CharField(_('content hash'), max_length=40)
+    data = Base64Field(_('data'))
+
+    @staticmethod
+    def make_content_hash(a, b):
+        """Returns a SHA1 hash of the lines the opcodes were generated from.
+
+        This is stored along with the opcodes, so that they're only reused
+        for files with the same content.
+        """
+        hasher = hashlib.sha1()
+        hasher.update('%d:%d\0' % (len(a), len(b)))
+
+        for lines in (a, b):
+            for line in lines:
+                if isinstance(line, unicode):
+                    line = line.encode('utf-8')
+
+                hasher.update(line)
+                hasher.update('\n')
+
+        return hasher.hexdigest()
+
+    def get_opcodes(self):
+        """Returns the stored opcodes and header line numbers.
+
+        The opcodes are returned in the same form as DiffOpcodeGenerator,
+        a list of (tag, i1, i2, j1, j2, meta) tuples. The header line
+        numbers are returned as a list of two lists of 0-based line numbers,
+        one for the original file and one for the modified file.
+        """
+        data = json.loads(zlib.decompress(self.data))
+        opcodes = []
+
+        for (tag, i1, i2, j1, j2, whitespace_chunk, whitespace_lines,
+             moved) in data['opcodes']:
+            meta = {
+                'whitespace_chunk': bool(whitespace_chunk),
+                'whitespace_lines': zip(whitespace_lines[::2],
+                                        whitespace_lines[1::2]),
+            }
+
+            if moved:
+                meta['moved'] = dict(zip(moved[::2], moved[1::2]))
+
+            opcodes.append((str(tag), i1, i2, j1, j2, meta))
+
+        return opcodes, data['headers']
+
+    def set_opcodes(self, opcodes, headers):
+        """Sets the opcodes and header line numbers to store.
+
+        This takes the same forms returned by get_opcodes. Whitespace lines
+        and moved lines are stored as flat lists of numbers to keep the data
+        small.
+        """
+        data = []
+
+        for tag, i1, i2, j1, j2, meta in opcodes:
+            whitespace_lines = []
+            moved = []
+
+            for line_nums in meta['whitespace_lines']:
+                whitespace_lines.extend(line_nums)
+
+            for line_nums in sorted(meta.get('moved', {}).iteritems()):
+                moved.extend(line_nums)
+
+            data.append([tag, i1, i2, j1, j2,
+                         int(meta['whitespace_chunk']), whitespace_lines,
+                         moved])
+
+        self.data = zlib.compress(json.dumps({
+            'opcodes': data,
+            'headers': headers,
+        }, separators=(',', ':')))
+
+    def __unicode__(self):
+        if self.interfilediff_id:
+            return u'Opcodes for interdiff %s-%s' % (self.filediff_id,
+                                                     self.interfilediff_id)
+        else:
+            return u'Opcodes for file diff %s' % self.filediff_id
+
+    class Meta:
+        verbose_name_plural = 'File diff opcodes'
+
+
 class DiffSet(models.Model):
     """
     A revisioned collection of FileDiffs.
@@ -1,5 +1,6 @@
 import logging
 import re
+from array import array
 
 from reviewboard.diffviewer.errors import DiffParserError
 
@@ -11,13 +12,66 @@ class File(object):
         self.origInfo = None
         self.newInfo = None
         self.origChangesetId = None
-        self.data = None
         self.binary = False
         self.deleted = False
         self.moved = False
         self.insert_count = 0
         self.delete_count = 0
 
+        self._data = None
+        self._data_parts = []
+        self._data_parser = None
+        self._data_start = None
+        self._data_end = None
+
+    def _get_data(self):
+        self._flush_data_lines()
+
+        if self._data_parts:
+            self._data = (self._data or '') + ''.join(self._data_parts)
+            self._data_parts = []
+
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._data_parts = []
+        self._data_parser = None
+
+    data = property(_get_data, _set_data)
+
+    def append_data(self, data):
+        """Appends a string to the file's diff content.
+
+        Appended strings are joined together the next time the data is
+        accessed, which avoids copying the content on every append.
+        """
+        self._flush_data_lines()
+        self._data_parts.append(data)
+
+    def append_lines(self, parser, start, end):
+        """Appends a range of lines from a parser's diff to the diff content.
+
+        Consecutive ranges of lines are merged, so that they can be taken
+        from the diff in one go the next time the data is accessed.
+        """
+        if self._data_end == start and self._data_parser is parser:
+            self._data_end = end
+        else:
+            self._flush_data_lines()
+            self._data_parser = parser
+            self._data_start = start
+            self._data_end = end
+
+    def _flush_data_lines(self):
+        if self._data_parser is not None:
+            self._data_parts.append(
+                self._data_parser.get_lines_data(self._data_start,
+                                                 self._data_end))
+            self._data_parser = None
+            self._data_start = None
+            self._data_end = None
+
 
 class DiffParser(object):
     """
@@ -30,6 +84,18 @@ class DiffParser(object):
     def __init__(self, data):
         self.data = data
         self.lines = data.splitlines()
+        self._line_offsets = None
+
+        if isinstance(data, str) and '\r' not in data:
+            # The lines were all split on '\n', so we can find where each
+            # one starts in the diff, and take the content for a range of
+            # lines straight from the diff.
+            self._line_offsets = array('l', [0])
+            offset = 0
+
+            for line in self.lines:
+                offset += len(line) + 1
+                self._line_offsets.append(offset)
 
     def parse(self):
         """
@@ -39,7 +105,6 @@ class DiffParser(object):
         logging.debug("DiffParser.parse: Beginning parse of diff, size = %s",
                       len(self.data))
 
-        preamble = ''
         self.files = []
         file = None
         i = 0
@@ -51,21 +116,41 @@ class DiffParser(object):
             if new_file:
                 # This line is the start of a new file diff.
                 file = new_file
-                file.data = preamble + file.data
-                preamble = ''
+
+                if not self.files and i > 0:
+                    # Anything before the first file's header is part of
+                    # that file's diff.
+                    file.data = self.get_lines_data(0, i) + file.data
+
                 self.files.append(file)
                 i = next_linenum
+            elif file:
+                i = self.parse_diff_line(i, file)
             else:
-                if file:
-                    i = self.parse_diff_line(i, file)
-                else:
-                    preamble += self.lines[i] + '\n'
-                    i += 1
+                i += 1
 
         logging.debug("DiffParser.parse: Finished parsing diff.")
 
         return self.files
 
+    def get_lines_data(self, start, end):
+        """Returns the content of a range of lines in the diff.
+
+        Each line in the result ends with a newline, regardless of the
+        line endings used in the diff.
+        """
+        if start >= end:
+            return ''
+        elif self._line_offsets is None:
+            return '\n'.join(self.lines[start:end]) + '\n'
+
+        data = self.data[self._line_offsets[start]:self._line_offsets[end]]
+
+        if end == len(self.lines) and not self.data.endswith('\n'):
+            data += '\n'
+
+        return data
+
     def parse_diff_line(self, linenum, info):
         line = self.lines[linenum]
 
@@ -75,7 +160,7 @@ class DiffParser(object):
             elif line.startswith('+'):
                 info.insert_count += 1
 
-        info.data += line + '\n'
+        info.append_lines(self, linenum, linenum + 1)
 
         return linenum + 1
 
@@ -115,9 +200,7 @@ class DiffParser(object):
 
             # The header is part of the diff, so make sure it gets in the
             # diff content.
-            file.data = ''.join([
-                self.lines[i] + '\n' for i in xrange(start, linenum)
-            ])
+            file.data = self.get_lines_data(start, linenum)
 
         return linenum, file
 
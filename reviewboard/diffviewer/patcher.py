@@ -0,0 +1,401 @@
+"""An in-process applier for unified diffs.
+
+This applies unified diffs to in-memory buffers, without writing anything
+to disk or spawning the external `patch` tool. It follows the hunk location
+rules used by GNU patch, so that hunks are matched with the same offsets and
+fuzz factors that `patch` would use.
+
+Anything this module doesn't understand (context diffs, binary diffs,
+reversed patches, etc.) results in a PatchError, which callers can use to
+fall back on GNU patch.
+"""
+import re
+
+from reviewboard.diffviewer.errors import PatchError
+
+
+HUNK_HEADER_RE = re.compile(
+    r'^@@ -(?P<old_start>\d+)(,(?P<old_len>\d+))? '
+    r'\+(?P<new_start>\d+)(,(?P<new_len>\d+))? @@')
+
+#: The maximum fuzz factor used when locating hunks. This matches the
+#: default used by GNU patch.
+MAX_FUZZ = 2
+
+
+class Hunk(object):
+    """A single hunk from a unified diff.
+
+    The hunk's lines are stored as a list of (type, line) tuples, where type
+    is one of ' ', '-' or '+', and line includes the trailing newline, if
+    any.
+    """
+    def __init__(self, old_start, old_len, new_start, new_len):
+        self.old_start = old_start
+        self.old_len = old_len
+        self.new_start = new_start
+        self.new_len = new_len
+        self.lines = []
+
+    @property
+    def pattern(self):
+        """Returns the lines expected to be found in the original file."""
+        return [line for line_type, line in self.lines if line_type != '+']
+
+    @property
+    def replacement(self):
+        """Returns the lines that the pattern will be replaced with."""
+        return [line for line_type, line in self.lines if line_type != '-']
+
+    @property
+    def prefix_context(self):
+        """Returns the number of context lines leading the hunk."""
+        count = 0
+
+        for line_type, line in self.lines:
+            if line_type != ' ':
+                break
+
+            count += 1
+
+        return count
+
+    @property
+    def suffix_context(self):
+        """Returns the number of context lines trailing the hunk."""
+        count = 0
+
+        for line_type, line in reversed(self.lines):
+            if line_type != ' ':
+                break
+
+            count += 1
+
+        return count
+
+    @property
+    def first_line(self):
+        """Returns the 1-based line where the hunk is expected to apply.
+
+        Like GNU patch, hunks that don't remove or keep any lines are
+        considered to apply after the specified line, rather than on it.
+        """
+        if self.old_len == 0:
+            return self.old_start + 1
+
+        return self.old_start
+
+    def reverse(self):
+        """Returns a copy of the hunk with the changes reversed."""
+        hunk = Hunk(self.new_start, self.new_len,
+                    self.old_start, self.old_len)
+        hunk.lines = [
+            ({'-': '+', '+': '-'}.get(line_type, line_type), line)
+            for line_type, line in self.lines
+        ]
+
+        return hunk
+
+
+def split_lines(data):
+    """Splits a buffer into lines, keeping the newline characters.
+
+    Unlike str.splitlines, this only ever splits on '\\n'. The last line
+    won't have a newline if the buffer doesn't end with one.
+    """
+    lines = data.split('\n')
+
+    if lines[-1] == '':
+        del lines[-1]
+        return [line + '\n' for line in lines]
+    else:
+        last = lines.pop()
+        result = [line + '\n' for line in lines]
+        result.append(last)
+
+        return result
+
+
+def parse_hunks(diff):
+    """Parses the hunks out of a single-file unified diff.
+
+    Any headers before the first hunk are skipped. A PatchError is raised if
+    the diff contains no hunks, if a hunk is truncated, or if the diff
+    appears to contain more than one file.
+    """
+    lines = split_lines(diff)
+    num_lines = len(lines)
+    hunks = []
+    i = 0
+
+    while i < num_lines:
+        line = lines[i]
+        m = HUNK_HEADER_RE.match(line)
+
+        if not m:
+            if (hunks and line.startswith('--- ') and i + 1 < num_lines and
+                    lines[i + 1].startswith('+++ ')):
+                raise PatchError('The diff contains more than one file')
+
+            i += 1
+            continue
+
+        hunk = Hunk(int(m.group('old_start')),
+                    int(m.group('old_len') or 1),
+                    int(m.group('new_start')),
+                    int(m.group('new_len') or 1))
+        old_remaining = hunk.old_len
+        new_remaining = hunk.new_len
+        i += 1
+
+        while old_remaining > 0 or new_remaining > 0:
+            if i >= num_lines:
+                raise PatchError('Hunk at line %d is truncated' %
+                                 hunk.old_start)
+
+            line = lines[i]
+
+            if line in ('\n', ''):
+                # Some tools strip the trailing whitespace from blank
+                # context lines. GNU patch accepts these, so we do as well.
+                line_type = ' '
+                line = '\n'
+            else:
+                line_type = line[0]
+                line = line[1:]
+
+            if line_type == ' ':
+                old_remaining -= 1
+                new_remaining -= 1
+            elif line_type == '-':
+                old_remaining -= 1
+            elif line_type == '+':
+                new_remaining -= 1
+            elif line_type == '\\':
+                _strip_last_newline(hunk)
+                i += 1
+                continue
+            else:
+                raise PatchError('Unexpected line in hunk at line %d: %r' %
+                                 (hunk.old_start, lines[i]))
+
+            if old_remaining < 0 or new_remaining < 0:
+                raise PatchError('Hunk at line %d has too many lines' %
+                                 hunk.old_start)
+
+            hunk.lines.append((line_type, line))
+            i += 1
+
+        # A "\ No newline at end of file" marker may follow the last line
+        # of the hunk.
+        while i < num_lines and lines[i].startswith('\\'):
+            _strip_last_newline(hunk)
+            i += 1
+
+        hunks.append(hunk)
+
+    if not hunks:
+        raise PatchError('The diff does not contain any unified diff hunks')
+
+    return hunks
+
+
+def apply_unified_diff(diff, data):
+    """Applies a single-file unified diff to a buffer.
+
+    The patched buffer is returned. Both the diff and the buffer are
+    expected to use '\\n' line endings.
+
+    A PatchError is raised if the diff can't be parsed, if any hunk fails
+    to apply, or if the diff looks like it's already been applied (which
+    GNU patch would prompt about).
+    """
+    hunks = parse_hunks(diff)
+    lines = split_lines(data)
+    result = []
+
+    # The number of lines from the input that have been written to the
+    # result, and the offset that the previous hunk was applied at.
+    last_frozen_line = 0
+    offset = 0
+
+    for hunk_num, hunk in enumerate(hunks):
+        where = None
+        max_fuzz = min(MAX_FUZZ,
+                       max(hunk.prefix_context, hunk.suffix_context))
+
+        for fuzz in xrange(max_fuzz + 1):
+            where, offset = _locate_hunk(hunk, hunk.pattern, lines, fuzz,
+                                         offset, last_frozen_line)
+
+            if where is not None:
+                break
+            elif (hunk_num == 0 and
+                  _locate_hunk(hunk.reverse(), hunk.replacement, lines, fuzz,
+                               offset, last_frozen_line)[0] is not None):
+                # GNU patch checks whether the first hunk applies in
+                # reverse, and asks the user what to do about it. We leave
+                # that decision up to the caller.
+                raise PatchError('Reversed (or previously applied) patch '
+                                 'detected')
+
+        if where is None:
+            raise PatchError('Hunk #%d failed to apply at line %d' %
+                             (hunk_num + 1, hunk.old_start))
+
+        # Apply the hunk the way GNU patch does. Lines from the input are
+        # only copied to the result when we reach a removed or inserted
+        # line, so context lines are taken from the input rather than the
+        # hunk (preserving the input's content in the case of fuzz), and
+        # the hunk's trailing context isn't frozen until the next hunk.
+        pos = where
+
+        for line_type, line in hunk.lines:
+            if line_type == ' ':
+                pos += 1
+            elif line_type == '-':
+                last_frozen_line = _copy_till(lines, result, last_frozen_line,
+                                              pos)
+                last_frozen_line += 1
+                pos += 1
+            else:
+                last_frozen_line = _copy_till(lines, result, last_frozen_line,
+                                              pos)
+                result.append(line)
+
+    result.extend(lines[last_frozen_line:])
+
+    # Lines missing a trailing newline (the last line of the input, or a
+    # line from a hunk) need one if they don't end up at the end of the
+    # file. GNU patch adds it as well.
+    for i in xrange(len(result) - 1):
+        if not result[i].endswith('\n'):
+            result[i] += '\n'
+
+    return ''.join(result)
+
+
+def _strip_last_newline(hunk):
+    """Strips the newline from the last line in a hunk."""
+    if hunk.lines:
+        line_type, line = hunk.lines[-1]
+
+        if line.endswith('\n'):
+            hunk.lines[-1] = (line_type, line[:-1])
+
+
+def _copy_till(lines, result, last_frozen_line, end):
+    """Copies lines from the input up to the given line.
+
+    This returns the new number of lines from the input that have been
+    written to the result.
+    """
+    if last_frozen_line < end:
+        result.extend(lines[last_frozen_line:end])
+        last_frozen_line = end
+
+    return last_frozen_line
+
+
+def _match(pattern, lines, where, prefix_fuzz, suffix_fuzz):
+    """Returns whether a pattern matches the input at a position.
+
+    The first prefix_fuzz and last suffix_fuzz lines of the pattern are
+    ignored.
+    """
+    end = len(pattern) - suffix_fuzz
+
+    if where < 0 or where + end > len(lines):
+        return False
+
+    for i in xrange(prefix_fuzz, end):
+        if pattern[i] != lines[where + i]:
+            return False
+
+    return True
+
+
+def _locate_hunk(hunk, pattern, lines, fuzz, offset, last_frozen_line):
+    """Locates where a hunk applies in the input.
+
+    This is based on locate_hunk() from GNU patch. The expected location is
+    based on the hunk's starting line and the offset at which the previous
+    hunk applied. From there, we search forward and then backward, one line
+    at a time, for a match.
+
+    Hunks with less leading context than trailing context (or vice versa)
+    can only apply at the start (or end) of the file, unless fuzz is used.
+
+    This returns a tuple of the 0-based line where the hunk applies (or
+    None) and the new offset.
+    """
+    input_lines = len(lines)
+    pat_lines = len(pattern)
+    prefix_context = hunk.prefix_context
+    suffix_context = hunk.suffix_context
+    context = max(prefix_context, suffix_context)
+    prefix_fuzz = fuzz + prefix_context - context
+    suffix_fuzz = fuzz + suffix_context - context
+
+    # These are all 1-based, in order to match GNU patch.
+    #
+    # Unlike GNU patch, we never let a hunk's leading context overlap lines
+    # already written by a previous hunk. GNU patch's results in that case
+    # are hard to predict, so we'd rather fail and let the caller fall back
+    # on it.
+    first_guess = hunk.first_line + offset
+    max_where = input_lines - (pat_lines - suffix_fuzz) + 1
+    min_where = last_frozen_line + 1
+    max_pos_offset = max_where - first_guess
+    max_neg_offset = first_guess - min_where
+
+    # Don't let hunks straddle the beginning of the file.
+    if max_neg_offset >= first_guess:
+        max_neg_offset = first_guess - 1
+
+    if prefix_fuzz < 0 and hunk.first_line <= 1:
+        # This can only match the start of the file.
+        if (suffix_fuzz < 0 and
+                (pat_lines != input_lines or last_frozen_line > 0)):
+            # This can only match the entire file, and doesn't.
+            return None, offset
+
+        delta = 1 - first_guess
+
+        if (last_frozen_line == 0 and
+                delta <= max_pos_offset and
+                _match(pattern, lines, first_guess + delta - 1, 0,
+                       max(suffix_fuzz, 0))):
+            return first_guess + delta - 1, offset + delta
+
+        return None, offset
+    elif prefix_fuzz < 0:
+        prefix_fuzz = 0
+
+    if suffix_fuzz < 0:
+        # This can only match the end of the file.
+        delta = first_guess - (input_lines - pat_lines + 1)
+
+        if (delta <= max_neg_offset and
+                _match(pattern, lines, first_guess - delta - 1,
+                       prefix_fuzz, 0)):
+            return first_guess - delta - 1, offset - delta
+
+        return None, offset
+
+    delta = 0
+
+    while delta <= max_pos_offset or delta <= max_neg_offset:
+        if (delta <= max_pos_offset and
+                _match(pattern, lines, first_guess + delta - 1,
+                       prefix_fuzz, suffix_fuzz)):
+            return first_guess + delta - 1, offset + delta
+
+        if (0 < delta <= max_neg_offset and
+                _match(pattern, lines, first_guess - delta - 1,
+                       prefix_fuzz, suffix_fuzz)):
+            return first_guess - delta - 1, offset - delta
+
+        delta += 1
+
+    return None, offset
@@ -1,24 +1,41 @@
 import os
+import random
+import threading
 import unittest
 
+from django.core.cache import cache
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.paginator import Paginator
 from django.http import HttpResponse
+from django.test.client import RequestFactory
 from djblets.siteconfig.models import SiteConfiguration
-from djblets.util.misc import cache_memoize
+from djblets.util.misc import cache_memoize, make_cache_key
 from kgb import SpyAgency
 
+import reviewboard.diffviewer.chunk_generator as chunk_generator
 import reviewboard.diffviewer.diffutils as diffutils
 import reviewboard.diffviewer.parser as diffparser
-from reviewboard.diffviewer.chunk_generator import DiffChunkGenerator
-from reviewboard.diffviewer.errors import UserVisibleError
+from reviewboard.admin.siteconfig import defaults as siteconfig_defaults
+from reviewboard.diffviewer.chunk_generator import (
+    DiffChunkGenerator, get_diff_chunk_generator_class,
+    set_diff_chunk_generator_class)
+from reviewboard.diffviewer.differ import (DEFAULT_DIFF_COMPAT_VERSION,
+                                           get_differ,
+                                           get_myers_differ_class,
+                                           set_myers_differ_class)
+from reviewboard.diffviewer.errors import PatchError, UserVisibleError
+from reviewboard.diffviewer.fastmyersdiff import FastMyersDiffer
 from reviewboard.diffviewer.forms import UploadDiffForm
-from reviewboard.diffviewer.models import DiffSet, FileDiff
+from reviewboard.diffviewer.models import DiffSet, FileDiff, FileDiffOpcodes
 from reviewboard.diffviewer.myersdiff import MyersDiffer
 from reviewboard.diffviewer.opcode_generator import get_diff_opcode_generator
+from reviewboard.diffviewer.patcher import apply_unified_diff
 from reviewboard.diffviewer.renderers import DiffRenderer
 from reviewboard.diffviewer.processors import (filter_interdiff_opcodes,
                                                merge_adjacent_chunks)
+from reviewboard.diffviewer.smdiff import SMDiffer
 from reviewboard.diffviewer.templatetags.difftags import highlightregion
+from reviewboard.diffviewer.views import DiffViewerView
 from reviewboard.scmtools.models import Repository, Tool
 from reviewboard.testing import TestCase
 
@@ -51,6 +68,83 @@ class MyersDifferTest(TestCase):
         self.assertEquals(opcodes, expected)
 
 
+class FastMyersDifferTests(TestCase):
+    """Unit tests for FastMyersDiffer."""
+    PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
+
+    def test_get_differ(self):
+        """Testing get_differ with FastMyersDiffer as the default"""
+        self.assertEqual(get_myers_differ_class(), FastMyersDiffer)
+        self.assertTrue(isinstance(get_differ([], []), FastMyersDiffer))
+        self.assertTrue(isinstance(get_differ([], [], compat_version=0),
+                                   SMDiffer))
+
+    def test_set_myers_differ_class(self):
+        """Testing get_differ after set_myers_differ_class"""
+        old_differ_class = get_myers_differ_class()
+        set_myers_differ_class(MyersDiffer)
+
+        try:
+            differ = get_differ([], [])
+        finally:
+            set_myers_differ_class(old_differ_class)
+
+        self.assertEqual(type(differ), MyersDiffer)
+
+    def test_opcodes_match_testdata(self):
+        """Testing FastMyersDiffer opcodes match MyersDiffer for the
+        testdata files
+        """
+        files = []
+
+        for dirname in ('orig_src', 'new_src'):
+            for filename in sorted(os.listdir(os.path.join(self.PREFIX,
+                                                           dirname))):
+                f = open(os.path.join(self.PREFIX, dirname, filename), 'r')
+                files.append((filename, f.readlines()))
+                f.close()
+
+        for filename, a in files:
+            for unused, b in files:
+                self._check_opcodes(filename, a, b)
+
+    def test_opcodes_match_generated_files(self):
+        """Testing FastMyersDiffer opcodes match MyersDiffer for large
+        generated files
+        """
+        rand = random.Random(42)
+        words = ['\n', '}\n', '    return 0;\n'] + [
+            'int x%d = %d;\n' % (i, i)
+            for i in range(300)
+        ]
+
+        a = [rand.choice(words) for i in range(1000)]
+        b = list(a)
+
+        for i in range(20):
+            pos = rand.randint(0, len(b))
+            b[pos:pos + rand.randint(0, 40)] = [
+                rand.choice(words)
+                for j in range(rand.randint(0, 40))
+            ]
+
+        self._check_opcodes('generated.c', a, b)
+        self._check_opcodes('generated.c', b, a)
+
+    def _check_opcodes(self, filename, a, b):
+        for ignore_space in (False, True):
+            reference = MyersDiffer(a, b, ignore_space)
+            reference.add_interesting_lines_for_headers(filename)
+
+            differ = get_differ(a, b, ignore_space)
+            differ.add_interesting_lines_for_headers(filename)
+
+            self.assertEqual(list(differ.get_opcodes()),
+                             list(reference.get_opcodes()))
+            self.assertEqual(differ.interesting_lines,
+                             reference.interesting_lines)
+
+
 class InterestingLinesTest(TestCase):
     PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
 
@@ -341,6 +435,230 @@ class DiffParserTest(unittest.TestCase):
         self.assertEqual(files[0].insert_count, 3)
         self.assertEqual(files[0].delete_count, 4)
 
+    def test_file_data(self):
+        """Testing DiffParser with file data for multiple files"""
+        diff1 = (
+            '--- README\t123\n'
+            '+++ README\t(new)\n'
+            '@@ -1,1 +1,1 @@\n'
+            '-blah\n'
+            '+blah!\n')
+        diff2 = (
+            '--- foo.c\t456\n'
+            '+++ foo.c\t(new)\n'
+            '@@ -1,2 +1,1 @@\n'
+            ' int i;\n'
+            '-int j;\n')
+        files = diffparser.DiffParser('Preamble\n' + diff1 + diff2).parse()
+
+        self.assertEqual(len(files), 2)
+        self.assertEqual(files[0].data, 'Preamble\n' + diff1)
+        self.assertEqual(files[1].data, diff2)
+
+    def test_file_data_with_crlf(self):
+        """Testing DiffParser with file data for a diff with CRLF newlines"""
+        diff = (
+            '--- README\t123\n'
+            '+++ README\t(new)\n'
+            '@@ -1,1 +1,1 @@\n'
+            '-blah\n'
+            '+blah!')
+        files = diffparser.DiffParser(diff.replace('\n', '\r\n')).parse()
+
+        self.assertEqual(len(files), 1)
+        self.assertEqual(files[0].data, diff + '\n')
+
+    def test_file_append_data(self):
+        """Testing File.append_data and File.append_lines"""
+        parser = diffparser.DiffParser('line 1\nline 2\nline 3\nline 4')
+        file = diffparser.File()
+        self.assertEqual(file.data, None)
+
+        file.append_lines(parser, 0, 1)
+        file.append_lines(parser, 1, 2)
+        file.append_data('extra\n')
+        file.append_lines(parser, 3, 4)
+        self.assertEqual(file.data, 'line 1\nline 2\nextra\nline 4\n')
+
+        file.data = 'replaced\n'
+        file.append_lines(parser, 2, 3)
+        self.assertEqual(file.data, 'replaced\nline 3\n')
+
+    def _get_file(self, *relative):
+        f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
+        data = f.read()
+        f.close()
+        return data
+
+
+class PatcherTests(SpyAgency, TestCase):
+    """Unit tests for the built-in patch engine."""
+    PREFIX = os.path.join(os.path.dirname(__file__), 'testdata')
+
+    ORIG = ''.join('line %d\n' % i for i in xrange(1, 21))
+
+    def test_apply(self):
+        """Testing apply_unified_diff"""
+        diff = (
+            '--- README\n'
+            '+++ README\n'
+            '@@ -4,7 +4,7 @@\n'
+            ' line 4\n'
+            ' line 5\n'
+            ' line 6\n'
+            '-line 7\n'
+            '+line seven\n'
+            ' line 8\n'
+            ' line 9\n'
+            ' line 10\n')
+
+        self.assertEqual(apply_unified_diff(diff, self.ORIG),
+                         self.ORIG.replace('line 7\n', 'line seven\n'))
+
+    def test_apply_with_offset(self):
+        """Testing apply_unified_diff with an offset hunk"""
+        diff = (
+            '@@ -1,3 +1,3 @@\n'
+            ' line 10\n'
+            '-line 11\n'
+            '+line eleven\n'
+            ' line 12\n')
+
+        self.assertEqual(apply_unified_diff(diff, self.ORIG),
+                         self.ORIG.replace('line 11\n', 'line eleven\n'))
+
+    def test_apply_with_fuzz(self):
+        """Testing apply_unified_diff with a hunk requiring fuzz"""
+        diff = (
+            '@@ -4,7 +4,7 @@\n'
+            ' line 4\n'
+            ' line 5\n'
+            ' line 6\n'
+            '-line 7\n'
+            '+line seven\n'
+            ' line 8\n'
+            ' line 9\n'
+            ' line 10\n')
+        orig = self.ORIG.replace('line 4\n', 'line four\n')
+
+        # The context line that didn't match must come from the original
+        # file, not the diff.
+        self.assertEqual(apply_unified_diff(diff, orig),
+                         orig.replace('line 7\n', 'line seven\n'))
+
+    def test_apply_with_no_newline(self):
+        """Testing apply_unified_diff with a missing newline at EOF"""
+        diff = (
+            '@@ -19,2 +19,2 @@\n'
+            ' line 19\n'
+            '-line 20\n'
+            '+line 20\n'
+            '\\ No newline at end of file\n')
+
+        self.assertEqual(apply_unified_diff(diff, self.ORIG),
+                         self.ORIG[:-1])
+
+    def test_apply_after_no_newline(self):
+        """Testing apply_unified_diff inserting after a missing newline"""
+        diff = (
+            '@@ -20,0 +21 @@\n'
+            '+line 21\n')
+
+        self.assertEqual(apply_unified_diff(diff, self.ORIG[:-1]),
+                         self.ORIG + 'line 21\n')
+
+    def test_apply_with_bad_hunk(self):
+        """Testing apply_unified_diff with a hunk that doesn't apply"""
+        diff = (
+            '@@ -4,3 +4,3 @@\n'
+            ' line 4\n'
+            '-line 5\n'
+            '+line five\n'
+            ' line 6\n')
+
+        self.assertRaises(PatchError,
+                          lambda: apply_unified_diff(diff, 'foo\nbar\n'))
+
+    def test_apply_with_reversed_patch(self):
+        """Testing apply_unified_diff with an already applied patch"""
+        diff = (
+            '@@ -6,3 +6,3 @@\n'
+            ' line 6\n'
+            '-line seven\n'
+            '+line 7\n'
+            ' line 8\n')
+
+        self.assertRaises(PatchError,
+                          lambda: apply_unified_diff(diff, self.ORIG))
+
+    def test_apply_with_context_diff(self):
+        """Testing apply_unified_diff with a context diff"""
+        diff = self._get_file('diffs', 'context', 'foo.c.diff')
+
+        self.assertRaises(PatchError,
+                          lambda: apply_unified_diff(diff, self.ORIG))
+
+    def test_apply_matches_patch(self):
+        """Testing apply_unified_diff results match GNU patch"""
+        diffs_dir = os.path.join(self.PREFIX, 'diffs', 'unified')
+
+        for diff_name in os.listdir(diffs_dir):
+            filename = diff_name[:-len('.diff')]
+
+            if not os.path.exists(os.path.join(self.PREFIX, 'orig_src',
+                                               filename)):
+                continue
+
+            diff = diffutils.convert_line_endings(
+                self._get_file('diffs', 'unified', diff_name))
+            orig = diffutils.convert_line_endings(
+                self._get_file('orig_src', filename))
+
+            self.assertEqual(
+                apply_unified_diff(diff, orig),
+                diffutils._patch_with_subprocess(diff, orig, filename))
+
+    def test_patch_with_builtin_engine(self):
+        """Testing diffutils.patch with the built-in engine"""
+        self.spy_on(diffutils._patch_with_subprocess)
+
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        diff = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+        self.assertEqual(diffutils.patch(diff, old, 'foo.c'), new)
+        self.assertFalse(diffutils._patch_with_subprocess.spy.called)
+
+    def test_patch_with_builtin_engine_fallback(self):
+        """Testing diffutils.patch falling back on GNU patch"""
+        self.spy_on(diffutils._patch_with_subprocess)
+
+        old = self._get_file('orig_src', 'foo.c')
+        new = self._get_file('new_src', 'foo.c')
+        diff = self._get_file('diffs', 'context', 'foo.c.diff')
+
+        self.assertEqual(diffutils.patch(diff, old, 'foo.c'), new)
+        self.assertTrue(diffutils._patch_with_subprocess.spy.called)
+
+    def test_patch_with_patch_engine(self):
+        """Testing diffutils.patch with the GNU patch engine"""
+        siteconfig = SiteConfiguration.objects.get_current()
+        siteconfig.set('diffviewer_patch_engine', 'patch')
+        siteconfig.save()
+
+        self.spy_on(diffutils._patch_with_subprocess)
+
+        try:
+            old = self._get_file('orig_src', 'foo.c')
+            new = self._get_file('new_src', 'foo.c')
+            diff = self._get_file('diffs', 'unified', 'foo.c.diff')
+
+            self.assertEqual(diffutils.patch(diff, old, 'foo.c'), new)
+            self.assertTrue(diffutils._patch_with_subprocess.spy.called)
+        finally:
+            siteconfig.set('diffviewer_patch_engine', 'builtin')
+            siteconfig.save()
+
     def _get_file(self, *relative):
         f = open(os.path.join(*tuple([self.PREFIX] + list(relative))))
         data = f.read()
@@ -348,6 +666,99 @@ class DiffParserTest(unittest.TestCase):
         return data
 
 
+class FileBufferCacheTests(SpyAgency, TestCase):
+    """Unit tests for caching original and patched files."""
+    fixtures = ['test_scmtools']
+
+    ORIG = 'line 1\r\nline 2\r\nline 3\r\n'
+
+    DIFF = (
+        '--- README\n'
+        '+++ README\n'
+        '@@ -1,3 +1,3 @@\n'
+        ' line 1\n'
+        '-line 2\n'
+        '+line two\n'
+        ' line 3\n')
+
+    def setUp(self):
+        super(FileBufferCacheTests, self).setUp()
+
+        self.repository = self.create_repository(tool_name='Test')
+        self.spy_on(self.repository.get_file,
+                    call_fake=lambda *args, **kwargs: self.ORIG)
+
+    def test_eviction(self):
+        """Testing FileBufferCache evicts least recently used buffers"""
+        buffer_cache = diffutils.FileBufferCache(10)
+        buffer_cache.set('a', 'aaaa')
+        buffer_cache.set('b', 'bbbb')
+        self.assertEqual(buffer_cache.get('a'), 'aaaa')
+
+        buffer_cache.set('c', 'cccc')
+        self.assertEqual(buffer_cache.get('a'), 'aaaa')
+        self.assertEqual(buffer_cache.get('b'), None)
+        self.assertEqual(buffer_cache.get('c'), 'cccc')
+        self.assertEqual(buffer_cache.size, 8)
+
+        buffer_cache.set('d', 'd' * 11)
+        self.assertEqual(buffer_cache.get('d'), None)
+        self.assertEqual(buffer_cache.size, 8)
+
+    def test_get_original_file_cached(self):
+        """Testing get_original_file caches the normalized file"""
+        filediff = self._create_filediff()
+
+        self.assertEqual(diffutils.get_original_file(filediff),
+                         'line 1\nline 2\nline 3\n')
+        self.assertEqual(diffutils.get_original_file(filediff),
+                         'line 1\nline 2\nline 3\n')
+        self.assertEqual(len(self.repository.get_file.spy.calls), 1)
+
+        # The main cache should be used when the buffer isn't in memory.
+        diffutils._file_buffer_cache.clear()
+        self.assertEqual(diffutils.get_original_file(filediff),
+                         'line 1\nline 2\nline 3\n')
+        self.assertEqual(len(self.repository.get_file.spy.calls), 1)
+
+    def test_get_original_file_with_parent_diff(self):
+        """Testing get_original_file caching with different parent diffs"""
+        filediff = self._create_filediff()
+        parent_filediff = self._create_filediff()
+        parent_filediff.parent_diff = self.DIFF
+        parent_filediff.save()
+
+        self.assertEqual(diffutils.get_original_file(filediff),
+                         'line 1\nline 2\nline 3\n')
+        self.assertEqual(diffutils.get_original_file(parent_filediff),
+                         'line 1\nline two\nline 3\n')
+
+    def test_get_patched_file_shared(self):
+        """Testing get_patched_file shares results between FileDiffs"""
+        self.spy_on(diffutils.patch)
+
+        filediff1 = self._create_filediff()
+        filediff2 = self._create_filediff()
+
+        for filediff in (filediff1, filediff2):
+            orig = diffutils.get_original_file(filediff)
+            self.assertEqual(diffutils.get_patched_file(orig, filediff),
+                             'line 1\nline two\nline 3\n')
+
+        self.assertEqual(len(diffutils.patch.spy.calls), 1)
+        self.assertEqual(len(self.repository.get_file.spy.calls), 1)
+
+    def _create_filediff(self):
+        diffset = self.create_diffset(repository=self.repository)
+        filediff = self.create_filediff(diffset, source_file='README',
+                                        dest_file='README', diff=self.DIFF)
+
+        # Make sure the spied-on repository is the one that gets used.
+        filediff.diffset.repository = self.repository
+
+        return filediff
+
+
 class FileDiffMigrationTests(TestCase):
     fixtures = ['test_scmtools']
 
@@ -585,8 +996,10 @@ class DiffSetManagerTests(SpyAgency, TestCase):
 
         repository = self.create_repository(tool_name='Test')
 
-        self.spy_on(repository.get_file_exists,
-                    call_fake=lambda *args, **kwargs: True)
+        self.spy_on(
+            repository.get_files_exist,
+            call_fake=lambda repository, files, *args, **kwargs:
+                [True] * len(files))
 
         diffset = DiffSet.objects.create_from_data(
             repository, 'diff', diff, None, None, None, '/', None)
@@ -615,8 +1028,10 @@ class UploadDiffFormTests(SpyAgency, TestCase):
 
         repository = self.create_repository(tool_name='Test')
 
-        self.spy_on(repository.get_file_exists,
-                    call_fake=lambda *args, **kwargs: True)
+        self.spy_on(
+            repository.get_files_exist,
+            call_fake=lambda repository, files, *args, **kwargs:
+                [True] * len(files))
 
         form = UploadDiffForm(
             repository=repository,
@@ -638,9 +1053,12 @@ class UploadDiffFormTests(SpyAgency, TestCase):
         """Testing UploadDiffForm and filtering parent diff files"""
         saw_file_exists = {}
 
-        def get_file_exists(repository, filename, revision, *args, **kwargs):
-            saw_file_exists[(filename, revision)] = True
-            return True
+        def get_files_exist(repository, paths_and_revisions, *args,
+                            **kwargs):
+            for path_and_revision in paths_and_revisions:
+                saw_file_exists[path_and_revision] = True
+
+            return [True] * len(paths_and_revisions)
 
         diff = (
             'diff --git a/README b/README\n'
@@ -677,7 +1095,7 @@ class UploadDiffFormTests(SpyAgency, TestCase):
                                               content_type='text/x-patch')
 
         repository = self.create_repository(tool_name='Test')
-        self.spy_on(repository.get_file_exists, call_fake=get_file_exists)
+        self.spy_on(repository.get_files_exist, call_fake=get_files_exist)
 
         form = UploadDiffForm(
             repository=repository,
@@ -849,8 +1267,10 @@ class ProcessorsTests(TestCase):
         ])
 
 
-class DiffChunkGeneratorTests(TestCase):
+class DiffChunkGeneratorTests(SpyAgency, TestCase):
     """Unit tests for DiffChunkGenerator."""
+    fixtures = ['test_scmtools']
+
     def test_get_line_changed_regions(self):
         """Testing DiffChunkGenerator._get_line_changed_regions"""
         def deep_equal(A, B):
@@ -876,14 +1296,674 @@ class DiffChunkGeneratorTests(TestCase):
         old = '-from reviews.models import ReviewRequest, Person, Group'
         new = '+from .reviews.models import ReviewRequest, Group'
         regions = generator._get_line_changed_regions(old, new)
-        deep_equal(regions, ([(0, 1), (6, 6), (43, 51)],
-                             [(0, 1), (6, 7), (44, 44)]))
+        deep_equal(regions, ([(0, 1), (6, 6), (41, 49)],
+                             [(0, 1), (6, 7), (42, 42)]))
 
         old = 'abcdefghijklm'
         new = 'nopqrstuvwxyz'
         regions = generator._get_line_changed_regions(old, new)
         deep_equal(regions, (None, None))
 
+    def test_get_line_changed_regions_with_insertion(self):
+        """Testing get_line_changed_regions with an insertion"""
+        regions = chunk_generator.get_line_changed_regions(
+            'def foo(self):', 'def foo(self, bar):')
+        self.assertEqual(regions, ([(12, 12)], [(12, 17)]))
+
+    def test_get_line_changed_regions_with_max_work(self):
+        """Testing get_line_changed_regions with lines exceeding
+        MAX_LINE_REGIONS_WORK
+        """
+        old = 'value = compute(first, second) + 1'
+        new = 'value = compute(second, first) + 1'
+        self.assertEqual(chunk_generator.get_line_changed_regions(old, new),
+                         ([(16, 23), (29, 29)], [(16, 16), (22, 29)]))
+
+        max_work = chunk_generator.MAX_LINE_REGIONS_WORK
+        chunk_generator.MAX_LINE_REGIONS_WORK = 10
+        chunk_generator._line_changed_regions_cache.clear()
+
+        try:
+            regions = chunk_generator.get_line_changed_regions(old, new)
+        finally:
+            chunk_generator.MAX_LINE_REGIONS_WORK = max_work
+
+        self.assertEqual(regions, ([(16, 29)], [(16, 29)]))
+
+    def test_get_line_changed_regions_cached(self):
+        """Testing get_line_changed_regions caches results"""
+        self.spy_on(chunk_generator._compute_line_changed_regions)
+        chunk_generator._line_changed_regions_cache.clear()
+
+        old = 'submitter = models.ForeignKey(Person, verbose_name="Submitter")'
+        new = 'submitter = models.ForeignKey(User, verbose_name="Submitter")'
+        regions1 = chunk_generator.get_line_changed_regions(old, new)
+        regions2 = chunk_generator.get_line_changed_regions(old, new)
+
+        self.assertEqual(regions1, ([(30, 36)], [(30, 34)]))
+        self.assertEqual(regions1, regions2)
+        self.assertFalse(regions1[0] is regions2[0])
+        self.assertEqual(
+            len(chunk_generator._compute_line_changed_regions.spy.calls), 1)
+
+    def test_get_lexer_for_filename_cached(self):
+        """Testing get_lexer_for_filename_cached"""
+        self.spy_on(chunk_generator.get_lexer_for_filename)
+        chunk_generator._lexer_cache.clear()
+
+        lexer = chunk_generator.get_lexer_for_filename_cached('/src/foo.py')
+        self.assertEqual(lexer.name, 'Python')
+        self.assertTrue(
+            chunk_generator.get_lexer_for_filename_cached('/lib/foo.py') is
+            lexer)
+        self.assertEqual(
+            chunk_generator.get_lexer_for_filename_cached('foo.unknown-ext'),
+            None)
+        self.assertEqual(
+            chunk_generator.get_lexer_for_filename_cached('foo.unknown-ext'),
+            None)
+        self.assertEqual(len(chunk_generator.get_lexer_for_filename.spy.calls),
+                         2)
+
+    def test_apply_pygments_cached(self):
+        """Testing DiffChunkGenerator._apply_pygments caches by contents"""
+        self.spy_on(chunk_generator.highlight)
+
+        filediff = FileDiff(source_file='foo.py', diffset=DiffSet())
+        generator = DiffChunkGenerator(None, filediff)
+        data = 'def foo():\n    pass\n'
+
+        markup = generator._apply_pygments(data, 'foo.py')
+        self.assertEqual(len(markup), 2)
+        self.assertEqual(generator._apply_pygments(data, 'bar/baz.py'),
+                         markup)
+        self.assertEqual(len(chunk_generator.highlight.spy.calls), 1)
+
+        generator._apply_pygments(data + 'foo()\n', 'foo.py')
+        self.assertEqual(len(chunk_generator.highlight.spy.calls), 2)
+
+    def test_apply_pygments_without_lexer(self):
+        """Testing DiffChunkGenerator._apply_pygments without a lexer"""
+        filediff = FileDiff(source_file='foo', diffset=DiffSet())
+        generator = DiffChunkGenerator(None, filediff)
+
+        self.assertEqual(generator._apply_pygments('abc\n', 'foo.unknown-ext'),
+                         None)
+
+    def test_get_chunks_with_stored_opcodes(self):
+        """Testing DiffChunkGenerator builds chunks from stored opcodes"""
+        orig = (
+            'class Foo(object):\n'
+            '    def moved_function(self):\n'
+            '        return compute_something()\n'
+            '\n'
+            '    def bar(self):\n'
+            '        pass\n'
+        )
+        diff = (
+            '--- foo.py\n'
+            '+++ foo.py\n'
+            '@@ -1,6 +1,6 @@\n'
+            ' class Foo(object):\n'
+            '-    def moved_function(self):\n'
+            '-        return compute_something()\n'
+            '-\n'
+            '     def bar(self):\n'
+            '-        pass\n'
+            '+          pass\n'
+            '+\n'
+            '+    def moved_function(self):\n'
+            '+        return compute_something()\n'
+        )
+
+        repository = self.create_repository(tool_name='Test')
+        self.spy_on(repository.get_file,
+                    call_fake=lambda *args, **kwargs: orig)
+        self.spy_on(chunk_generator.get_differ)
+
+        diffset = self.create_diffset(repository=repository)
+        diffset.diffcompat = DEFAULT_DIFF_COMPAT_VERSION
+        diffset.save()
+        filediff = self.create_filediff(diffset, source_file='foo.py',
+                                        dest_file='foo.py', diff=diff)
+        filediff.diffset = diffset
+
+        chunks = DiffChunkGenerator(None, filediff).get_chunks()
+        self.assertEqual(len(chunk_generator.get_differ.spy.calls), 1)
+        self.assertEqual(
+            FileDiffOpcodes.objects.filter(filediff=filediff).count(), 1)
+
+        generator = DiffChunkGenerator(None, filediff,
+                                       enable_syntax_highlighting=False)
+        unhighlighted_chunks = generator.get_chunks()
+        self.assertEqual(len(chunk_generator.get_differ.spy.calls), 1)
+        self.assertEqual(len(chunks), len(unhighlighted_chunks))
+
+        for chunk, unhighlighted_chunk in zip(chunks, unhighlighted_chunks):
+            self.assertEqual(chunk['change'], unhighlighted_chunk['change'])
+            self.assertEqual(chunk['meta'], unhighlighted_chunk['meta'])
+            self.assertEqual(
+                [line[:2] + line[3:5] + line[6:] for line in chunk['lines']],
+                [line[:2] + line[3:5] + line[6:]
+                 for line in unhighlighted_chunk['lines']])
+
+        self.assertTrue(any('moved' in chunk['meta'] for chunk in chunks))
+
+    def test_file_diff_opcodes(self):
+        """Testing FileDiffOpcodes.set_opcodes and get_opcodes"""
+        opcodes = [
+            ('equal', 0, 2, 0, 2, {
+                'whitespace_chunk': False,
+                'whitespace_lines': [],
+            }),
+            ('replace', 2, 4, 2, 4, {
+                'whitespace_chunk': True,
+                'whitespace_lines': [(3, 3), (4, 4)],
+            }),
+            ('delete', 4, 6, 4, 4, {
+                'whitespace_chunk': False,
+                'whitespace_lines': [],
+                'moved': {5: 9, 6: 10},
+            }),
+            ('insert', 6, 6, 4, 6, {
+                'whitespace_chunk': False,
+                'whitespace_lines': [],
+                'moved': {9: 5, 10: 6},
+            }),
+        ]
+
+        stored = FileDiffOpcodes()
+        stored.set_opcodes(opcodes, [[0, 4], [1]])
+        self.assertEqual(stored.get_opcodes(), (opcodes, [[0, 4], [1]]))
+
+    def test_file_diff_opcodes_content_hash(self):
+        """Testing FileDiffOpcodes.make_content_hash"""
+        content_hash = FileDiffOpcodes.make_content_hash(['a', 'b'], ['c'])
+
+        self.assertEqual(len(content_hash), 40)
+        self.assertEqual(
+            FileDiffOpcodes.make_content_hash(['a', 'b'], ['c']),
+            content_hash)
+        self.assertNotEqual(
+            FileDiffOpcodes.make_content_hash(['a', 'x'], ['c']),
+            content_hash)
+        self.assertNotEqual(
+            FileDiffOpcodes.make_content_hash(['a'], ['b', 'c']),
+            content_hash)
+
+
+class GetDiffFilesTests(TestCase):
+    """Unit tests for diffutils.get_diff_files and related functions."""
+    fixtures = ['test_scmtools']
+
+    def setUp(self):
+        super(GetDiffFilesTests, self).setUp()
+
+        repository = self.create_repository(tool_name='Test')
+        self.diffset = self.create_diffset(repository=repository)
+
+        for filename in ('z.txt', 'a/b.c', 'foo.c', 'foo.h'):
+            self.create_filediff(self.diffset, source_file=filename,
+                                 dest_file=filename)
+
+    def test_sort_order(self):
+        """Testing get_diff_files sorts files for display"""
+        files = diffutils.get_diff_files(self.diffset)
+
+        self.assertEqual([f['depot_filename'] for f in files],
+                         ['foo.h', 'foo.c', 'z.txt', 'a/b.c'])
+        self.assertEqual([f['index'] for f in files], [0, 1, 2, 3])
+        self.assertEqual(
+            list(self.diffset.files.order_by('sort_order')
+                 .values_list('source_file', flat=True)),
+            ['foo.h', 'foo.c', 'z.txt', 'a/b.c'])
+
+    def test_with_parts(self):
+        """Testing get_diff_files with a page of parts"""
+        parts = diffutils.get_diff_file_parts(self.diffset)
+        self.assertTrue(isinstance(parts, diffutils.FileDiffPartList))
+        self.assertEqual(len(parts), 4)
+
+        page = Paginator(parts, 2).page(2)
+        files = diffutils.get_diff_files(self.diffset,
+                                         parts=page.object_list)
+
+        self.assertEqual([f['depot_filename'] for f in files],
+                         ['z.txt', 'a/b.c'])
+
+    def test_get_diff_file_part_index(self):
+        """Testing get_diff_file_part_index"""
+        parts = diffutils.get_diff_file_parts(self.diffset)
+        filediff = self.diffset.files.get(source_file='z.txt')
+
+        self.assertEqual(
+            diffutils.get_diff_file_part_index(parts, filediff.pk), 2)
+        self.assertEqual(
+            diffutils.get_diff_file_part_index(list(parts), filediff.pk), 2)
+        self.assertEqual(diffutils.get_diff_file_part_index(parts, -1),
+                         None)
+
+    def test_prefetch_filediff_data(self):
+        """Testing prefetch_filediff_data"""
+        filediffs = list(self._create_diffset_with_diffs(3).files.all())
+
+        with self.assertNumQueries(1):
+            diffutils.prefetch_filediff_data(filediffs)
+
+        with self.assertNumQueries(0):
+            for filediff in filediffs:
+                self.assertTrue(filediff.diff.startswith('--- '))
+                self.assertEqual(filediff.insert_count, 1)
+                self.assertEqual(filediff.parent_diff, None)
+
+    def test_interdiff_without_loading_diffs(self):
+        """Testing get_diff_files with an interdiff compares diff hashes"""
+        diffset = self._create_diffset_with_diffs(3)
+        interdiffset = self._create_diffset_with_diffs(3)
+        interfilediff = interdiffset.files.get(source_file='file1.c')
+        interfilediff.diff = interfilediff.diff + '+another line\n'
+        interfilediff.save()
+
+        # Loading the FileDiffs from each DiffSet should be enough to find
+        # the files that changed, without loading any diffs.
+        with self.assertNumQueries(2):
+            parts = diffutils.get_diff_file_parts(diffset,
+                                                  interdiffset=interdiffset)
+
+        files = diffutils.get_diff_files(diffset, interdiffset=interdiffset,
+                                         parts=parts)
+
+        self.assertEqual([f['depot_filename'] for f in files], ['file1.c'])
+        self.assertEqual(files[0]['interfilediff'], interfilediff)
+
+    def test_diff_viewer_query_count(self):
+        """Testing DiffViewerView uses a constant number of queries per
+        page
+        """
+        # Set up the view the way as_view() and get() would.
+        view = DiffViewerView()
+        view.request = RequestFactory().get('/')
+        view.args = ()
+        view.kwargs = {}
+        view.collapse_diffs = True
+
+        # Load the site configuration, which only happens once.
+        SiteConfiguration.objects.get_current()
+
+        # The number of queries shouldn't depend on the number of files.
+        for num_files in (5, 15):
+            diffset = self._create_diffset_with_diffs(num_files)
+
+            # Set the stored sort order, which only happens once.
+            diffutils.get_sorted_filediffs(diffset)
+
+            # This should take one query each to check the sort order,
+            # count the files, fetch the files for the page, and fetch
+            # their diffs.
+            with self.assertNumQueries(4):
+                context = view.get_context_data(diffset, None)
+
+                for f in context['files']:
+                    f['filediff'].diff
+                    f['filediff'].insert_count
+                    f['filediff'].delete_count
+
+            self.assertEqual(len(context['files']), num_files)
+
+    def _create_diffset_with_diffs(self, num_files):
+        diffset = self.create_diffset(repository=self.diffset.repository)
+
+        for i in xrange(num_files):
+            filename = 'file%d.c' % i
+            filediff = self.create_filediff(
+                diffset, source_file=filename, dest_file=filename,
+                diff=('--- %s\n'
+                      '+++ %s\n'
+                      '@@ -1,1 +1,1 @@\n'
+                      '-old line %d\n'
+                      '+new line %d\n'
+                      % (filename, filename, i, i)))
+            filediff.set_line_counts(1, 1)
+
+        return diffset
+
+
+class UnpicklableError(Exception):
+    """An error that can't be rebuilt from its args after being pickled."""
+    def __init__(self, filename, reason):
+        super(UnpicklableError, self).__init__('%s: %s' % (filename, reason))
+
+
+class PopulateDiffChunksTests(SpyAgency, TestCase):
+    """Unit tests for diffutils.populate_diff_chunks."""
+    fixtures = ['test_scmtools']
+
+    def setUp(self):
+        super(PopulateDiffChunksTests, self).setUp()
+
+        self.generated_threads = []
+        generated_threads = self.generated_threads
+
+        class TestDiffChunkGenerator(DiffChunkGenerator):
+            def make_cache_key(self):
+                return 'test-chunks-%s' % self.filediff.source_file
+
+            def has_chunks(self):
+                return True
+
+            def get_chunks_uncached(self):
+                generated_threads.append(threading.current_thread())
+
+                return [{
+                    'change': 'insert',
+                    'lines': [],
+                    'meta': {},
+                    'filename': self.filediff.source_file,
+                }]
+
+        self.old_generator_class = get_diff_chunk_generator_class()
+        set_diff_chunk_generator_class(TestDiffChunkGenerator)
+
+        self.siteconfig = SiteConfiguration.objects.get_current()
+        self.siteconfig.set('diffviewer_chunk_executor', 'thread')
+        self.siteconfig.set('diffviewer_chunk_executor_max_workers', 2)
+        self.siteconfig.save()
+
+    def tearDown(self):
+        super(PopulateDiffChunksTests, self).tearDown()
+
+        set_diff_chunk_generator_class(self.old_generator_class)
+
+        self.siteconfig.set('diffviewer_chunk_executor', '')
+        self.siteconfig.save()
+
+    def test_with_thread_executor(self):
+        """Testing populate_diff_chunks with a thread pool"""
+        files = self._make_files(['a.c', 'b.c', 'c.c'])
+        diffutils.populate_diff_chunks(files)
+
+        self.assertEqual(len(self.generated_threads), 3)
+        self.assertFalse(threading.current_thread() in
+                         self.generated_threads)
+        self.assertEqual(
+            [diff_file['chunks'][0]['filename'] for diff_file in files],
+            ['a.c', 'b.c', 'c.c'])
+
+        for diff_file in files:
+            self.assertTrue(diff_file['chunks_loaded'])
+            self.assertEqual(diff_file['num_changes'], 1)
+
+        # A second pass should pull everything from the cache.
+        files = self._make_files(['a.c', 'b.c', 'c.c'])
+        diffutils.populate_diff_chunks(files)
+
+        self.assertEqual(len(self.generated_threads), 3)
+        self.assertEqual(
+            [diff_file['chunks'][0]['filename'] for diff_file in files],
+            ['a.c', 'b.c', 'c.c'])
+
+    def test_with_thread_executor_and_single_file(self):
+        """Testing populate_diff_chunks with a thread pool and one file"""
+        files = self._make_files(['a.c'])
+        diffutils.populate_diff_chunks(files)
+
+        self.assertEqual(self.generated_threads,
+                         [threading.current_thread()])
+
+    def test_with_process_executor(self):
+        """Testing populate_diff_chunks with a process pool"""
+        self.siteconfig.set('diffviewer_chunk_executor', 'process')
+        self.siteconfig.save()
+        self.addCleanup(self._close_chunk_pool, 'process', 2)
+
+        files = self._make_files(['a.c', 'b.c', 'c.c'])
+        diffutils.populate_diff_chunks(files)
+
+        # The chunks were generated in the worker processes, so this
+        # process never recorded generating them.
+        self.assertEqual(self.generated_threads, [])
+        self.assertEqual(
+            [diff_file['chunks'][0]['filename'] for diff_file in files],
+            ['a.c', 'b.c', 'c.c'])
+
+        for diff_file in files:
+            self.assertTrue(diff_file['chunks_loaded'])
+            self.assertEqual(diff_file['num_changes'], 1)
+
+    def test_with_process_executor_and_error(self):
+        """Testing populate_diff_chunks with a process pool and a worker error"""
+        class FailingDiffChunkGenerator(get_diff_chunk_generator_class()):
+            def get_chunks_uncached(self):
+                if self.filediff.source_file == 'b.c':
+                    raise UnpicklableError('b.c', 'failed')
+
+                return super(FailingDiffChunkGenerator,
+                             self).get_chunks_uncached()
+
+        set_diff_chunk_generator_class(FailingDiffChunkGenerator)
+        self.siteconfig.set('diffviewer_chunk_executor', 'process')
+        self.siteconfig.save()
+        self.addCleanup(self._close_chunk_pool, 'process', 2)
+
+        files = self._make_files(['a.c', 'b.c', 'c.c'])
+
+        # The worker's error is raised again when b.c's chunks are
+        # generated in this process.
+        self.assertRaises(UnpicklableError,
+                          diffutils.populate_diff_chunks, files)
+        self.assertEqual(self.generated_threads, [])
+
+    def test_with_process_executor_and_new_generator_class(self):
+        """Testing populate_diff_chunks with a process pool after changing the chunk generator class"""
+        self.siteconfig.set('diffviewer_chunk_executor', 'process')
+        self.siteconfig.save()
+        self.addCleanup(self._close_chunk_pool, 'process', 2)
+
+        pool = diffutils._get_chunk_pool('process', 2)
+        self.assertTrue(diffutils._get_chunk_pool('process', 2) is pool)
+
+        class NewDiffChunkGenerator(get_diff_chunk_generator_class()):
+            def get_chunks_uncached(self):
+                return [{
+                    'change': 'delete',
+                    'lines': [],
+                    'meta': {},
+                    'filename': self.filediff.source_file,
+                }]
+
+        set_diff_chunk_generator_class(NewDiffChunkGenerator)
+        self.assertFalse(diffutils._get_chunk_pool('process', 2) is pool)
+
+        files = self._make_files(['a.c', 'b.c'])
+        diffutils.populate_diff_chunks(files)
+
+        self.assertEqual(
+            [diff_file['chunks'][0]['change'] for diff_file in files],
+            ['delete', 'delete'])
+
+    def test_prefetches_original_files(self):
+        """Testing populate_diff_chunks fetches the original files at once"""
+        def get_files(repository, paths_and_revisions, *args, **kwargs):
+            fetched.append(list(paths_and_revisions))
+            return [''] * len(paths_and_revisions)
+
+        fetched = []
+
+        repository = self.create_repository(tool_name='Test')
+        self.spy_on(repository.get_files, call_fake=get_files)
+
+        diffset = self.create_diffset(repository=repository)
+        files = []
+
+        for filename in ('a.c', 'b.c'):
+            filediff = self.create_filediff(diffset, source_file=filename,
+                                            dest_file=filename)
+
+            # Make sure the spied-on repository is the one that gets used.
+            filediff.diffset.repository = repository
+
+            files.append({
+                'filediff': filediff,
+                'interfilediff': None,
+                'force_interdiff': False,
+            })
+
+        diffutils.populate_diff_chunks(files)
+
+        self.assertEqual(fetched, [[('a.c', '123'), ('b.c', '123')]])
+
+    def _close_chunk_pool(self, executor, max_workers):
+        pool, generator_cls = diffutils._chunk_pools.pop(
+            (executor, max_workers), (None, None))
+
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def _make_files(self, filenames):
+        return [
+            {
+                'filediff': FileDiff(source_file=filename,
+                                     diffset=DiffSet()),
+                'interfilediff': None,
+                'force_interdiff': False,
+            }
+            for filename in filenames
+        ]
+
+
+class DiffCacheWarmingTests(SpyAgency, TestCase):
+    """Unit tests for warming the caches for uploaded diffs."""
+    fixtures = ['test_scmtools']
+
+    def setUp(self):
+        super(DiffCacheWarmingTests, self).setUp()
+
+        self.generated = []
+        generated = self.generated
+
+        class TestDiffChunkGenerator(DiffChunkGenerator):
+            def make_cache_key(self):
+                return 'test-warm-chunks-%s' % self.filediff.pk
+
+            def has_chunks(self):
+                return True
+
+            def get_chunks_uncached(self):
+                generated.append(self.filediff.source_file)
+
+                return [{
+                    'change': 'insert',
+                    'lines': [],
+                    'meta': {},
+                }]
+
+        self.old_generator_class = get_diff_chunk_generator_class()
+        set_diff_chunk_generator_class(TestDiffChunkGenerator)
+
+        # The site configuration's defaults aren't loaded in unit tests.
+        self.siteconfig = SiteConfiguration.objects.get_current()
+        self.siteconfig.add_defaults(dict([
+            (key, siteconfig_defaults[key])
+            for key in ('diffviewer_warm_caches_max_workers',
+                        'diffviewer_warm_caches_max_workers_per_repository')
+        ]))
+        self.siteconfig.set('diffviewer_warm_caches_on_upload', True)
+        self.siteconfig.save()
+
+        self.spy_on(diffutils.prefetch_original_files,
+                    call_fake=lambda filediffs, request=None: None)
+
+        repository = self.create_repository(tool_name='Test')
+        diffset = self.create_diffset(repository=repository)
+        self.filediffs = [
+            self.create_filediff(diffset, source_file=filename,
+                                 dest_file=filename)
+            for filename in ('a.c', 'b.c')
+        ]
+
+    def tearDown(self):
+        super(DiffCacheWarmingTests, self).tearDown()
+
+        set_diff_chunk_generator_class(self.old_generator_class)
+
+        self.siteconfig.set('diffviewer_warm_caches_on_upload', False)
+        self.siteconfig.save()
+
+    def test_schedule(self):
+        """Testing schedule_diff_cache_warming hands FileDiffs to a pool"""
+        class FakePool(object):
+            def apply_async(self, key, func, args):
+                scheduled.append((key, func, args[0]))
+
+        def _get_warm_caches_pool(max_workers, max_repository_workers):
+            return FakePool()
+
+        scheduled = []
+        self.spy_on(diffutils._get_warm_caches_pool,
+                    call_fake=_get_warm_caches_pool)
+
+        diffutils.schedule_diff_cache_warming(self.filediffs)
+
+        self.assertTrue(
+            diffutils._get_warm_caches_pool.spy.last_called_with(4, 2))
+        self.assertEqual(scheduled, [
+            (self.filediffs[0].diffset.repository_id,
+             diffutils._warm_diff_caches_in_thread,
+             [filediff.pk for filediff in self.filediffs]),
+        ])
+        self.assertEqual(
+            diffutils.get_diff_cache_warming_stats()['scheduled'], 2)
+
+        self.siteconfig.set('diffviewer_warm_caches_on_upload', False)
+        self.siteconfig.save()
+        diffutils.schedule_diff_cache_warming(self.filediffs)
+
+        self.assertEqual(len(scheduled), 1)
+
+    def test_warm_first_views(self):
+        """Testing populate_diff_chunks with warmed caches"""
+        diffutils.warm_diff_caches(self.filediffs)
+
+        self.assertEqual(self.generated, ['a.c', 'b.c'])
+        self.assertTrue(diffutils.prefetch_original_files.spy.called)
+
+        diffutils.populate_diff_chunks(self._make_files())
+        diffutils.populate_diff_chunks(self._make_files())
+
+        self.assertEqual(self.generated, ['a.c', 'b.c'])
+        self.assertEqual(diffutils.get_diff_cache_warming_stats(), {
+            'scheduled': 0,
+            'warmed': 2,
+            'failed': 0,
+            'warm_first_views': 2,
+            'cold_first_views': 0,
+        })
+
+    def test_cold_first_views(self):
+        """Testing populate_diff_chunks with evicted warmed caches"""
+        diffutils.warm_diff_caches(self.filediffs)
+        cache.delete(make_cache_key('test-warm-chunks-%s'
+                                    % self.filediffs[1].pk))
+
+        diffutils.populate_diff_chunks(self._make_files())
+
+        self.assertEqual(self.generated, ['a.c', 'b.c', 'b.c'])
+
+        stats = diffutils.get_diff_cache_warming_stats()
+        self.assertEqual(stats['warm_first_views'], 1)
+        self.assertEqual(stats['cold_first_views'], 1)
+
+    def _make_files(self):
+        return [
+            {
+                'filediff': filediff,
+                'interfilediff': None,
+                'force_interdiff': False,
+            }
+            for filediff in self.filediffs
+        ]
+
 
 class DiffRendererTests(SpyAgency, TestCase):
     """Unit tests for DiffRenderer."""
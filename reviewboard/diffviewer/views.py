@@ -11,6 +11,8 @@ from django.views.generic.base import TemplateView, View
 from djblets.siteconfig.models import SiteConfiguration
 
 from reviewboard.diffviewer.diffutils import (get_diff_files,
+                                              get_diff_file_part_index,
+                                              get_diff_file_parts,
                                               populate_diff_chunks,
                                               get_enable_highlighting)
 from reviewboard.diffviewer.errors import UserVisibleError
@@ -125,13 +127,15 @@ class DiffViewerView(TemplateView):
         side-by-side diff, handling pagination, and more. The data is
         collected into a context dictionary and returned for rendering.
         """
-        files = get_diff_files(diffset, None, interdiffset,
-                               request=self.request)
+        # Only the files on the current page are loaded and have their
+        # information generated, so the cost of building a page doesn't
+        # depend on the number of files in the diffset.
+        parts = get_diff_file_parts(diffset, None, interdiffset)
 
         # Break the list of files into pages
         siteconfig = SiteConfiguration.objects.get_current()
 
-        paginator = Paginator(files,
+        paginator = Paginator(parts,
                               siteconfig.get('diffviewer_paginate_by'),
                               siteconfig.get('diffviewer_paginate_orphans'))
 
@@ -139,17 +143,18 @@ class DiffViewerView(TemplateView):
 
         if self.request.GET.get('file', False):
             file_id = int(self.request.GET['file'])
+            i = get_diff_file_part_index(parts, file_id)
 
-            for i, f in enumerate(files):
-                if f['filediff'].pk == file_id:
-                    page_num = i // paginator.per_page + 1
+            if i is not None:
+                page_num = i // paginator.per_page + 1
 
-                    if page_num > paginator.num_pages:
-                        page_num = paginator.num_pages
-
-                    break
+                if page_num > paginator.num_pages:
+                    page_num = paginator.num_pages
 
         page = paginator.page(page_num)
+        files = get_diff_files(diffset, None, interdiffset,
+                               request=self.request,
+                               parts=page.object_list)
 
         diff_context = {
             'revision': {
@@ -180,7 +185,7 @@ class DiffViewerView(TemplateView):
             'diffset': diffset,
             'interdiffset': interdiffset,
             'diffset_pair': (diffset, interdiffset),
-            'files': page.object_list,
+            'files': files,
             'collapseall': self.collapse_diffs,
         }, **extra_context)
 
@@ -102,16 +102,22 @@ class Beanstalk(HostingService):
         """Determines if a file exists.
 
         This will perform an API request to fetch the metadata for a file.
+        Without a base commit ID, the contents of the file must be fetched
+        instead, and are cached for later calls to get_file.
 
         If using Git, this will expect a base commit ID to be provided.
         """
         try:
-            self._api_get_node(repository, path, revision, base_commit_id)
-
-            return True
+            data = self._api_get_node(repository, path, revision,
+                                      base_commit_id)
         except (HTTPError, URLError, FileNotFoundError):
             return False
 
+        if not base_commit_id:
+            repository.cache_file(path, revision, data, base_commit_id)
+
+        return True
+
     def _api_get_repository(self, account_domain, repository_name):
         url = self._build_api_url(account_domain,
                                   'repositories/%s.json' % repository_name)
@@ -153,17 +153,21 @@ class Bitbucket(HostingService):
                         *args, **kwargs):
         """Determines if a file exists.
 
-        This will perform an API request to fetch the metadata for a file.
+        This will perform an API request to fetch the contents of the file,
+        which are then cached for later calls to get_file.
 
         If using Git, this will expect a base commit ID to be provided.
         """
         try:
-            self._api_get_src(repository, path, revision, base_commit_id)
-
-            return True
+            data = self._api_get_src(repository, path, revision,
+                                     base_commit_id)
         except (URLError, HTTPError, FileNotFoundError):
             return False
 
+        repository.cache_file(path, revision, data, base_commit_id)
+
+        return True
+
     def _api_get_repository(self, username, repo_name):
         url = self._build_api_url('repositories/%s/%s'
                                   % (username, repo_name))
@@ -12,3 +12,12 @@ class InvalidPlanError(KeyError):
 
 class SSHKeyAssociationError(Exception):
     pass
+
+
+class RateLimitExceededError(Exception):
+    """Indicates a request was refused to save an account's rate limit.
+
+    This is raised for background requests once the account's remaining
+    rate limit is down to what's reserved for interactive requests.
+    """
+    pass
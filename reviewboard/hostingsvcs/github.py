@@ -14,6 +14,8 @@ from reviewboard.hostingsvcs.errors import (AuthorizationError,
                                             InvalidPlanError,
                                             SSHKeyAssociationError)
 from reviewboard.hostingsvcs.forms import HostingServiceForm
+from reviewboard.hostingsvcs.ratelimit import (get_remaining_requests,
+                                               record_rate_limit)
 from reviewboard.hostingsvcs.service import HostingService
 from reviewboard.scmtools.core import Branch, Commit
 from reviewboard.scmtools.errors import FileNotFoundError
@@ -162,6 +164,10 @@ class GitHub(HostingService):
 
     RAW_MIMETYPE = 'application/vnd.github.v3.raw'
 
+    # Once the number of API requests remaining for an account drops to
+    # this, cached responses are used where possible.
+    RATE_LIMIT_LOW_WATERMARK = 100
+
     def get_api_url(self, hosting_url):
         """Returns the API URL for GitHub.
 
@@ -246,10 +252,12 @@ class GitHub(HostingService):
             raise FileNotFoundError(path, revision)
 
     def get_file_exists(self, repository, path, revision, *args, **kwargs):
+        # The blob is looked up with a HEAD request, so that it's only
+        # downloaded if and when get_file needs it.
         url = self._build_api_url(repository, 'git/blobs/%s' % revision)
 
         try:
-            self._http_get(url, headers={
+            self._http_head(url, headers={
                 'Accept': self.RAW_MIMETYPE,
             })
 
@@ -480,10 +488,28 @@ class GitHub(HostingService):
         return msg
 
     def _http_get(self, url, *args, **kwargs):
-        data, headers = super(GitHub, self)._http_get(url, *args, **kwargs)
+        try:
+            data, headers = super(GitHub, self)._http_get(url, *args,
+                                                          **kwargs)
+        except urllib2.HTTPError, e:
+            # Error responses, and 304 Not Modified responses to
+            # conditional requests, report the rate limits too.
+            self._check_rate_limits(e.hdrs or {})
+            raise
+
         self._check_rate_limits(headers)
         return data, headers
 
+    def _http_head(self, url, *args, **kwargs):
+        try:
+            headers = super(GitHub, self)._http_head(url, *args, **kwargs)
+        except urllib2.HTTPError, e:
+            self._check_rate_limits(e.hdrs or {})
+            raise
+
+        self._check_rate_limits(headers)
+        return headers
+
     def _http_post(self, url, *args, **kwargs):
         data, headers = super(GitHub, self)._http_post(url, *args, **kwargs)
         self._check_rate_limits(headers)
@@ -492,13 +518,35 @@ class GitHub(HostingService):
     def _check_rate_limits(self, headers):
         rate_limit_remaining = headers.get('X-RateLimit-Remaining', None)
 
+        if rate_limit_remaining is None:
+            return
+
         try:
-            if (rate_limit_remaining is not None and
-                int(rate_limit_remaining) <= 100):
-                logging.warning('GitHub rate limit for %s is down to %s',
-                                self.account.username, rate_limit_remaining)
+            rate_limit_remaining = int(rate_limit_remaining)
         except ValueError:
-            pass
+            return
+
+        if rate_limit_remaining <= self.RATE_LIMIT_LOW_WATERMARK:
+            logging.warning('GitHub rate limit for %s is down to %s',
+                            self.account.username, rate_limit_remaining)
+
+        try:
+            limit = int(headers.get('X-RateLimit-Limit'))
+        except (TypeError, ValueError):
+            limit = None
+
+        try:
+            reset = int(headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            reset = None
+
+        record_rate_limit(self.account, rate_limit_remaining, limit, reset)
+
+    def _is_rate_limited(self):
+        rate_limit_remaining = get_remaining_requests(self.account)
+
+        return (rate_limit_remaining is not None and
+                rate_limit_remaining <= self.RATE_LIMIT_LOW_WATERMARK)
 
     def _build_api_url(self, repository, api_path):
         return '%s%s?access_token=%s' % (
@@ -523,7 +571,7 @@ class GitHub(HostingService):
 
     def _api_get(self, url):
         try:
-            data, headers = self._http_get(url)
+            data, headers = self._http_get_conditional(url)
             return json.loads(data)
         except (urllib2.URLError, urllib2.HTTPError), e:
             data = e.read()
@@ -0,0 +1,215 @@
+"""Scheduling of requests against hosting service rate limits.
+
+Hosting services such as GitHub limit the number of API requests an
+account can make in a period of time, and report how many are remaining
+in each response. Services record those numbers here, and they're shared
+between processes through the cache.
+
+Every request made through a HostingService is checked against its
+account's rate limit first. Requests are interactive by default. Work that
+nobody is waiting on, such as warming caches, should be run within
+request_priority(PRIORITY_BACKGROUND). Background requests are refused
+with a RateLimitExceededError once the account is down to the share of its
+rate limit reserved for interactive requests, so that people viewing diffs
+aren't the ones left without any.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.utils.http import urlquote
+from djblets.util.misc import make_cache_key
+
+from reviewboard.hostingsvcs.errors import RateLimitExceededError
+
+
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BACKGROUND = 'background'
+
+# The share of an account's rate limit reserved for interactive requests.
+BACKGROUND_RESERVE_FRACTION = 0.2
+
+# The number of requests reserved for interactive requests, if the service
+# doesn't report the account's total rate limit.
+BACKGROUND_RESERVE_DEFAULT = 100
+
+# The length of a rate limit period, in seconds. This is used if the service
+# doesn't report when the rate limit resets.
+RATE_LIMIT_PERIOD = 60 * 60  # 1 hour
+
+
+_state = threading.local()
+
+
+@contextmanager
+def request_priority(priority):
+    """Sets the priority of hosting service requests made in a block.
+
+    This applies to requests made from the current thread.
+    """
+    old_priority = get_request_priority()
+    _state.priority = priority
+
+    try:
+        yield
+    finally:
+        _state.priority = old_priority
+
+
+def get_request_priority():
+    """Returns the priority of requests made from the current thread."""
+    return getattr(_state, 'priority', PRIORITY_INTERACTIVE)
+
+
+def record_rate_limit(account, remaining, limit=None, reset=None):
+    """Records the rate limit reported by a hosting service.
+
+    ``remaining`` is the number of requests the account has left, ``limit``
+    the total number allowed in each period, and ``reset`` the time (in
+    seconds since the epoch) that the period ends. The numbers are kept
+    until then.
+    """
+    now = time.time()
+
+    if reset is None or reset <= now:
+        reset = now + RATE_LIMIT_PERIOD
+
+    expiration = max(int(reset - now), 1)
+
+    cache.set(_make_cache_key(account, 'remaining'), remaining, expiration)
+    cache.set(_make_cache_key(account, 'info'), {
+        'limit': limit,
+        'reset': reset,
+    }, expiration)
+
+
+def get_remaining_requests(account):
+    """Returns the number of requests an account has left.
+
+    This is an estimate, based on the last number reported by the hosting
+    service minus the requests made since. If nothing has been reported,
+    this returns None.
+    """
+    return cache.get(_make_cache_key(account, 'remaining'))
+
+
+def get_rate_limits(accounts):
+    """Returns the state of the rate limits for a list of accounts.
+
+    This returns a list of dictionaries for the accounts with a known rate
+    limit, containing the ``account``, the ``remaining`` requests, the
+    ``limit`` (if known), the ``reset`` time, the number of requests
+    ``reserved`` for interactive use, and the number of background requests
+    ``shed`` in the current period.
+    """
+    keys = []
+
+    for account in accounts:
+        keys += [
+            _make_cache_key(account, name)
+            for name in ('remaining', 'info', 'shed')
+        ]
+
+    values = cache.get_many(keys)
+    results = []
+
+    for account in accounts:
+        remaining, info, shed = [
+            values.get(_make_cache_key(account, name))
+            for name in ('remaining', 'info', 'shed')
+        ]
+
+        if remaining is not None and info is not None:
+            results.append({
+                'account': account,
+                'remaining': remaining,
+                'limit': info['limit'],
+                'reset': info['reset'],
+                'reserved': _get_background_reserve(info),
+                'shed': shed or 0,
+            })
+
+    return results
+
+
+def can_make_background_request(account):
+    """Returns whether a background request would be allowed for an account.
+
+    This checks the same condition as acquire_request, without counting
+    the request or recording it as shed. It can be used to avoid starting
+    background work that would only be refused.
+    """
+    remaining = cache.get(_make_cache_key(account, 'remaining'))
+
+    if remaining is None:
+        return True
+
+    info = cache.get(_make_cache_key(account, 'info'))
+
+    return info is None or remaining > _get_background_reserve(info)
+
+
+def acquire_request(account):
+    """Checks that a request can be made for an account.
+
+    This is called before each request made through a HostingService. If
+    the request has background priority and the account is down to the
+    requests reserved for interactive use, RateLimitExceededError will be
+    raised. Otherwise, the request is counted against the account's
+    remaining requests.
+    """
+    remaining_key = _make_cache_key(account, 'remaining')
+    remaining = cache.get(remaining_key)
+
+    if remaining is None:
+        return
+
+    if get_request_priority() == PRIORITY_BACKGROUND:
+        info = cache.get(_make_cache_key(account, 'info'))
+
+        if info is not None and remaining <= _get_background_reserve(info):
+            shed_key = _make_cache_key(account, 'shed')
+            cache.add(shed_key, 0, max(int(info['reset'] - time.time()), 1))
+
+            try:
+                cache.incr(shed_key)
+            except ValueError:
+                pass
+
+            raise RateLimitExceededError(
+                'Only %s requests remain for %s on %s; skipping background '
+                'request' % (remaining, account.username,
+                             account.service_name))
+
+    try:
+        cache.decr(remaining_key)
+    except ValueError:
+        # The rate limit was reset while checking it.
+        pass
+
+
+def _get_background_reserve(info):
+    """Returns the number of requests reserved for interactive use.
+
+    The reserve shrinks as the end of the rate limit period approaches,
+    since whatever hasn't been used by then is lost anyway.
+    """
+    if info['limit']:
+        reserve = info['limit'] * BACKGROUND_RESERVE_FRACTION
+    else:
+        reserve = BACKGROUND_RESERVE_DEFAULT
+
+    time_left = min(max(info['reset'] - time.time(), 0), RATE_LIMIT_PERIOD)
+
+    return int(reserve * time_left / RATE_LIMIT_PERIOD)
+
+
+def _make_cache_key(account, name):
+    """Makes a cache key for part of an account's rate limit."""
+    return make_cache_key('hostingsvcs-rate-limit-%s:%s:%s:%s' % (
+        name,
+        urlquote(account.service_name),
+        urlquote(account.hosting_url or ''),
+        urlquote(account.username)))
@@ -1,13 +1,37 @@
+from __future__ import with_statement
 import base64
+import httplib
 import json
 import logging
 import mimetools
+import socket
+import threading
+import urllib
 import urllib2
-from urlparse import urlparse
+from hashlib import md5
+from StringIO import StringIO
+from urlparse import urljoin, urlparse
 
+from django.core.cache import cache
 from django.utils.translation import ugettext_lazy as _
+from djblets.util.misc import make_cache_key
 from pkg_resources import iter_entry_points
 
+from reviewboard.hostingsvcs.ratelimit import (PRIORITY_BACKGROUND,
+                                               acquire_request,
+                                               can_make_background_request,
+                                               request_priority)
+
+
+# How long responses are kept for conditional requests, in seconds.
+HTTP_CACHE_EXPIRATION = 60 * 60 * 24 * 7  # 1 week
+
+# How long a background refresh of a cached response may take before
+# another one can be started, in seconds.
+HTTP_CACHE_REFRESH_TIMEOUT = 60
+
+HTTP_CACHE_STATS = ('hits', 'misses', 'not_modified')
+
 
 class HostingService(object):
     """An interface to a hosting service for repositories and bug trackers.
@@ -234,6 +258,51 @@ class HostingService(object):
     def _http_get(self, url, *args, **kwargs):
         return self._http_request(url, **kwargs)
 
+    def _http_head(self, url, *args, **kwargs):
+        """Performs an HTTP HEAD, returning the response's headers.
+
+        This can be used to check that a resource exists without
+        downloading it.
+        """
+        return self._http_request(url, method='HEAD', **kwargs)[1]
+
+    def _http_get_conditional(self, url, headers={}, **kwargs):
+        """Performs an HTTP GET, reusing a cached response if it's current.
+
+        Responses with an ETag or Last-Modified header are cached. When the
+        URL is requested again, the request is made conditional on the
+        response having changed, and the cached response is returned if the
+        server says it hasn't (with a 304 Not Modified).
+
+        If the service is rate-limiting the account (see _is_rate_limited),
+        any cached response is returned straight away, and the cache is
+        refreshed in the background.
+
+        The number of requests served from the cache, by 304s and by full
+        responses are counted, and can be retrieved through
+        get_http_cache_stats.
+        """
+        cache_key = self._make_http_cache_key(url, headers, kwargs)
+        entry = cache.get(cache_key)
+
+        if entry is not None and self._is_rate_limited():
+            _increment_http_cache_stat('hits')
+            self._refresh_http_cache_in_background(cache_key, url, headers,
+                                                   kwargs)
+
+            return entry['data'], _load_http_headers(entry['headers'])
+
+        return self._fetch_conditional(cache_key, entry, url, headers, kwargs)
+
+    def _is_rate_limited(self):
+        """Returns whether the account is close to its API rate limit.
+
+        Subclasses for services with rate limits can override this so that
+        _http_get_conditional will serve cached responses rather than use
+        up what remains of the limit.
+        """
+        return False
+
     def _http_post(self, url, body=None, fields={}, files={},
                    content_type=None, headers={}, *args, **kwargs):
         headers = headers.copy()
@@ -251,10 +320,114 @@ class HostingService(object):
 
         return self._http_request(url, body, headers, **kwargs)
 
+    def _fetch_conditional(self, cache_key, entry, url, headers, kwargs):
+        """Performs a conditional HTTP GET for _http_get_conditional."""
+        request_headers = headers.copy()
+
+        if entry is not None:
+            if entry['etag']:
+                request_headers['If-None-Match'] = entry['etag']
+
+            if entry['last_modified']:
+                request_headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            data, rsp_headers = self._http_get(url, headers=request_headers,
+                                               **kwargs)
+        except urllib2.HTTPError, e:
+            if entry is None or e.code != 304:
+                raise
+
+            _increment_http_cache_stat('not_modified')
+
+            # Keep the entry around for another full period, since it's
+            # known to be current.
+            cache.set(cache_key, entry, HTTP_CACHE_EXPIRATION)
+
+            return entry['data'], _load_http_headers(entry['headers'])
+
+        _increment_http_cache_stat('misses')
+
+        if rsp_headers:
+            etag = rsp_headers.get('ETag')
+            last_modified = rsp_headers.get('Last-Modified')
+        else:
+            etag = None
+            last_modified = None
+
+        if etag or last_modified:
+            cache.set(cache_key, {
+                'etag': etag,
+                'last_modified': last_modified,
+                'data': data,
+                'headers': _dump_http_headers(rsp_headers),
+            }, HTTP_CACHE_EXPIRATION)
+        elif entry is not None:
+            cache.delete(cache_key)
+
+        return data, rsp_headers
+
+    def _refresh_http_cache_in_background(self, cache_key, url, headers,
+                                          kwargs):
+        """Refreshes a response in the cache from a new thread.
+
+        Only one refresh for a given response is run at a time. No thread
+        is started if the account's rate limit wouldn't allow a background
+        request.
+        """
+        if (self.account is not None and
+            not can_make_background_request(self.account)):
+            logging.debug('Not refreshing the cached response for %s, since '
+                          'the rate limit is reserved for interactive '
+                          'requests',
+                          url)
+            return
+
+        lock_key = cache_key + ':refreshing'
+
+        if cache.add(lock_key, True, HTTP_CACHE_REFRESH_TIMEOUT):
+            thread = threading.Thread(target=self._refresh_http_cache,
+                                      args=(cache_key, lock_key, url,
+                                            headers, kwargs))
+            thread.setDaemon(True)
+            thread.start()
+
+    def _refresh_http_cache(self, cache_key, lock_key, url, headers, kwargs):
+        """Refreshes a response in the cache.
+
+        If the refresh is refused or fails, the lock is left to expire on
+        its own, so that the refresh isn't retried on every request for the
+        response.
+        """
+        try:
+            with request_priority(PRIORITY_BACKGROUND):
+                self._fetch_conditional(cache_key, cache.get(cache_key), url,
+                                        headers, kwargs)
+        except Exception, e:
+            logging.debug('Unable to refresh the cached response for %s: %s',
+                          url, e)
+        else:
+            cache.delete(lock_key)
+
+    def _make_http_cache_key(self, url, headers, kwargs):
+        """Makes a cache key for a response to _http_get_conditional.
+
+        URLs may contain access tokens, so they're hashed rather than used
+        in the key directly.
+        """
+        return make_cache_key('hostingsvcs-http:%s' % md5(repr((
+            url,
+            sorted(headers.items()),
+            kwargs.get('username'),
+        ))).hexdigest())
+
     def _build_request(self, url, body=None, headers={}, username=None,
-                       password=None):
+                       password=None, method=None):
         r = urllib2.Request(url, body, headers)
 
+        if method is not None:
+            r.get_method = lambda: method
+
         if username is not None and password is not None:
             r.add_header(urllib2.HTTPBasicAuthHandler.auth_header,
                          'Basic %s' % base64.b64encode(username + ':' +
@@ -263,10 +436,30 @@ class HostingService(object):
         return r
 
     def _http_request(self, url, body=None, headers={}, **kwargs):
+        u = self._http_open(url, body, headers, **kwargs)
+
+        try:
+            return u.read(), u.headers
+        finally:
+            u.close()
+
+    def _http_open(self, url, body=None, headers={}, **kwargs):
+        """Opens a URL, returning a file-like object for the response.
+
+        The response body is streamed from the server as it's read. The
+        connection is kept alive and shared with later requests to the same
+        host once the body has been read or the response closed.
+
+        Like urllib2.urlopen, this raises urllib2.HTTPError for error
+        responses, and urllib2.URLError if the server couldn't be reached.
+        RateLimitExceededError is raised for background requests once the
+        account is low on requests (see reviewboard.hostingsvcs.ratelimit).
+        """
+        acquire_request(self.account)
+
         r = self._build_request(url, body, headers, **kwargs)
-        u = urllib2.urlopen(r)
 
-        return u.read(), u.headers
+        return _http_connection_pool.urlopen(r)
 
     def _build_form_data(self, fields, files):
         """Encodes data for use in an HTTP POST."""
@@ -296,6 +489,336 @@ class HostingService(object):
         return content_type, content
 
 
+class PooledHTTPResponse(object):
+    """A response to a request made through an HTTPConnectionPool.
+
+    This provides the parts of the interface of urllib2.urlopen's responses
+    that hosting services use. The body is read from the connection as it's
+    requested. Once the whole body has been read, or the response has been
+    closed, the connection is handed back to the pool. Responses should
+    always be closed when no longer needed, so that the pool's limit on
+    connections isn't used up.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self.code = response.status
+        self.msg = response.reason
+        self.headers = response.msg
+        self.url = url
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def read(self, amt=None):
+        if self._conn is None:
+            return ''
+
+        try:
+            data = self._response.read(amt)
+        except:
+            self._release(reuse=False)
+            raise
+
+        if self._response.isclosed():
+            self._release(reuse=not self._response.will_close)
+
+        return data
+
+    def info(self):
+        return self.headers
+
+    def geturl(self):
+        return self.url
+
+    def getcode(self):
+        return self.code
+
+    def close(self):
+        if self._conn is not None:
+            # The rest of the body hasn't been read, so the connection
+            # can't be used for another request.
+            self._release(reuse=False)
+
+    def _release(self, reuse):
+        conn = self._conn
+        self._conn = None
+        self._response.close()
+        self._pool.release(self._key, conn, reuse)
+
+
+class HTTPConnectionPool(object):
+    """A pool of keep-alive HTTP connections, keyed by host.
+
+    Requests to a host reuse any idle connections that earlier requests
+    left open, saving a new TCP connection and TLS handshake each time.
+    No more than ``max_connections_per_host`` connections are used at once
+    for any given host. Further requests for that host will wait until a
+    connection is released.
+
+    Requests that would go through a proxy are made using urllib2 instead.
+    """
+    CONNECTION_CLASSES = {
+        'http': httplib.HTTPConnection,
+        'https': httplib.HTTPSConnection,
+    }
+
+    REDIRECT_CODES = (301, 302, 303, 307)
+    MAX_REDIRECTS = 10
+
+    # Methods that are safe to send again if a reused connection fails
+    # after the request was sent.
+    RETRY_METHODS = ('GET', 'HEAD')
+
+    def __init__(self, max_connections_per_host=4):
+        self.max_connections_per_host = max_connections_per_host
+        self._idle = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def urlopen(self, request):
+        """Performs a request, returning a PooledHTTPResponse.
+
+        ``request`` is a urllib2.Request. Redirects are followed, and any
+        other responses outside of the 2xx range (including 304 Not
+        Modified) raise urllib2.HTTPError, as with urllib2.urlopen.
+        """
+        url = request.get_full_url()
+        method = request.get_method()
+        body = request.get_data()
+        # As with urllib2.Request, header names are capitalized, so that
+        # they can be compared without worrying about case.
+        headers = dict([
+            (key.capitalize(), value)
+            for key, value in request.header_items()
+        ])
+        headers.setdefault('User-agent',
+                           'Python-urllib/%s' % urllib2.__version__)
+
+        if body is not None:
+            headers.setdefault('Content-type',
+                               'application/x-www-form-urlencoded')
+
+        for i in xrange(self.MAX_REDIRECTS + 1):
+            scheme, netloc = urlparse(url)[:2]
+
+            if (scheme not in self.CONNECTION_CLASSES or
+                self._uses_proxy(scheme, netloc)):
+                proxy_request = urllib2.Request(url, body, headers)
+                proxy_request.get_method = lambda: method
+
+                return urllib2.urlopen(proxy_request)
+
+            response = self._request((scheme, netloc), method, url, body,
+                                     headers)
+
+            if (response.code not in self.REDIRECT_CODES or
+                (response.code == 307 and method not in ('GET', 'HEAD'))):
+                break
+
+            location = (response.headers.getheader('Location') or
+                        response.headers.getheader('URI'))
+            response.read()
+            response.close()
+
+            if not location:
+                break
+
+            url = urljoin(url, location)
+
+            if response.code != 307 and method != 'HEAD':
+                # As with urllib2, the request is redirected as a GET.
+                method = 'GET'
+                body = None
+                headers = dict([
+                    (key, value)
+                    for key, value in headers.iteritems()
+                    if key not in ('Content-length', 'Content-type')
+                ])
+        else:
+            raise urllib2.HTTPError(url, response.code,
+                                    'Too many redirects', response.headers,
+                                    StringIO())
+
+        if not 200 <= response.code < 300:
+            fp = StringIO(response.read())
+            response.close()
+
+            raise urllib2.HTTPError(url, response.code, response.msg,
+                                    response.headers, fp)
+
+        return response
+
+    def release(self, key, conn, reuse):
+        """Releases a connection acquired for a request.
+
+        If ``reuse`` is set, the connection is kept open for the next
+        request to the host. Otherwise, it's closed.
+        """
+        if reuse:
+            self._lock.acquire()
+
+            try:
+                self._idle.setdefault(key, []).append(conn)
+            finally:
+                self._lock.release()
+        else:
+            conn.close()
+
+        self._get_semaphore(key).release()
+
+    def clear(self):
+        """Closes all idle connections."""
+        self._lock.acquire()
+
+        try:
+            idle = self._idle
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+        for conns in idle.itervalues():
+            for conn in conns:
+                conn.close()
+
+    def _request(self, key, method, url, body, headers):
+        """Sends a request, returning the response.
+
+        An idle connection may have been closed by the server since it was
+        last used, in which case the request is retried on a new connection.
+        If the connection failed after the request was sent, the server may
+        have acted on it, so it's only retried for RETRY_METHODS.
+        """
+        scheme, netloc = key
+        parsed_url = urlparse(url)
+        selector = parsed_url[2] or '/'
+
+        if parsed_url[4]:
+            selector += '?' + parsed_url[4]
+
+        self._get_semaphore(key).acquire()
+
+        try:
+            while True:
+                conn = self._get_idle_connection(key)
+                reused = conn is not None
+
+                if not reused:
+                    conn = self.CONNECTION_CLASSES[scheme](netloc)
+
+                sent = False
+
+                try:
+                    conn.request(method, selector, body, headers)
+                    sent = True
+                    response = conn.getresponse()
+                    break
+                except (httplib.HTTPException, socket.error), e:
+                    conn.close()
+
+                    if (not reused or
+                        (sent and method not in self.RETRY_METHODS)):
+                        raise urllib2.URLError(e)
+        except:
+            self._get_semaphore(key).release()
+            raise
+
+        return PooledHTTPResponse(self, key, conn, response, url)
+
+    def _get_idle_connection(self, key):
+        self._lock.acquire()
+
+        try:
+            conns = self._idle.get(key)
+
+            if conns:
+                return conns.pop()
+            else:
+                return None
+        finally:
+            self._lock.release()
+
+    def _get_semaphore(self, key):
+        self._lock.acquire()
+
+        try:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(
+                    self.max_connections_per_host)
+
+            return self._semaphores[key]
+        finally:
+            self._lock.release()
+
+    def _uses_proxy(self, scheme, netloc):
+        host = netloc.rsplit('@', 1)[-1]
+
+        return (scheme in urllib.getproxies() and
+                not urllib.proxy_bypass(host.split(':', 1)[0]))
+
+
+MAX_HTTP_CONNECTIONS_PER_HOST = 4
+
+_http_connection_pool = HTTPConnectionPool(MAX_HTTP_CONNECTIONS_PER_HOST)
+
+
+def get_http_cache_stats():
+    """Returns statistics on the cache for conditional HTTP requests.
+
+    This returns a dictionary with the number of responses to
+    HostingService._http_get_conditional that were served from the cache
+    without contacting the service (``hits``), that needed a full response
+    (``misses``), and that the service said were unchanged
+    (``not_modified``).
+
+    The counts are stored in the cache, so that they're shared between
+    processes. They'll start over if the cache is cleared.
+    """
+    keys = dict([
+        (name, make_cache_key('hostingsvcs-http-cache-stats-%s' % name))
+        for name in HTTP_CACHE_STATS
+    ])
+    values = cache.get_many(keys.values())
+
+    return dict([
+        (name, values.get(key, 0))
+        for name, key in keys.iteritems()
+    ])
+
+
+def _increment_http_cache_stat(name):
+    """Adds to one of the statistics on the cache for HTTP requests."""
+    key = make_cache_key('hostingsvcs-http-cache-stats-%s' % name)
+    cache.add(key, 0)
+
+    try:
+        cache.incr(key)
+    except ValueError:
+        # The key was evicted after being added. Losing a count isn't
+        # worth retrying for.
+        pass
+
+
+def _dump_http_headers(headers):
+    """Dumps the headers of a response for caching."""
+    if hasattr(headers, 'headers'):
+        # This is a mimetools.Message, which has the raw header lines.
+        return ''.join(headers.headers)
+    else:
+        return ''.join([
+            '%s: %s\r\n' % (key, value)
+            for key, value in headers.iteritems()
+        ])
+
+
+def _load_http_headers(data):
+    """Loads the headers of a cached response.
+
+    Like the headers of a response from urllib2, the result can be accessed
+    like a dictionary with case-insensitive keys.
+    """
+    return httplib.HTTPMessage(StringIO(data))
+
+
 _hosting_services = {}
 
 
@@ -1,16 +1,37 @@
 from __future__ import with_statement
+import httplib
 import json
+import threading
+import time
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from hashlib import md5
+from SocketServer import ThreadingMixIn
 from textwrap import dedent
 from urllib2 import HTTPError
 from urlparse import urlparse
 
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from djblets.util.misc import make_cache_key
 from django.test import TestCase
 from kgb import SpyAgency
 
 from reviewboard.hostingsvcs.models import HostingServiceAccount
-from reviewboard.hostingsvcs.service import get_hosting_service
+from reviewboard.hostingsvcs import service as hostingsvcs_service
+from reviewboard.hostingsvcs.errors import RateLimitExceededError
+from reviewboard.hostingsvcs.ratelimit import (PRIORITY_BACKGROUND,
+                                               acquire_request,
+                                               can_make_background_request,
+                                               get_rate_limits,
+                                               get_remaining_requests,
+                                               get_request_priority,
+                                               record_rate_limit,
+                                               request_priority)
+from reviewboard.hostingsvcs.service import (HostingService,
+                                             HTTPConnectionPool,
+                                             get_hosting_service,
+                                             get_http_cache_stats)
 from reviewboard.scmtools.core import Branch
 from reviewboard.scmtools.errors import FileNotFoundError
 from reviewboard.scmtools.models import Repository, Tool
@@ -281,11 +302,19 @@ class BeanstalkTests(ServiceTests):
 
         self.spy_on(service._http_get, call_fake=_http_get)
 
+        cache.clear()
         result = service.get_file_exists(repository, '/path', revision,
                                          base_commit_id)
         self.assertTrue(service._http_get.called)
         self.assertEqual(result, expected_found)
 
+        # Only the full contents of the file are cached for get_file.
+        file_cache_key = make_cache_key(
+            repository._make_file_cache_key('/path', revision,
+                                            base_commit_id))
+        self.assertEqual(cache.has_key(file_cache_key),
+                         expected_found and not base_commit_id)
+
 
 class BitbucketTests(ServiceTests):
     """Unit tests for the Bitbucket hosting service."""
@@ -554,11 +583,17 @@ class BitbucketTests(ServiceTests):
 
         self.spy_on(service._http_get, call_fake=_http_get)
 
+        cache.clear()
         result = service.get_file_exists(repository, 'path', revision,
                                          base_commit_id)
         self.assertEqual(service._http_get.called, expected_http_called)
         self.assertEqual(result, expected_found)
 
+        file_cache_key = make_cache_key(
+            repository._make_file_cache_key('path', revision,
+                                            base_commit_id))
+        self.assertEqual(cache.has_key(file_cache_key), expected_found)
+
 
 class BugzillaTests(ServiceTests):
     """Unit tests for the Bugzilla hosting service."""
@@ -925,6 +960,34 @@ class GitHubTests(ServiceTests):
         self.assertEqual(body['client_id'], client_id)
         self.assertEqual(body['client_secret'], client_secret)
 
+    def test_rate_limits(self):
+        """Testing GitHub tracking the remaining rate limit"""
+        cache.clear()
+        service = self._get_service()
+        reset = str(int(time.time()) + 600)
+
+        self.assertFalse(service._is_rate_limited())
+
+        service._check_rate_limits({
+            'X-RateLimit-Remaining': '4000',
+            'X-RateLimit-Reset': reset,
+        })
+        self.assertFalse(service._is_rate_limited())
+
+        service._check_rate_limits({
+            'X-RateLimit-Remaining': '50',
+            'X-RateLimit-Reset': reset,
+        })
+        self.assertTrue(service._is_rate_limited())
+
+    def test_get_file_exists(self):
+        """Testing GitHub get_file_exists checking blobs with HEAD requests"""
+        self._test_get_file_exists(expected_found=True)
+
+    def test_get_file_exists_not_found(self):
+        """Testing GitHub get_file_exists with a missing blob"""
+        self._test_get_file_exists(expected_found=False)
+
     def test_get_branches(self):
         """Testing GitHub get_branches implementation"""
         branches_api_response = json.dumps([
@@ -1206,6 +1269,38 @@ class GitHubTests(ServiceTests):
 
         return service._get_repo_api_url(repository)
 
+    def _test_get_file_exists(self, expected_found):
+        def _http_head(service, url, headers={}, *args, **kwargs):
+            self.assertEqual(
+                url,
+                'https://api.github.com/repos/myuser/myrepo/git/blobs/'
+                'abc123?access_token=abc123')
+            self.assertEqual(headers['Accept'], service.RAW_MIMETYPE)
+
+            if expected_found:
+                return {}
+            else:
+                raise HTTPError(url, 404, 'Not Found', {}, None)
+
+        account = self._get_hosting_account()
+        account.data['authorization'] = {'token': 'abc123'}
+
+        repository = Repository(hosting_account=account)
+        repository.extra_data = {
+            'repository_plan': 'public',
+            'github_public_repo_name': 'myrepo',
+        }
+
+        service = account.service
+        self.spy_on(service._http_head, call_fake=_http_head)
+        self.spy_on(service._http_get)
+
+        result = service.get_file_exists(repository, 'path', 'abc123')
+
+        self.assertEqual(result, expected_found)
+        self.assertTrue(service._http_head.called)
+        self.assertFalse(service._http_get.called)
+
 
 class GitoriousTests(ServiceTests):
     """Unit tests for the Gitorious hosting service."""
@@ -1369,3 +1464,380 @@ class VersionOneTests(ServiceTests):
                 'versionone_url': 'http://versionone.example.com',
             }),
             'http://versionone.example.com/assetdetail.v1?Number=%s')
+
+
+class CountingHTTPServer(ThreadingMixIn, HTTPServer):
+    """A local HTTP server that counts the connections made to it.
+
+    This stands in for a hosting service's API in the HTTP connection pool
+    tests.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), CountingHTTPHandler)
+        self.num_connections = 0
+        self.etag_requests = []
+        self.url = 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def process_request(self, request, client_address):
+        self.num_connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Connections left open by the pool are reset when the test ends.
+        pass
+
+
+class CountingHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path.startswith('/file/'):
+            self._respond(200, 'contents of %s' % self.path[len('/file/'):])
+        elif self.path == '/close':
+            self._respond(200, 'closing', {'Connection': 'close'})
+            self.close_connection = 1
+        elif self.path == '/redirect':
+            self._respond(302, '', {'Location': '/file/redirected'})
+        elif self.path == '/etag':
+            etag = self.headers.get('If-None-Match')
+            self.server.etag_requests.append(etag)
+
+            if etag == '"v1"':
+                self._respond(304, '', {'ETag': '"v1"'})
+            else:
+                self._respond(200, 'versioned', {'ETag': '"v1"'})
+        else:
+            self._respond(404, '{"message": "Not Found"}')
+
+    def do_HEAD(self):
+        if self.path.startswith('/file/'):
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self._respond(200, '%s %s' % (self.headers['Content-Type'], body))
+
+    def log_message(self, *args):
+        pass
+
+    def _respond(self, code, body, headers={}):
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTPRequestTests(TestCase):
+    """Unit tests for HTTP requests made by hosting services."""
+    def setUp(self):
+        super(HTTPRequestTests, self).setUp()
+
+        cache.clear()
+
+        self.server = CountingHTTPServer()
+        self.server_thread = threading.Thread(
+            target=self.server.serve_forever)
+        self.server_thread.setDaemon(True)
+        self.server_thread.start()
+
+        self.service = HostingService(
+            HostingServiceAccount(service_name='github', username='myuser'))
+
+    def tearDown(self):
+        super(HTTPRequestTests, self).tearDown()
+
+        hostingsvcs_service._http_connection_pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        """Testing HostingService._http_get reusing connections"""
+        for name in ('a', 'b', 'c'):
+            data, headers = self.service._http_get(
+                '%s/file/%s' % (self.server.url, name))
+
+            self.assertEqual(data, 'contents of %s' % name)
+            self.assertEqual(headers['Content-Length'], str(len(data)))
+
+        data, headers = self.service._http_post(
+            '%s/post' % self.server.url,
+            body='{}',
+            content_type='application/json')
+
+        self.assertEqual(data, 'application/json {}')
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_streaming(self):
+        """Testing HostingService._http_open streaming the response"""
+        u = self.service._http_open('%s/file/stream' % self.server.url)
+
+        self.assertEqual(u.read(8), 'contents')
+        self.assertEqual(u.read(), ' of stream')
+        u.close()
+
+        self.service._http_get('%s/file/a' % self.server.url)
+        self.assertEqual(self.server.num_connections, 1)
+
+        # A response that's closed before being read can't hand back its
+        # connection.
+        u = self.service._http_open('%s/file/stream' % self.server.url)
+        u.close()
+
+        self.service._http_get('%s/file/a' % self.server.url)
+        self.assertEqual(self.server.num_connections, 2)
+
+    def test_http_error(self):
+        """Testing HostingService._http_get with HTTP errors"""
+        try:
+            self.service._http_get('%s/missing' % self.server.url)
+            self.fail('HTTPError was not raised')
+        except urllib2.HTTPError, e:
+            self.assertEqual(e.code, 404)
+            self.assertEqual(json.loads(e.read()),
+                             {'message': 'Not Found'})
+
+        self.service._http_get('%s/file/a' % self.server.url)
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_connection_close(self):
+        """Testing HostingService._http_get with servers closing connections"""
+        data, headers = self.service._http_get(
+            '%s/close' % self.server.url)
+        self.assertEqual(data, 'closing')
+
+        data, headers = self.service._http_get(
+            '%s/file/a' % self.server.url)
+        self.assertEqual(data, 'contents of a')
+        self.assertEqual(self.server.num_connections, 2)
+
+    def test_head(self):
+        """Testing HostingService._http_head"""
+        headers = self.service._http_head('%s/file/a' % self.server.url)
+        self.assertEqual(headers['Content-Length'], '100')
+
+        self.assertRaises(urllib2.HTTPError,
+                          self.service._http_head,
+                          '%s/missing' % self.server.url)
+
+        data, headers = self.service._http_get('%s/file/a' % self.server.url)
+        self.assertEqual(data, 'contents of a')
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_redirect(self):
+        """Testing HostingService._http_get following redirects"""
+        data, headers = self.service._http_get(
+            '%s/redirect' % self.server.url)
+
+        self.assertEqual(data, 'contents of redirected')
+        self.assertEqual(self.server.num_connections, 1)
+
+    def test_max_connections_per_host(self):
+        """Testing HTTPConnectionPool limiting connections per host"""
+        pool = HTTPConnectionPool(max_connections_per_host=1)
+        u = pool.urlopen(urllib2.Request('%s/file/a' % self.server.url))
+        results = []
+
+        def _fetch():
+            u = pool.urlopen(urllib2.Request('%s/file/b' % self.server.url))
+            results.append(u.read())
+
+        thread = threading.Thread(target=_fetch)
+        thread.start()
+        thread.join(0.5)
+
+        self.assertTrue(thread.isAlive())
+        self.assertEqual(results, [])
+
+        self.assertEqual(u.read(), 'contents of a')
+        thread.join()
+
+        self.assertEqual(results, ['contents of b'])
+        self.assertEqual(self.server.num_connections, 1)
+        pool.clear()
+
+    def test_stale_connection_retry(self):
+        """Testing HTTPConnectionPool retrying only GET and HEAD requests on stale connections"""
+        class StaleConnection(object):
+            def request(self, method, selector, body, headers):
+                sent.append(method)
+
+            def getresponse(self):
+                raise httplib.BadStatusLine('')
+
+            def close(self):
+                pass
+
+        sent = []
+        pool = HTTPConnectionPool()
+        key = ('http', self.server.url[len('http://'):])
+
+        pool._idle[key] = [StaleConnection()]
+        u = pool.urlopen(urllib2.Request('%s/file/a' % self.server.url))
+        self.assertEqual(u.read(), 'contents of a')
+        self.assertEqual(self.server.num_connections, 1)
+
+        # The server may have acted on a POST that was sent, so it isn't
+        # sent again.
+        pool._idle[key] = [StaleConnection()]
+        self.assertRaises(urllib2.URLError, pool.urlopen,
+                          urllib2.Request('%s/post' % self.server.url, '{}'))
+        self.assertEqual(sent, ['GET', 'POST'])
+        self.assertEqual(self.server.num_connections, 1)
+        pool.clear()
+
+    def test_conditional_get(self):
+        """Testing HostingService._http_get_conditional"""
+        url = '%s/etag' % self.server.url
+
+        for i in xrange(2):
+            data, headers = self.service._http_get_conditional(url)
+
+            self.assertEqual(data, 'versioned')
+            self.assertEqual(headers['etag'], '"v1"')
+
+        self.assertEqual(self.server.etag_requests, [None, '"v1"'])
+        self.assertEqual(get_http_cache_stats(), {
+            'hits': 0,
+            'misses': 1,
+            'not_modified': 1,
+        })
+
+    def test_conditional_get_rate_limited(self):
+        """Testing HostingService._http_get_conditional when rate-limited"""
+        url = '%s/etag' % self.server.url
+        self.service._is_rate_limited = lambda: True
+
+        for i in xrange(2):
+            data, headers = self.service._http_get_conditional(url)
+            self.assertEqual(data, 'versioned')
+
+        self.assertEqual(get_http_cache_stats()['hits'], 1)
+
+        # The cached response is refreshed in the background.
+        for i in xrange(50):
+            if get_http_cache_stats()['not_modified']:
+                break
+
+            time.sleep(0.1)
+
+        self.assertEqual(self.server.etag_requests, [None, '"v1"'])
+
+    def test_conditional_get_rate_limited_without_background_requests(self):
+        """Testing HostingService._http_get_conditional when rate-limited and out of background requests"""
+        url = '%s/etag' % self.server.url
+        refreshes = []
+
+        self.service._is_rate_limited = lambda: True
+        self.service._refresh_http_cache = \
+            lambda *args: refreshes.append(args)
+        record_rate_limit(self.service.account, 50, 5000,
+                          time.time() + 3600)
+
+        for i in xrange(5):
+            data, headers = self.service._http_get_conditional(url)
+            self.assertEqual(data, 'versioned')
+
+        self.assertEqual(get_http_cache_stats()['hits'], 4)
+        self.assertEqual(refreshes, [])
+        self.assertEqual(self.server.etag_requests, [None])
+
+    def test_refresh_http_cache_failure(self):
+        """Testing HostingService._refresh_http_cache keeping the lock after a failure"""
+        def _fetch_conditional(*args):
+            raise urllib2.URLError('Connection refused')
+
+        self.service._fetch_conditional = _fetch_conditional
+        cache.set('refresh-lock', True)
+
+        self.service._refresh_http_cache('refresh-key', 'refresh-lock',
+                                         '%s/etag' % self.server.url, {}, {})
+
+        self.assertTrue(cache.get('refresh-lock'))
+
+
+class RateLimitTests(TestCase):
+    """Unit tests for scheduling requests against rate limits."""
+    def setUp(self):
+        super(RateLimitTests, self).setUp()
+
+        cache.clear()
+        self.account = HostingServiceAccount(service_name='github',
+                                             username='myuser')
+
+    def test_request_priority(self):
+        """Testing request_priority"""
+        self.assertEqual(get_request_priority(), 'interactive')
+
+        with request_priority(PRIORITY_BACKGROUND):
+            self.assertEqual(get_request_priority(), 'background')
+
+        self.assertEqual(get_request_priority(), 'interactive')
+
+    def test_acquire_request(self):
+        """Testing acquire_request counting requests"""
+        acquire_request(self.account)
+        self.assertEqual(get_remaining_requests(self.account), None)
+
+        record_rate_limit(self.account, 3000, 5000, time.time() + 3600)
+        acquire_request(self.account)
+
+        with request_priority(PRIORITY_BACKGROUND):
+            acquire_request(self.account)
+
+        self.assertEqual(get_remaining_requests(self.account), 2998)
+
+    def test_acquire_request_sheds_background(self):
+        """Testing acquire_request refusing background requests when low"""
+        reset = time.time() + 3600
+        record_rate_limit(self.account, 500, 5000, reset)
+
+        with request_priority(PRIORITY_BACKGROUND):
+            self.assertRaises(RateLimitExceededError,
+                              acquire_request, self.account)
+
+        acquire_request(self.account)
+
+        self.assertEqual(get_remaining_requests(self.account), 499)
+        self.assertEqual(get_rate_limits([self.account]), [{
+            'account': self.account,
+            'remaining': 499,
+            'limit': 5000,
+            'reset': reset,
+            'reserved': 999,
+            'shed': 1,
+        }])
+
+    def test_can_make_background_request(self):
+        """Testing can_make_background_request"""
+        self.assertTrue(can_make_background_request(self.account))
+
+        record_rate_limit(self.account, 3000, 5000, time.time() + 3600)
+        self.assertTrue(can_make_background_request(self.account))
+
+        record_rate_limit(self.account, 500, 5000, time.time() + 3600)
+        self.assertFalse(can_make_background_request(self.account))
+
+        # Checking doesn't count as a request.
+        self.assertEqual(get_remaining_requests(self.account), 500)
+        self.assertEqual(get_rate_limits([self.account])[0]['shed'], 0)
+
+    def test_acquire_request_near_reset(self):
+        """Testing acquire_request allowing background requests near reset"""
+        record_rate_limit(self.account, 500, 5000, time.time() + 60)
+
+        with request_priority(PRIORITY_BACKGROUND):
+            acquire_request(self.account)
+
+        self.assertEqual(get_remaining_requests(self.account), 499)
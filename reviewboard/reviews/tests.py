@@ -1261,12 +1261,16 @@ class PostCommitTests(SpyAgency, TestCase):
 
             return commit
 
-        def get_file_exists(repository, path, revision, base_commit_id=None,
-                            request=None):
-            return (path, revision) in [('/readme', 'd6613f5')]
+        def get_files_exist(repository, paths_and_revisions,
+                            base_commit_id=None, request=None):
+            return [
+                path_and_revision in [('/readme', 'd6613f5')]
+                for path_and_revision in paths_and_revisions
+            ]
 
         self.spy_on(self.repository.get_change, call_fake=get_change)
-        self.spy_on(self.repository.get_file_exists, call_fake=get_file_exists)
+        self.spy_on(self.repository.get_files_exist,
+                    call_fake=get_files_exist)
 
         review_request = ReviewRequest.objects.create(self.user,
                                                       self.repository)
@@ -1,7 +1,11 @@
+from __future__ import with_statement
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 
 from reviewboard.diffviewer.parser import DiffParser
 from reviewboard.scmtools.core import SCMTool, HEAD, PRE_CREATION
@@ -30,6 +34,139 @@ else:
     _popen_shell = False
 
 
+# The maximum number of commands written to a cleartool session before
+# reading their results.
+CLEARTOOL_PIPELINE_SIZE = 32
+
+
+class CleartoolSession(object):
+    """A long-lived interactive cleartool process.
+
+    Commands are written to cleartool's stdin, and their output is read back
+    from its stdout up to the status line that ``cleartool -status`` writes
+    after each command. This avoids starting a new cleartool process (and,
+    on some platforms, a shell) for every command.
+
+    If cleartool exits unexpectedly, a new process is started for the next
+    command.
+    """
+    command = ['cleartool', '-status']
+
+    PROMPT = 'cleartool> '
+    STATUS_RE = re.compile(r'Command \d+ returned status (\d+)\r?\n')
+
+    def __init__(self, cwd):
+        self.cwd = cwd
+        self.process = None
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def run(self, args):
+        """Runs a cleartool command, returning its output.
+
+        SCMError is raised with the command's output if it fails.
+        """
+        status, output = self.run_many([args])[0]
+
+        if status:
+            raise SCMError(output)
+
+        return output
+
+    def run_many(self, commands):
+        """Runs several cleartool commands.
+
+        The commands are written to cleartool in batches, before reading
+        their results. This returns a list of (status, output) tuples, one
+        per command.
+        """
+        results = []
+
+        with self._lock:
+            if self.process is None or self.process.poll() is not None:
+                self._start()
+
+            for i in xrange(0, len(commands), CLEARTOOL_PIPELINE_SIZE):
+                chunk = commands[i:i + CLEARTOOL_PIPELINE_SIZE]
+
+                try:
+                    self.process.stdin.write(''.join([
+                        '%s\n' % self._format_command(args)
+                        for args in chunk
+                    ]))
+                    self.process.stdin.flush()
+
+                    for args in chunk:
+                        results.append(self._read_result())
+                except (IOError, OSError), e:
+                    self._stop()
+                    raise SCMError('cleartool exited unexpectedly: %s' % e)
+
+        return results
+
+    def close(self):
+        """Shuts down the cleartool process."""
+        with self._lock:
+            self._stop()
+
+    def _start(self):
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.cwd,
+            shell=_popen_shell)
+        self._buffer = ''
+
+    def _stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.wait()
+            except (IOError, OSError):
+                pass
+
+            self.process = None
+
+    def _format_command(self, args):
+        """Builds a command line, quoting arguments where needed."""
+        quoted_args = []
+
+        for arg in args:
+            if not arg or re.search(r'[\s"\']', arg):
+                arg = '"%s"' % arg.replace('"', '\\"')
+
+            quoted_args.append(arg)
+
+        return ' '.join(quoted_args)
+
+    def _read_result(self):
+        """Reads the status and output of one command."""
+        fd = self.process.stdout.fileno()
+
+        while True:
+            m = self.STATUS_RE.search(self._buffer)
+
+            if m:
+                break
+
+            data = os.read(fd, 65536)
+
+            if not data:
+                raise IOError('cleartool closed its output')
+
+            self._buffer += data
+
+        output = self._buffer[:m.start()]
+        self._buffer = self._buffer[m.end():]
+
+        if output.startswith(self.PROMPT):
+            output = output[len(self.PROMPT):]
+
+        return int(m.group(1)), output
+
+
 class ClearCaseTool(SCMTool):
     name = 'ClearCase'
     uses_atomic_revisions = False
@@ -58,14 +195,28 @@ class ClearCaseTool(SCMTool):
 
         SCMTool.__init__(self, repository)
 
-        self.viewtype = self._get_view_type(self.repopath)
+        self.session = CleartoolSession(self.repopath)
 
-        if self.viewtype == self.VIEW_SNAPSHOT:
-            self.client = ClearCaseSnapshotViewClient(self.repopath)
-        elif self.viewtype == self.VIEW_DYNAMIC:
-            self.client = ClearCaseDynamicViewClient(self.repopath)
-        else:
-            raise SCMError('Unsupported view type.')
+        try:
+            self.viewtype = self._get_view_type(self.repopath)
+
+            if self.viewtype == self.VIEW_SNAPSHOT:
+                self.client = ClearCaseSnapshotViewClient(self.repopath,
+                                                          self.session)
+            elif self.viewtype == self.VIEW_DYNAMIC:
+                self.client = ClearCaseDynamicViewClient(self.repopath)
+            else:
+                raise SCMError('Unsupported view type.')
+        except Exception:
+            self.session.close()
+            raise
+
+    def close(self):
+        """Shuts down the tool's cleartool process.
+
+        A new process is started if the tool is used again.
+        """
+        self.session.close()
 
     def unextend_path(self, extended_path):
         """Remove ClearCase revision and branch informations from path.
@@ -149,19 +300,7 @@ class ClearCaseTool(SCMTool):
         }
 
     def _get_view_type(self, repopath):
-        cmdline = ["cleartool", "lsview", "-full", "-properties", "-cview"]
-        p = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=repopath,
-            shell=_popen_shell)
-
-        (res, error) = p.communicate()
-        failure = p.poll()
-
-        if failure:
-            raise SCMError(error)
+        res = self.session.run(["lsview", "-full", "-properties", "-cview"])
 
         for line in res.splitlines(True):
             splitted = line.split(' ')
@@ -174,36 +313,10 @@ class ClearCaseTool(SCMTool):
         return self.VIEW_UNKNOWN
 
     def _get_vobs_tag(self, repopath):
-        cmdline = ["cleartool", "describe", "-short", "vob:."]
-        p = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self.repopath,
-            shell=_popen_shell)
-
-        (res, error) = p.communicate()
-        failure = p.poll()
-
-        if failure:
-            raise SCMError(error)
-
-        return res.rstrip()
+        return self.session.run(["describe", "-short", "vob:."]).rstrip()
 
     def _get_vobs_uuid(self, vobstag):
-        cmdline = ["cleartool", "lsvob", "-long", vobstag]
-        p = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self.repopath,
-            shell=_popen_shell)
-
-        (res, error) = p.communicate()
-        failure = p.poll()
-
-        if failure:
-            raise SCMError(error)
+        res = self.session.run(["lsvob", "-long", vobstag])
 
         for line in res.splitlines(True):
             if line.startswith('Vob family uuid:'):
@@ -211,52 +324,68 @@ class ClearCaseTool(SCMTool):
 
         raise SCMError("Can't find familly uuid for vob: %s" % vobstag)
 
-    def _get_object_kind(self, extended_path):
-        cmdline = ["cleartool", "desc", "-fmt", "%m", extended_path]
-        p = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self.repopath,
-            shell=_popen_shell)
+    def _get_object_kinds(self, extended_paths):
+        results = []
 
-        (res, error) = p.communicate()
-        failure = p.poll()
+        for status, res in self.session.run_many([
+                ["desc", "-fmt", "%m", extended_path]
+                for extended_path in extended_paths]):
+            if status:
+                raise SCMError(res)
 
-        if failure:
-            raise SCMError(error)
+            results.append(res.strip())
 
-        return res.strip()
+        return results
 
     def get_file(self, extended_path, revision=HEAD):
         """Return content of file or list content of directory"""
-        if not extended_path:
-            raise FileNotFoundError(extended_path, revision)
+        return self.get_files([(extended_path, revision)])[0]
 
-        if revision == PRE_CREATION:
-            return ''
+    def get_files(self, paths_and_revisions):
+        """Return the contents of several files or directories.
 
-        if self.viewtype == self.VIEW_SNAPSHOT:
-            # Get the path to (presumably) file element (remove version)
-            # The '@@' at the end of file_path is required.
-            file_path = extended_path.rsplit('@@', 1)[0] + '@@'
-            okind = self._get_object_kind(file_path)
+        In snapshot views, the object kinds are looked up and the files
+        are fetched with one batch of commands each, through the cleartool
+        session.
+        """
+        results = [None] * len(paths_and_revisions)
+        snapshot_indexes = []
 
-            if okind == 'directory element':
-                raise SCMError('Directory elements are unsupported.')
-            elif okind == 'file element':
-                output = self.client.cat_file(extended_path, revision)
-            else:
+        for i, (extended_path, revision) in enumerate(paths_and_revisions):
+            if not extended_path:
                 raise FileNotFoundError(extended_path, revision)
-        else:
-            if cpath.isdir(extended_path):
-                output = self.client.list_dir(extended_path, revision)
+
+            if revision == PRE_CREATION:
+                results[i] = ''
+            elif self.viewtype == self.VIEW_SNAPSHOT:
+                snapshot_indexes.append(i)
+            elif cpath.isdir(extended_path):
+                results[i] = self.client.list_dir(extended_path, revision)
             elif cpath.exists(extended_path):
-                output = self.client.cat_file(extended_path, revision)
+                results[i] = self.client.cat_file(extended_path, revision)
             else:
                 raise FileNotFoundError(extended_path, revision)
 
-        return output
+        if snapshot_indexes:
+            files = [paths_and_revisions[i] for i in snapshot_indexes]
+
+            # Get the path to (presumably) file element (remove version)
+            # The '@@' at the end of file_path is required.
+            okinds = self._get_object_kinds([
+                extended_path.rsplit('@@', 1)[0] + '@@'
+                for extended_path, revision in files
+            ])
+
+            for (extended_path, revision), okind in zip(files, okinds):
+                if okind == 'directory element':
+                    raise SCMError('Directory elements are unsupported.')
+                elif okind != 'file element':
+                    raise FileNotFoundError(extended_path, revision)
+
+            for i, data in zip(snapshot_indexes, self.client.cat_files(files)):
+                results[i] = data
+
+        return results
 
     def parse_diff_revision(self, extended_path, revision_str, *args, **kwargs):
         """Guess revision based on extended_path.
@@ -279,7 +408,7 @@ class ClearCaseTool(SCMTool):
         return ['basedir', 'diff_path']
 
     def get_parser(self, data):
-        return ClearCaseDiffParser(data, self.repopath)
+        return ClearCaseDiffParser(data, self.repopath, self.session)
 
 
 class ClearCaseDiffParser(DiffParser):
@@ -289,8 +418,9 @@ class ClearCaseDiffParser(DiffParser):
 
     SPECIAL_REGEX = re.compile(r'^==== (\S+) (\S+) ====$')
 
-    def __init__(self, data, repopath):
+    def __init__(self, data, repopath, session):
         self.repopath = repopath
+        self.session = session
         super(ClearCaseDiffParser, self).__init__(data)
 
     def parse_diff_header(self, linenum, info):
@@ -330,19 +460,8 @@ class ClearCaseDiffParser(DiffParser):
         return linenum
 
     def _oid2filename(self, oid):
-        cmdline = ["cleartool", "describe", "-fmt", "%En@@%Vn", "oid:%s" % oid]
-        p = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=self.repopath,
-            shell=_popen_shell)
-
-        (res, error) = p.communicate()
-        failure = p.poll()
-
-        if failure:
-            raise SCMError(error)
+        res = self.session.run(["describe", "-fmt", "%En@@%Vn",
+                                "oid:%s" % oid])
 
         drive = os.path.splitdrive(self.repopath)[0]
         if drive:
@@ -369,33 +488,46 @@ class ClearCaseDynamicViewClient(object):
 
 
 class ClearCaseSnapshotViewClient(object):
-    def __init__(self, path):
+    def __init__(self, path, session):
         self.path = path
+        self.session = session
 
     def cat_file(self, extended_path, revision):
-        import tempfile
-        # Use tempfile to generate temporary filename
-        temp = tempfile.NamedTemporaryFile()
-        # Remove the file, so cleartool can write to it
-        temp.close()
-
-        cmdline = ["cleartool", "get", "-to", temp.name, extended_path]
-        p = subprocess.Popen(
-            cmdline,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            shell=_popen_shell)
+        return self.cat_files([(extended_path, revision)])[0]
 
-        (res, error) = p.communicate()
-        failure = p.poll()
+    def cat_files(self, files):
+        """Return the contents of several files.
 
-        if failure:
-            raise FileNotFoundError(extended_path, revision)
+        This takes a list of (extended_path, revision) tuples. cleartool
+        writes each file to a temporary directory, which is removed once
+        they've all been read.
+        """
+        tempdir = tempfile.mkdtemp(prefix='rb-clearcase-')
 
         try:
-            fp = open(temp.name, 'r')
-            data = fp.read()
-            fp.close()
-            return data
-        except:
-            raise FileNotFoundError(extended_path, revision)
+            temp_names = [
+                os.path.join(tempdir, str(i))
+                for i in xrange(len(files))
+            ]
+            results = self.session.run_many([
+                ["get", "-to", temp_name, extended_path]
+                for (extended_path, revision), temp_name in zip(files,
+                                                                temp_names)
+            ])
+            contents = []
+
+            for (extended_path, revision), temp_name, (failure, res) in \
+                    zip(files, temp_names, results):
+                if failure:
+                    raise FileNotFoundError(extended_path, revision)
+
+                try:
+                    fp = open(temp_name, 'r')
+                    contents.append(fp.read())
+                    fp.close()
+                except IOError:
+                    raise FileNotFoundError(extended_path, revision)
+
+            return contents
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
@@ -1,10 +1,14 @@
+from __future__ import with_statement
 import base64
 import logging
 import os
 import subprocess
 import sys
+import threading
 import urllib2
 import urlparse
+from collections import deque
+from multiprocessing.pool import ThreadPool
 
 import reviewboard.diffviewer.parser as diffparser
 from reviewboard.scmtools.errors import (AuthenticationError,
@@ -101,6 +105,194 @@ UNKNOWN = Revision('UNKNOWN')
 PRE_CREATION = Revision("PRE-CREATION")
 
 
+class LRUCache(object):
+    """A thread-safe dictionary holding a limited number of items.
+
+    Once there are more than max_size items, the least recently used items
+    are removed.
+
+    If on_remove is given, it's called with the key and value of each item
+    that's removed, whether it's evicted, replaced, deleted or cleared.
+    """
+    def __init__(self, max_size, on_remove=None):
+        self.max_size = max_size
+        self.on_remove = on_remove
+        self._items = {}
+        self._keys = []
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+
+            self._keys.remove(key)
+            self._keys.append(key)
+
+            return self._items[key]
+
+    def set(self, key, value):
+        removed = []
+
+        with self._lock:
+            if key in self._items:
+                self._keys.remove(key)
+
+                if self._items[key] is not value:
+                    removed.append((key, self._items[key]))
+
+            self._items[key] = value
+            self._keys.append(key)
+
+            while len(self._keys) > self.max_size:
+                old_key = self._keys.pop(0)
+                removed.append((old_key, self._items.pop(old_key)))
+
+        self._notify_removed(removed)
+
+    def delete(self, key):
+        removed = []
+
+        with self._lock:
+            if key in self._items:
+                removed.append((key, self._items.pop(key)))
+                self._keys.remove(key)
+
+        self._notify_removed(removed)
+
+    def keys(self):
+        with self._lock:
+            return list(self._keys)
+
+    def clear(self):
+        with self._lock:
+            removed = self._items.items()
+            self._items = {}
+            self._keys = []
+
+        self._notify_removed(removed)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _notify_removed(self, removed):
+        """Calls on_remove for removed items, outside of the lock."""
+        if self.on_remove is not None:
+            for key, value in removed:
+                self.on_remove(key, value)
+
+
+class KeyedTaskResult(object):
+    """The result of a task queued in a KeyedThreadPool."""
+    def __init__(self):
+        self._event = threading.Event()
+        self._value = None
+        self._error = None
+
+    def ready(self):
+        """Returns whether the task has finished."""
+        return self._event.is_set()
+
+    def get(self):
+        """Waits for the task, returning its result.
+
+        If the task raised an exception, it's raised again here.
+        """
+        self._event.wait()
+
+        if self._error is not None:
+            raise self._error
+
+        return self._value
+
+    def _set(self, value, error):
+        self._value = value
+        self._error = error
+        self._event.set()
+
+
+class KeyedThreadPool(object):
+    """A pool of threads limiting the number of tasks run at once per key.
+
+    Tasks are queued along with a key, such as the host or repository they
+    make requests to. No more than max_workers_per_key tasks for any key
+    are handed to the threads at once. The rest wait in a queue for that
+    key rather than in a thread, so many tasks for one key never hold up
+    tasks for other keys.
+
+    Keys are only tracked while they have tasks running or queued, and the
+    threads are started on first use.
+    """
+    def __init__(self, max_workers, max_workers_per_key):
+        self.max_workers = max_workers
+        self.max_workers_per_key = max_workers_per_key
+        self._pool = None
+        self._num_running = {}
+        self._queued = {}
+        self._lock = threading.Lock()
+
+    def apply_async(self, key, func, args=()):
+        """Queues a call to func(*args), returning a KeyedTaskResult."""
+        task = (func, args, KeyedTaskResult())
+
+        with self._lock:
+            num_running = self._num_running.get(key, 0)
+
+            if num_running < self.max_workers_per_key:
+                self._num_running[key] = num_running + 1
+                self._start_task(key, task)
+            else:
+                self._queued.setdefault(key, deque()).append(task)
+
+        return task[2]
+
+    def map(self, key, func, iterable):
+        """Calls func for each item, returning the results in order.
+
+        This waits for all the calls to finish. If any raise an exception,
+        the one for the first item is raised.
+        """
+        results = [
+            self.apply_async(key, func, (item,))
+            for item in iterable
+        ]
+
+        return [result.get() for result in results]
+
+    def _start_task(self, key, task):
+        """Hands a task to the threads. The lock must be held."""
+        if self._pool is None:
+            self._pool = ThreadPool(self.max_workers)
+
+        self._pool.apply_async(self._run_task, (key,) + task)
+
+    def _run_task(self, key, func, args, result):
+        """Runs a task, and then starts the next one queued for its key."""
+        value = None
+        error = None
+
+        try:
+            value = func(*args)
+        except Exception, e:
+            error = e
+
+        with self._lock:
+            queued = self._queued.get(key)
+
+            if queued:
+                self._start_task(key, queued.popleft())
+
+                if not queued:
+                    del self._queued[key]
+            else:
+                self._num_running[key] -= 1
+
+                if not self._num_running[key]:
+                    del self._num_running[key]
+
+        result._set(value, error)
+
+
 class SCMTool(object):
     name = None
     uses_atomic_revisions = False
@@ -126,9 +318,35 @@ class SCMTool(object):
     def __init__(self, repository):
         self.repository = repository
 
+    def close(self):
+        """Releases any processes or connections held by the SCMTool.
+
+        This is called when a cached SCMTool is discarded (see
+        Repository.get_scmtool). The SCMTool may still be in use by
+        another thread at that point, so subclasses overriding this should
+        leave it usable, starting up whatever they need again on next use.
+        """
+        pass
+
     def get_file(self, path, revision=None):
         raise NotImplementedError
 
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each of a list of files.
+
+        This takes a list of (path, revision) tuples, and returns a list of
+        file contents in the same order. By default, this calls get_file for
+        each file. SCMTools that can fetch several files at once should
+        override this.
+
+        As with get_file, FileNotFoundError is raised if any of the files
+        can't be found.
+        """
+        return [
+            self.get_file(path, revision)
+            for path, revision in paths_and_revisions
+        ]
+
     def file_exists(self, path, revision=HEAD):
         try:
             self.get_file(path, revision)
@@ -136,6 +354,19 @@ class SCMTool(object):
         except FileNotFoundError:
             return False
 
+    def files_exist(self, paths_and_revisions):
+        """Returns whether each of a list of files exists.
+
+        This takes a list of (path, revision) tuples, and returns a list of
+        booleans in the same order. By default, this calls file_exists for
+        each file. SCMTools that can check several files at once should
+        override this.
+        """
+        return [
+            self.file_exists(path, revision)
+            for path, revision in paths_and_revisions
+        ]
+
     def parse_diff_revision(self, file_str, revision_str, moved=False):
         raise NotImplementedError
 
@@ -204,12 +435,17 @@ class SCMTool(object):
         return patch
 
     @classmethod
-    def popen(cls, command, local_site_name=None):
+    def popen(cls, command, local_site_name=None, stdin=None,
+              stderr=subprocess.PIPE, cwd=None):
         """Launches an application, capturing output.
 
         This wraps subprocess.Popen to provide some common parameters and
         to pass environment variables that may be needed by rbssh, if
         indirectly invoked.
+
+        If stdin is subprocess.PIPE, the application's input can be written
+        to through the returned object. stderr can be set to
+        subprocess.STDOUT to merge the application's errors into its output.
         """
         env = os.environ.copy()
 
@@ -220,8 +456,10 @@ class SCMTool(object):
 
         return subprocess.Popen(command,
                                 env=env,
-                                stderr=subprocess.PIPE,
+                                stdin=stdin,
+                                stderr=stderr,
                                 stdout=subprocess.PIPE,
+                                cwd=cwd,
                                 close_fds=(os.name != 'nt'))
 
     @classmethod
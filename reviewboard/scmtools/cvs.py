@@ -1,6 +1,11 @@
+from __future__ import with_statement
+import atexit
 import os
 import re
+import shutil
+import subprocess
 import tempfile
+import threading
 import urlparse
 
 from djblets.util.filesystem import is_exe_in_path
@@ -18,6 +23,37 @@ from reviewboard.ssh.errors import SSHAuthenticationError, SSHError
 sshutils.register_rbssh('CVS_RSH')
 
 
+# The header that cvs writes before the contents of each file checked out
+# with "checkout -p".
+CHECKOUT_HEADER = '%s\nChecking out %%s\nRCS:  ' % ('=' * 67)
+
+# Matches a message that cvs wrote to stderr at the end of a file's contents,
+# such as "cvs checkout: warning: ..." or "cvs [checkout aborted]: ...".
+CVS_MESSAGE_RE = re.compile(r'cvs (\w+|\[\w+ aborted\]): [^\n]*\n?\Z')
+
+
+_work_dir = None
+_work_dir_lock = threading.Lock()
+
+
+def _get_work_dir():
+    """Returns the directory that cvs is run from.
+
+    CVS sometimes writes .cvsignore files to the current working directory,
+    even when files are checked out to stdout with -p. Rather than creating
+    and changing into a new temporary directory for every command, cvs is
+    always run from one scratch directory, shared by the whole process.
+    """
+    global _work_dir
+
+    with _work_dir_lock:
+        if _work_dir is None or not os.path.isdir(_work_dir):
+            _work_dir = tempfile.mkdtemp(prefix='rb-cvs-')
+            atexit.register(shutil.rmtree, _work_dir, True)
+
+        return _work_dir
+
+
 class CVSTool(SCMTool):
     name = "CVS"
     supports_authentication = True
@@ -53,6 +89,36 @@ class CVSTool(SCMTool):
 
         return self.client.cat_file(path, revision)
 
+    def get_files(self, paths_and_revisions):
+        for path, revision in paths_and_revisions:
+            if not path:
+                raise FileNotFoundError(path, revision)
+
+        results = self.client.cat_files(paths_and_revisions)
+
+        for (path, revision), data in zip(paths_and_revisions, results):
+            if data is None:
+                raise FileNotFoundError(path, revision)
+
+        return results
+
+    def files_exist(self, paths_and_revisions):
+        results = [False] * len(paths_and_revisions)
+        indexes = [
+            i
+            for i, (path, revision) in enumerate(paths_and_revisions)
+            if path
+        ]
+        files = self.client.cat_files([
+            paths_and_revisions[i]
+            for i in indexes
+        ])
+
+        for i, data in zip(indexes, files):
+            results[i] = data is not None
+
+        return results
+
     def parse_diff_revision(self, file_str, revision_str, *args, **kwargs):
         if revision_str == "PRE-CREATION":
             return file_str, PRE_CREATION
@@ -210,8 +276,6 @@ class CVSDiffParser(DiffParser):
 
 class CVSClient(object):
     def __init__(self, cvsroot, path, local_site_name):
-        self.tempdir = ""
-        self.currentdir = os.getcwd()
         self.cvsroot = cvsroot
         self.path = path
         self.local_site_name = local_site_name
@@ -221,15 +285,75 @@ class CVSClient(object):
             # pattern we use with all the other tools.
             raise ImportError
 
-    def cleanup(self):
-        if self.currentdir != os.getcwd():
-            # Restore current working directory
-            os.chdir(self.currentdir)
-            # Remove temporary directory
-            if self.tempdir != "":
-                os.rmdir(self.tempdir)
-
     def cat_file(self, filename, revision):
+        filename, filenameAttic = self._normalize_filename(filename)
+
+        try:
+            return self._cat_specific_file(filename, revision)
+        except FileNotFoundError:
+            if filenameAttic:
+                return self._cat_specific_file(filenameAttic, revision)
+            else:
+                raise
+
+    def cat_files(self, files):
+        """Returns the contents of each of a list of files.
+
+        This takes a list of (filename, revision) tuples, and returns a list
+        of file contents in the same order, with None in place of any file
+        that couldn't be found.
+
+        All the files for a revision are checked out with a single call to
+        cvs. Any that can't be found that way (such as files in the Attic)
+        are then fetched one at a time.
+        """
+        results = [None] * len(files)
+        revisions = []
+        indexes_by_revision = {}
+
+        for i, (filename, revision) in enumerate(files):
+            revision = str(revision)
+
+            if revision not in indexes_by_revision:
+                indexes_by_revision[revision] = []
+                revisions.append(revision)
+
+            indexes_by_revision[revision].append(i)
+
+        for revision in revisions:
+            indexes = indexes_by_revision[revision]
+            filenames = []
+
+            for i in indexes:
+                filename = self._normalize_filename(files[i][0])[0]
+
+                if filename not in filenames:
+                    filenames.append(filename)
+
+            if len(filenames) > 1:
+                contents = self._cat_specific_files(filenames, revision)
+            else:
+                contents = {}
+
+            for i in indexes:
+                filename = self._normalize_filename(files[i][0])[0]
+
+                if filename in contents:
+                    results[i] = contents[filename]
+                else:
+                    try:
+                        results[i] = self.cat_file(files[i][0], revision)
+                    except FileNotFoundError:
+                        pass
+
+        return results
+
+    def _normalize_filename(self, filename):
+        """Returns the filename to check out, and its path in the Attic.
+
+        The Attic path will be None if the filename doesn't contain enough
+        path information to build one.
+        """
         # We strip the repo off of the fully qualified path as CVS does
         # not like to be given absolute paths.
         repos_path = self.path.split(":")[-1]
@@ -266,23 +390,17 @@ class CVSClient(object):
             # Attic path that makes any kind of sense.
             filenameAttic = None
 
-        try:
-            return self._cat_specific_file(filename, revision)
-        except FileNotFoundError:
-            if filenameAttic:
-                return self._cat_specific_file(filenameAttic, revision)
-            else:
-                raise
+        return filename, filenameAttic
+
+    def _popen(self, args, **kwargs):
+        """Runs cvs against the repository, capturing its output."""
+        return SCMTool.popen(['cvs', '-f', '-d', self.cvsroot] + args,
+                             self.local_site_name,
+                             cwd=_get_work_dir(),
+                             **kwargs)
 
     def _cat_specific_file(self, filename, revision):
-        # Somehow CVS sometimes seems to write .cvsignore files to current
-        # working directory even though we force stdout with -p.
-        self.tempdir = tempfile.mkdtemp()
-        os.chdir(self.tempdir)
-
-        p = SCMTool.popen(['cvs', '-f', '-d', self.cvsroot, 'checkout',
-                           '-r', str(revision), '-p', filename],
-                          self.local_site_name)
+        p = self._popen(['checkout', '-r', str(revision), '-p', filename])
         contents = p.stdout.read()
         errmsg = p.stderr.read()
         failure = p.wait()
@@ -307,7 +425,6 @@ class CVSClient(object):
         if not errmsg or \
            errmsg.startswith('cvs checkout: cannot find module') or \
            errmsg.startswith('cvs checkout: could not read RCS file'):
-            self.cleanup()
             raise FileNotFoundError(filename, revision)
 
         # Otherwise, if there's an exit code, or errmsg doesn't look like
@@ -317,8 +434,72 @@ class CVSClient(object):
         # stating this. This is safe to ignore.
         if (failure and not errmsg.startswith('==========')) and \
            not ".cvspass does not exist - creating new file" in errmsg:
-            self.cleanup()
             raise SCMError(errmsg)
 
-        self.cleanup()
+        return contents
+
+    def _cat_specific_files(self, filenames, revision):
+        """Checks out several files at one revision with a single call to cvs.
+
+        This returns a dictionary mapping filenames to contents, for each
+        file whose contents could be reliably read.
+
+        stderr is merged into stdout, so each file's contents follow the
+        header cvs writes for it. cvs keeps the two in order by flushing
+        stdout before writing to stderr. Anything else cvs writes to stderr
+        (such as an error for a missing file) would end up appended to the
+        previous file's contents, so a file's contents are only trusted if
+        the next file's header immediately follows them, or if it's the last
+        file and cvs exited successfully. Even then, contents ending in a
+        cvs message (such as a warning) aren't trusted. The rest are left
+        for the caller to fetch individually.
+
+        cvs can't be run with -Q here, since that would also hide the
+        headers.
+        """
+        p = self._popen(['checkout', '-r', revision, '-p'] + filenames,
+                        stderr=subprocess.STDOUT)
+        output = p.stdout.read()
+        failure = p.wait()
+
+        # Find the start and end of each file's header, in order.
+        headers = []
+        pos = 0
+
+        for filename in filenames:
+            start = output.find(CHECKOUT_HEADER % filename, pos)
+
+            if start == -1:
+                headers.append(None)
+                continue
+
+            end = output.find('\n***************\n', start)
+
+            if end == -1:
+                break
+
+            pos = end + len('\n***************\n')
+            headers.append((start, pos))
+
+        contents = {}
+
+        for i, header in enumerate(headers):
+            if header is None:
+                continue
+
+            if i + 1 < len(headers):
+                next_header = headers[i + 1]
+
+                if next_header is None:
+                    continue
+
+                data = output[header[1]:next_header[0]]
+            elif i + 1 == len(filenames) and not failure:
+                data = output[header[1]:]
+            else:
+                continue
+
+            if not CVS_MESSAGE_RE.search(data):
+                contents[filenames[i]] = data
+
         return contents
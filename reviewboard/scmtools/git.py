@@ -1,6 +1,9 @@
 import logging
 import os
 import re
+import subprocess
+import threading
+import time
 import urlparse
 
 # Python 2.5+ provides urllib2.quote, whereas Python 2.4 only
@@ -32,6 +35,296 @@ urlparse.uses_netloc.append('git')
 sshutils.register_rbssh('GIT_SSH')
 
 
+# The maximum number of git cat-file processes of each type that can run
+# at once for a repository.
+CAT_FILE_MAX_WORKERS = 4
+
+# The number of seconds a git cat-file process can sit unused before it's
+# shut down.
+CAT_FILE_IDLE_TIMEOUT = 60
+
+# The number of objects requested from a git cat-file process before reading
+# back the results. This keeps the responses from filling up the pipe while
+# we're still writing requests.
+CAT_FILE_REQUEST_CHUNK_SIZE = 32
+
+
+_cat_file_pools = {}
+_cat_file_pools_lock = threading.Lock()
+_cat_file_reaper_pid = None
+
+
+class GitCatFileError(Exception):
+    """An error communicating with a git cat-file process."""
+    pass
+
+
+class GitCatFileProcess(object):
+    """A long-lived git cat-file process.
+
+    This runs ``git cat-file --batch`` (for fetching objects) or
+    ``git cat-file --batch-check`` (for fetching just their types), and
+    sends it requests for objects over its stdin, reading the results
+    from its stdout. This avoids starting a new git process for every
+    object.
+    """
+    def __init__(self, git_dir, batch_option, local_site_name=None):
+        self.batch_option = batch_option
+        self.last_used = time.time()
+
+        # Nothing reads the process's errors while it's running, so they're
+        # discarded. Otherwise, warnings (such as for ambiguous refnames)
+        # would fill up the pipe, and git would block writing to it.
+        with open(os.devnull, 'w') as devnull:
+            self.process = SCMTool.popen(
+                ['git', '--git-dir=%s' % git_dir, 'cat-file', batch_option],
+                local_site_name=local_site_name,
+                stdin=subprocess.PIPE,
+                stderr=devnull)
+
+    def is_alive(self):
+        """Returns whether the process is still running."""
+        return self.process.poll() is None
+
+    def request(self, object_names):
+        """Requests a list of objects from the process.
+
+        This returns a list of (type, data) tuples, one per object. The type
+        is None for objects that don't exist. The data is only fetched when
+        running with --batch, and is None otherwise.
+
+        GitCatFileError is raised if the process can't be communicated
+        with, such as if it has crashed.
+        """
+        results = []
+
+        for i in xrange(0, len(object_names), CAT_FILE_REQUEST_CHUNK_SIZE):
+            chunk = object_names[i:i + CAT_FILE_REQUEST_CHUNK_SIZE]
+
+            try:
+                self.process.stdin.write(''.join([
+                    '%s\n' % object_name
+                    for object_name in chunk
+                ]))
+                self.process.stdin.flush()
+
+                for object_name in chunk:
+                    results.append(self._read_result())
+            except (IOError, OSError), e:
+                raise GitCatFileError(str(e))
+
+        self.last_used = time.time()
+
+        return results
+
+    def close(self):
+        """Shuts down the process."""
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+
+    def _read_result(self):
+        """Reads the result for one object from the process."""
+        header = self.process.stdout.readline()
+
+        if not header.endswith('\n'):
+            raise GitCatFileError('git cat-file exited unexpectedly')
+
+        parts = header.rstrip('\n').rsplit(' ', 2)
+
+        if len(parts) != 3 or not parts[2].isdigit():
+            # This is a "<object> missing" or "<object> ambiguous" result.
+            return None, None
+
+        object_type = parts[1]
+
+        if self.batch_option != '--batch':
+            return object_type, None
+
+        size = int(parts[2])
+        data = self.process.stdout.read(size + 1)
+
+        if len(data) != size + 1:
+            raise GitCatFileError('git cat-file exited unexpectedly')
+
+        return object_type, data[:-1]
+
+
+class GitCatFilePool(object):
+    """A pool of long-lived git cat-file processes for a repository.
+
+    Processes are started as needed, up to CAT_FILE_MAX_WORKERS running
+    requests at once, and reused for later requests. Processes that have
+    been idle for longer than CAT_FILE_IDLE_TIMEOUT are shut down (see
+    close_expired), and a process that crashes is replaced by a new one.
+    """
+    def __init__(self, git_dir, batch_option, local_site_name=None):
+        self.git_dir = git_dir
+        self.batch_option = batch_option
+        self.local_site_name = local_site_name
+        self._idle_workers = []
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(CAT_FILE_MAX_WORKERS)
+        self._pid = os.getpid()
+
+    def request(self, object_names):
+        """Requests a list of objects from one of the processes.
+
+        See GitCatFileProcess.request for the results. If the process fails,
+        the request is retried once on a new process before raising
+        SCMError.
+        """
+        self._semaphore.acquire()
+
+        try:
+            worker = self._get_worker()
+
+            try:
+                results = worker.request(object_names)
+            except GitCatFileError, e:
+                logging.warning('git cat-file process for %s failed, '
+                                'restarting: %s', self.git_dir, e)
+                worker.close()
+                worker = self._start_worker()
+
+                try:
+                    results = worker.request(object_names)
+                except GitCatFileError, e:
+                    worker.close()
+                    raise SCMError(_('Unable to read from git cat-file: %s')
+                                   % e)
+
+            with self._lock:
+                self._idle_workers.append(worker)
+
+            return results
+        finally:
+            self._semaphore.release()
+
+    def close(self):
+        """Shuts down all idle processes."""
+        with self._lock:
+            self._check_forked()
+            workers = self._idle_workers
+            self._idle_workers = []
+
+        for worker in workers:
+            worker.close()
+
+    def close_expired(self):
+        """Shuts down processes that have been idle for too long."""
+        now = time.time()
+
+        with self._lock:
+            self._check_forked()
+            expired_workers = [
+                worker
+                for worker in self._idle_workers
+                if (not worker.is_alive() or
+                    now - worker.last_used >= CAT_FILE_IDLE_TIMEOUT)
+            ]
+
+            for worker in expired_workers:
+                self._idle_workers.remove(worker)
+
+        for worker in expired_workers:
+            worker.close()
+
+    def _check_forked(self):
+        """Forgets the idle processes if we've been forked.
+
+        The processes belong to the parent process. This must be called
+        with the lock held.
+        """
+        if self._pid != os.getpid():
+            self._idle_workers = []
+            self._pid = os.getpid()
+
+    def _get_worker(self):
+        """Returns an idle process, or starts a new one."""
+        expired_workers = []
+        worker = None
+        now = time.time()
+
+        with self._lock:
+            self._check_forked()
+
+            while self._idle_workers:
+                idle_worker = self._idle_workers.pop()
+
+                if (idle_worker.is_alive() and
+                        now - idle_worker.last_used < CAT_FILE_IDLE_TIMEOUT):
+                    worker = idle_worker
+                    break
+                else:
+                    expired_workers.append(idle_worker)
+
+            # Any workers left have been idle for longer than the one we
+            # picked, so check them for expiration as well.
+            for idle_worker in list(self._idle_workers):
+                if now - idle_worker.last_used >= CAT_FILE_IDLE_TIMEOUT:
+                    self._idle_workers.remove(idle_worker)
+                    expired_workers.append(idle_worker)
+
+        for expired_worker in expired_workers:
+            expired_worker.close()
+
+        return worker or self._start_worker()
+
+    def _start_worker(self):
+        """Starts a new git cat-file process."""
+        return GitCatFileProcess(self.git_dir, self.batch_option,
+                                 self.local_site_name)
+
+
+def get_cat_file_pool(git_dir, batch_option, local_site_name=None):
+    """Returns the shared GitCatFilePool for a repository.
+
+    This also makes sure a thread is running in this process to shut down
+    idle processes in all the pools.
+    """
+    global _cat_file_reaper_pid
+
+    key = (git_dir, batch_option, local_site_name)
+
+    with _cat_file_pools_lock:
+        if _cat_file_reaper_pid != os.getpid():
+            thread = threading.Thread(target=_reap_cat_file_processes)
+            thread.setDaemon(True)
+            thread.start()
+            _cat_file_reaper_pid = os.getpid()
+
+        if key not in _cat_file_pools:
+            _cat_file_pools[key] = GitCatFilePool(git_dir, batch_option,
+                                                  local_site_name)
+
+        return _cat_file_pools[key]
+
+
+def _reap_cat_file_processes():
+    """Periodically shuts down idle git cat-file processes.
+
+    Pools only check for idle processes when they're used, so this keeps
+    processes from pools that are no longer being used from running
+    forever.
+    """
+    while True:
+        time.sleep(CAT_FILE_IDLE_TIMEOUT)
+
+        with _cat_file_pools_lock:
+            pools = _cat_file_pools.values()
+
+        for pool in pools:
+            try:
+                pool.close_expired()
+            except Exception, e:
+                logging.error('Unable to shut down idle git cat-file '
+                              'processes for %s: %s',
+                              pool.git_dir, e)
+
+
 class ShortSHA1Error(InvalidRevisionFormatError):
     def __init__(self, path, revision, *args, **kwargs):
         InvalidRevisionFormatError.__init__(
@@ -79,6 +372,25 @@ class GitTool(SCMTool):
 
         return self.client.get_file(path, revision)
 
+    def get_files(self, paths_and_revisions):
+        results = [''] * len(paths_and_revisions)
+        indexes = [
+            i
+            for i, (path, revision) in enumerate(paths_and_revisions)
+            if revision != PRE_CREATION
+        ]
+
+        if indexes:
+            files_data = self.client.get_files([
+                paths_and_revisions[i]
+                for i in indexes
+            ])
+
+            for i, data in zip(indexes, files_data):
+                results[i] = data
+
+        return results
+
     def file_exists(self, path, revision=HEAD):
         if revision == PRE_CREATION:
             return False
@@ -88,6 +400,25 @@ class GitTool(SCMTool):
         except (FileNotFoundError, InvalidRevisionFormatError):
             return False
 
+    def files_exist(self, paths_and_revisions):
+        results = [False] * len(paths_and_revisions)
+        indexes = [
+            i
+            for i, (path, revision) in enumerate(paths_and_revisions)
+            if revision != PRE_CREATION
+        ]
+
+        if indexes:
+            exists = self.client.get_files_exist([
+                paths_and_revisions[i]
+                for i in indexes
+            ])
+
+            for i, file_exists in zip(indexes, exists):
+                results[i] = file_exists
+
+        return results
+
     def parse_diff_revision(self, file_str, revision_str, moved=False,
                             *args, **kwargs):
         revision = revision_str
@@ -148,7 +479,7 @@ class GitDiffParser(DiffParser):
         """
         self.files = []
         i = 0
-        preamble = ''
+        preamble_start = 0
 
         while i < len(self.lines):
             next_i, file_info, new_diff = self._parse_diff(i)
@@ -156,21 +487,22 @@ class GitDiffParser(DiffParser):
             if file_info:
                 self._ensure_file_has_required_fields(file_info)
 
-                if preamble:
-                    file_info.data = preamble + file_info.data
-                    preamble = ''
+                if preamble_start < i:
+                    file_info.data = (self.get_lines_data(preamble_start, i) +
+                                      file_info.data)
 
                 self.files.append(file_info)
+                preamble_start = next_i
             elif new_diff:
                 # We found a diff, but it was empty and has no file entry.
                 # Reset the preamble.
-                preamble = ''
-            else:
-                preamble += self.lines[i] + '\n'
+                preamble_start = next_i
 
             i = next_i
 
-        if not self.files and preamble.strip() != '':
+        if (not self.files and
+                self.get_lines_data(preamble_start,
+                                    len(self.lines)).strip() != ''):
             # This is probably not an actual git diff file.
             raise DiffParserError('This does not appear to be a git diff', 0)
 
@@ -198,7 +530,7 @@ class GitDiffParser(DiffParser):
 
         # Now we have a diff we are going to use so get the filenames + commits
         file_info = File()
-        file_info.data = self.lines[linenum] + "\n"
+        file_info.append_lines(self, linenum, linenum + 1)
         file_info.binary = False
         diff_line = self.lines[linenum].split()
 
@@ -215,20 +547,17 @@ class GitDiffParser(DiffParser):
         # Parse the extended header to save the new file, deleted file,
         # mode change, file move, and index.
         if self._is_new_file(linenum):
-            file_info.data += self.lines[linenum] + "\n"
+            file_info.append_lines(self, linenum, linenum + 1)
             linenum += 1
         elif self._is_deleted_file(linenum):
-            file_info.data += self.lines[linenum] + "\n"
+            file_info.append_lines(self, linenum, linenum + 1)
             linenum += 1
             file_info.deleted = True
         elif self._is_mode_change(linenum):
-            file_info.data += self.lines[linenum] + "\n"
-            file_info.data += self.lines[linenum + 1] + "\n"
+            file_info.append_lines(self, linenum, linenum + 2)
             linenum += 2
         elif self._is_moved_file(linenum):
-            file_info.data += self.lines[linenum] + "\n"
-            file_info.data += self.lines[linenum + 1] + "\n"
-            file_info.data += self.lines[linenum + 2] + "\n"
+            file_info.append_lines(self, linenum, linenum + 3)
             linenum += 3
             file_info.moved = True
 
@@ -249,7 +578,7 @@ class GitDiffParser(DiffParser):
             if self.pre_creation_regexp.match(file_info.origInfo):
                 file_info.origInfo = PRE_CREATION
 
-            file_info.data += self.lines[linenum] + "\n"
+            file_info.append_lines(self, linenum, linenum + 1)
             linenum += 1
 
         # Get the changes
@@ -258,7 +587,7 @@ class GitDiffParser(DiffParser):
                 break
             elif self._is_binary_patch(linenum):
                 file_info.binary = True
-                file_info.data += self.lines[linenum] + "\n"
+                file_info.append_lines(self, linenum, linenum + 1)
                 empty_change = False
                 linenum += 1
                 break
@@ -266,8 +595,7 @@ class GitDiffParser(DiffParser):
                 if self.lines[linenum].split()[1] == "/dev/null":
                     file_info.origInfo = PRE_CREATION
 
-                file_info.data += self.lines[linenum] + '\n'
-                file_info.data += self.lines[linenum + 1] + '\n'
+                file_info.append_lines(self, linenum, linenum + 2)
                 linenum += 2
             else:
                 empty_change = False
@@ -391,6 +719,38 @@ class GitClient(SCMClient):
         else:
             return self._cat_file(path, revision, "blob")
 
+    def get_files(self, paths_and_revisions):
+        """Returns the contents of each of a list of files.
+
+        This takes a list of (path, revision) tuples, and returns a list of
+        file contents in the same order. For local repositories, all the
+        files are fetched in one request to a git cat-file process.
+        """
+        if self.raw_file_url or not self.git_dir:
+            return [
+                self.get_file(path, revision)
+                for path, revision in paths_and_revisions
+            ]
+
+        object_names = []
+
+        for path, revision in paths_and_revisions:
+            object_name = self._resolve_head(revision, path)
+
+            if not object_name or '\n' in object_name:
+                raise FileNotFoundError(object_name)
+
+            object_names.append(object_name)
+
+        pool = get_cat_file_pool(self.git_dir, '--batch',
+                                 self.local_site_name)
+
+        return [
+            self._get_blob_data(blob_name, object_type, data)
+            for blob_name, (object_type, data) in zip(
+                object_names, pool.request(object_names))
+        ]
+
     def get_file_exists(self, path, revision):
         if self.raw_file_url:
             try:
@@ -407,6 +767,46 @@ class GitClient(SCMClient):
             contents = self._cat_file(path, revision, "-t")
             return contents and contents.strip() == "blob"
 
+    def get_files_exist(self, paths_and_revisions):
+        """Returns whether each of a list of files exists.
+
+        This takes a list of (path, revision) tuples, and returns a list of
+        booleans in the same order. For local repositories, all the files
+        are checked in one request to a git cat-file process.
+        """
+        if self.raw_file_url or not self.git_dir:
+            results = []
+
+            for path, revision in paths_and_revisions:
+                try:
+                    results.append(bool(self.get_file_exists(path, revision)))
+                except (FileNotFoundError, InvalidRevisionFormatError):
+                    results.append(False)
+
+            return results
+
+        results = [False] * len(paths_and_revisions)
+        indexes = []
+        object_names = []
+
+        for i, (path, revision) in enumerate(paths_and_revisions):
+            object_name = self._resolve_head(revision, path)
+
+            # Names that can't be sent to git cat-file can't exist.
+            if object_name and '\n' not in object_name:
+                indexes.append(i)
+                object_names.append(object_name)
+
+        if object_names:
+            pool = get_cat_file_pool(self.git_dir, '--batch-check',
+                                     self.local_site_name)
+
+            for i, (object_type, data) in zip(indexes,
+                                              pool.request(object_names)):
+                results[i] = (object_type == 'blob')
+
+        return results
+
     def validate_sha1_format(self, path, sha1):
         """Validates that a SHA1 is of the right length for this repository."""
         if self.raw_file_url and len(sha1) != self.FULL_SHA1_LENGTH:
@@ -436,6 +836,9 @@ class GitClient(SCMClient):
         """
         commit = self._resolve_head(revision, path)
 
+        if self.git_dir and option in ('blob', '-t'):
+            return self._cat_file_from_pool(commit, option)
+
         p = self._run_git(['--git-dir=%s' % self.git_dir, 'cat-file',
                            option, commit])
         contents = p.stdout.read()
@@ -450,6 +853,48 @@ class GitClient(SCMClient):
 
         return contents
 
+    def _cat_file_from_pool(self, commit, option):
+        """Gets the content or type of an object from a git cat-file pool.
+
+        This behaves like _cat_file, but uses a long-lived git cat-file
+        process instead of starting a new one.
+        """
+        if not commit or '\n' in commit:
+            raise FileNotFoundError(commit)
+
+        if option == 'blob':
+            batch_option = '--batch'
+        else:
+            batch_option = '--batch-check'
+
+        pool = get_cat_file_pool(self.git_dir, batch_option,
+                                 self.local_site_name)
+        object_type, data = pool.request([commit])[0]
+
+        if option == 'blob':
+            return self._get_blob_data(commit, object_type, data)
+        elif object_type is None:
+            raise FileNotFoundError(commit)
+        else:
+            return object_type + '\n'
+
+    def _get_blob_data(self, object_name, object_type, data):
+        """Returns the data for a blob read from a git cat-file process.
+
+        FileNotFoundError is raised if the object doesn't exist, and
+        SCMError is raised if it isn't a blob.
+        """
+        if object_type is None:
+            raise FileNotFoundError(object_name)
+        elif object_type != 'blob':
+            raise SCMError(_('%(object)s is a %(type)s, not a blob')
+                           % {
+                               'object': object_name,
+                               'type': object_type,
+                           })
+
+        return data
+
     def _resolve_head(self, revision, path):
         if revision == HEAD:
             if path == "":
@@ -1,5 +1,7 @@
+from __future__ import with_statement
 import logging
 import re
+import threading
 
 try:
     from urllib2 import quote as urllib_quote
@@ -11,10 +13,49 @@ from pkg_resources import parse_version
 from reviewboard.diffviewer.parser import DiffParser, DiffParserError
 from reviewboard.scmtools.git import GitDiffParser
 from reviewboard.scmtools.core import \
-    FileNotFoundError, SCMClient, SCMTool, HEAD, PRE_CREATION, UNKNOWN
+    FileNotFoundError, LRUCache, SCMClient, SCMTool, HEAD, PRE_CREATION, \
+    UNKNOWN
 from reviewboard.scmtools.errors import RepositoryNotFoundError
 
 
+# The maximum number of opened Mercurial repositories (and hgweb clients)
+# kept around by each process.
+MAX_HG_CLIENT_CACHE_SIZE = 16
+
+# The maximum number of changeset contexts kept around for each opened
+# repository.
+MAX_CHANGECTX_CACHE_SIZE = 64
+
+
+_hg_clients = LRUCache(MAX_HG_CLIENT_CACHE_SIZE)
+
+
+def get_hg_client(path, local_site_name=None, username=None, password=None):
+    """Returns a client for a Mercurial repository.
+
+    Opening a repository means reading and parsing its revlog indexes, so
+    clients are kept around and shared by every HgTool for the same
+    repository. They're keyed off the repository's configuration, so a
+    client is never reused once the path, Local Site or credentials change.
+    """
+    if path.startswith('http'):
+        key = ('web', path, username, password)
+    else:
+        key = ('local', path, local_site_name)
+
+    client = _hg_clients.get(key)
+
+    if client is None:
+        if path.startswith('http'):
+            client = HgWebClient(path, username, password)
+        else:
+            client = HgClient(path, local_site_name)
+
+        _hg_clients.set(key, client)
+
+    return client
+
+
 class HgTool(SCMTool):
     name = "Mercurial"
     supports_authentication = True
@@ -24,18 +65,26 @@ class HgTool(SCMTool):
 
     def __init__(self, repository):
         SCMTool.__init__(self, repository)
-        if repository.path.startswith('http'):
-            self.client = HgWebClient(repository.path,
-                                      repository.username,
-                                      repository.password)
+
+        if repository.local_site:
+            local_site_name = repository.local_site.name
         else:
-            self.client = HgClient(repository.path, repository.local_site)
+            local_site_name = None
+
+        self.client = get_hg_client(repository.path, local_site_name,
+                                    repository.username, repository.password)
 
         self.uses_atomic_revisions = True
 
     def get_file(self, path, revision=HEAD):
         return self.client.cat_file(path, str(revision))
 
+    def get_files(self, paths_and_revisions):
+        return self.client.cat_files([
+            (path, str(revision))
+            for path, revision in paths_and_revisions
+        ])
+
     def parse_diff_revision(self, file_str, revision_str, *args, **kwargs):
         revision = revision_str
         if file_str == "/dev/null":
@@ -222,6 +271,12 @@ class HgWebClient(SCMClient):
 
         raise FileNotFoundError(path, rev)
 
+    def cat_files(self, paths_and_revisions):
+        return [
+            self.cat_file(path, rev)
+            for path, rev in paths_and_revisions
+        ]
+
 
 class HgClient(object):
     def __init__(self, repoPath, local_site):
@@ -276,15 +331,68 @@ class HgClient(object):
                           % (repoPath, e))
             raise RepositoryNotFoundError
 
+        # The repository is shared between threads, and isn't thread-safe.
+        self._lock = threading.Lock()
+        self._changectxs = LRUCache(MAX_CHANGECTX_CACHE_SIZE)
+
     def cat_file(self, path, rev="tip"):
-        if rev == HEAD:
-            rev = "tip"
-        elif rev == PRE_CREATION:
-            rev = ""
+        return self.cat_files([(path, rev)])[0]
+
+    def cat_files(self, paths_and_revisions):
+        """Returns the contents of several files.
+
+        The changeset context for each revision is only looked up once,
+        and shared by all the files at that revision.
+        """
+        changectxs = {}
+        results = []
+
+        with self._lock:
+            for path, rev in paths_and_revisions:
+                if rev == HEAD:
+                    rev = "tip"
+                elif rev == PRE_CREATION:
+                    rev = ""
+
+                try:
+                    if rev not in changectxs:
+                        changectxs[rev] = self._get_changectx(rev)
+
+                    results.append(changectxs[rev].filectx(path).data())
+                except Exception, e:
+                    # LookupError moves from repo to revlog in hg v0.9.4, so
+                    # we catch the more general Exception to avoid the
+                    # dependency.
+                    raise FileNotFoundError(path, rev, detail=str(e))
+
+        return results
+
+    def _get_changectx(self, rev):
+        """Returns the changeset context for a revision.
+
+        Contexts for changeset IDs never change, so they're remembered for
+        later lookups. Contexts for anything else, such as "tip" or branch
+        names, are looked up every time.
+
+        Since the repository is kept open between requests, it may not know
+        about changesets added since it was opened. If the revision can't
+        be found, the repository is reloaded and the lookup is tried again.
+        """
+        changectx = self._changectxs.get(rev)
+
+        if changectx is not None:
+            return changectx
 
         try:
-            return self.repo.changectx(rev).filectx(path).data()
-        except Exception, e:
-            # LookupError moves from repo to revlog in hg v0.9.4, so we
-            # catch the more general Exception to avoid the dependency.
-            raise FileNotFoundError(path, rev, detail=str(e))
+            changectx = self.repo.changectx(rev)
+        except Exception:
+            if not hasattr(self.repo, 'invalidate'):
+                raise
+
+            self.repo.invalidate()
+            changectx = self.repo.changectx(rev)
+
+        if rev and changectx.hex().startswith(rev):
+            self._changectxs.set(rev, changectx)
+
+        return changectx
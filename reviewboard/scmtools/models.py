@@ -1,7 +1,13 @@
+from __future__ import with_statement
+import json
+import logging
+import thread
+import urlparse
+
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
-from django.db import models
+from django.db import connections, models
 from django.utils.http import urlquote
 from django.utils.translation import ugettext_lazy as _
 from djblets.log import log_timed
@@ -9,6 +15,7 @@ from djblets.util.fields import JSONField
 from djblets.util.misc import cache_memoize, make_cache_key
 
 from reviewboard.hostingsvcs.models import HostingServiceAccount
+from reviewboard.scmtools.core import KeyedThreadPool, LRUCache, SCMTool
 from reviewboard.scmtools.managers import RepositoryManager, ToolManager
 from reviewboard.scmtools.signals import (checked_file_exists,
                                           checking_file_exists,
@@ -16,6 +23,36 @@ from reviewboard.scmtools.signals import (checked_file_exists,
 from reviewboard.site.models import LocalSite
 
 
+# The maximum number of file existence checks made at once across all hosts,
+# for repositories that can't check many files in one request.
+FILE_EXISTS_MAX_WORKERS = 8
+
+# The maximum number of file existence checks made against a single host at
+# once.
+FILE_EXISTS_MAX_WORKERS_PER_HOST = 4
+
+# The maximum number of SCMTool instances kept around by each process.
+MAX_SCMTOOL_CACHE_SIZE = 64
+
+
+_file_exists_pool = KeyedThreadPool(FILE_EXISTS_MAX_WORKERS,
+                                    FILE_EXISTS_MAX_WORKERS_PER_HOST)
+
+def _close_cached_scmtool(key, value):
+    """Shuts down an SCMTool that's been removed from the cache."""
+    config, tool = value
+
+    try:
+        tool.close()
+    except Exception, e:
+        logging.error('Unable to close SCMTool %r for repository %s: %s',
+                      tool, key[0], e, exc_info=1)
+
+
+_scmtool_cache = LRUCache(MAX_SCMTOOL_CACHE_SIZE,
+                          on_remove=_close_cached_scmtool)
+
+
 class Tool(models.Model):
     name = models.CharField(max_length=32, unique=True)
     class_name = models.CharField(max_length=128, unique=True)
@@ -142,10 +179,53 @@ class Repository(models.Model):
 
     BRANCHES_CACHE_PERIOD = 60 * 5  # 5 minutes
     COMMITS_CACHE_PERIOD = 60 * 60 * 24  # 1 day
+    COMMITS_PAGE_SIZE = 30
 
     def get_scmtool(self):
-        cls = self.tool.get_scmtool_class()
-        return cls(self)
+        """Returns an SCMTool instance for this repository.
+
+        Setting up an SCMTool can mean creating clients, logging in or
+        spawning processes, so instances are kept around and reused for
+        saved repositories. SCMTools aren't thread-safe, so each thread
+        gets its own instance. An instance is only reused while the
+        repository's configuration matches the one it was created with.
+
+        Saving the repository discards the instances in every process.
+        Discarded instances are shut down through SCMTool.close.
+        """
+        if self.pk is None:
+            return self.tool.get_scmtool_class()(self)
+
+        key = (self.pk, thread.get_ident())
+        config = (self._get_scmtool_config(),
+                  cache.get(self._make_scmtool_serial_cache_key()))
+        cached = _scmtool_cache.get(key)
+
+        if cached is not None and cached[0] == config:
+            return cached[1]
+
+        tool = self.tool.get_scmtool_class()(self)
+        _scmtool_cache.set(key, (config, tool))
+
+        return tool
+
+    def save(self, *args, **kwargs):
+        super(Repository, self).save(*args, **kwargs)
+
+        # Other processes notice the new serial number the next time they
+        # look up an SCMTool for the repository.
+        serial_key = self._make_scmtool_serial_cache_key()
+        cache.add(serial_key, 0)
+
+        try:
+            cache.incr(serial_key)
+        except ValueError:
+            # The key was evicted after being added.
+            cache.set(serial_key, 1)
+
+        for key in _scmtool_cache.keys():
+            if key[0] == self.pk:
+                _scmtool_cache.delete(key)
 
     @property
     def hosting_service(self):
@@ -190,6 +270,104 @@ class Repository(models.Model):
                                              request)],
             large_data=True)[0]
 
+    def get_files(self, paths_and_revisions, base_commit_id=None,
+                  request=None):
+        """Returns a list of files from the repository.
+
+        This takes a list of (path, revision) tuples, and returns the
+        contents of each file in the same order.
+
+        Files that aren't already in the cache are fetched together through
+        the SCMTool's get_files, so that SCMTools that can fetch many files
+        at once only need one round trip. If the repository is backed by a
+        hosting service, the files are fetched through that instead.
+
+        Each file is cached just as if it was fetched through get_file.
+        """
+        results = [None] * len(paths_and_revisions)
+
+        # Each uncached file is only fetched once, even if it was listed
+        # more than once. This maps each one to its indexes in the results.
+        uncached = {}
+        uncached_paths_and_revisions = []
+
+        for i, (path, revision) in enumerate(paths_and_revisions):
+            path_and_revision = (path, revision)
+            key = self._make_file_cache_key(path, revision, base_commit_id)
+
+            if cache.has_key(make_cache_key(key)):
+                results[i] = self.get_file(path, revision,
+                                           base_commit_id=base_commit_id,
+                                           request=request)
+            else:
+                if path_and_revision not in uncached:
+                    uncached[path_and_revision] = []
+                    uncached_paths_and_revisions.append(path_and_revision)
+
+                uncached[path_and_revision].append(i)
+
+        if not uncached:
+            return results
+
+        for path, revision in uncached_paths_and_revisions:
+            fetching_file.send(sender=self,
+                               path=path,
+                               revision=revision,
+                               base_commit_id=base_commit_id,
+                               request=request)
+
+        log_timer = log_timed("Fetching %d files from %s"
+                              % (len(uncached_paths_and_revisions), self),
+                              request=request)
+
+        hosting_service = self.hosting_service
+
+        if hosting_service:
+            files_data = [
+                hosting_service.get_file(
+                    self,
+                    path,
+                    revision,
+                    base_commit_id=base_commit_id)
+                for path, revision in uncached_paths_and_revisions
+            ]
+        else:
+            files_data = self.get_scmtool().get_files(
+                uncached_paths_and_revisions)
+
+        log_timer.done()
+
+        for (path, revision), data in zip(uncached_paths_and_revisions,
+                                          files_data):
+            fetched_file.send(sender=self,
+                              path=path,
+                              revision=revision,
+                              base_commit_id=base_commit_id,
+                              request=request,
+                              data=data)
+
+            self.cache_file(path, revision, data, base_commit_id)
+
+            for i in uncached[(path, revision)]:
+                results[i] = data
+
+        return results
+
+    def cache_file(self, path, revision, data, base_commit_id=None):
+        """Stores the contents of a file in the cache.
+
+        Later calls to get_file and get_files for the file will use the
+        cached contents, rather than fetching it from the repository. This
+        lets hosting services that had to download a file in order to check
+        that it exists save it for when it's needed.
+        """
+        # As in get_file, the data is wrapped in a list to keep the cache
+        # backend from converting it to unicode.
+        cache_memoize(
+            self._make_file_cache_key(path, revision, base_commit_id),
+            lambda: [data],
+            large_data=True)
+
     def get_file_exists(self, path, revision, base_commit_id=None,
                         request=None):
         """Returns whether or not a file exists in the repository.
@@ -214,6 +392,103 @@ class Repository(models.Model):
 
         return exists
 
+    def get_files_exist(self, paths_and_revisions, base_commit_id=None,
+                        request=None):
+        """Returns whether each of a list of files exists in the repository.
+
+        This takes a list of (path, revision) tuples, and returns a list of
+        booleans in the same order.
+
+        Files already known to exist are looked up in the cache. The rest
+        are checked together through the SCMTool's files_exist, so that
+        SCMTools that can check many files at once only need one round
+        trip. If the repository is backed by a hosting service, the files
+        are checked through that instead.
+
+        As with get_file_exists, the files found to exist will be cached.
+        """
+        results = [False] * len(paths_and_revisions)
+        uncached = []
+
+        for i, (path, revision) in enumerate(paths_and_revisions):
+            key = self._make_file_exists_cache_key(path, revision,
+                                                   base_commit_id)
+            file_cache_key = self._make_file_cache_key(path, revision,
+                                                       base_commit_id)
+
+            if (cache.get(make_cache_key(key)) == '1' or
+                    cache.has_key(make_cache_key(file_cache_key))):
+                results[i] = True
+            else:
+                uncached.append(i)
+
+        if not uncached:
+            return results
+
+        uncached_paths_and_revisions = [
+            paths_and_revisions[i]
+            for i in uncached
+        ]
+
+        for path, revision in uncached_paths_and_revisions:
+            checking_file_exists.send(sender=self,
+                                      path=path,
+                                      revision=revision,
+                                      base_commit_id=base_commit_id,
+                                      request=request)
+
+        log_timer = log_timed("Checking whether %d files exist in %s"
+                              % (len(uncached), self),
+                              request=request)
+
+        hosting_service = self.hosting_service
+
+        if hosting_service:
+            files_exist = self._check_files_exist_concurrently(
+                lambda path, revision: hosting_service.get_file_exists(
+                    self,
+                    path,
+                    revision,
+                    base_commit_id=base_commit_id),
+                uncached_paths_and_revisions)
+        else:
+            tool = self.get_scmtool()
+
+            if (len(uncached_paths_and_revisions) > 1 and
+                tool.__class__.files_exist.im_func is
+                    SCMTool.files_exist.im_func):
+                # This SCMTool can only check one file at a time, so check
+                # them concurrently instead. get_scmtool gives each thread
+                # its own SCMTool.
+                files_exist = self._check_files_exist_concurrently(
+                    lambda path, revision:
+                        self.get_scmtool().file_exists(path, revision),
+                    uncached_paths_and_revisions)
+            else:
+                files_exist = tool.files_exist(uncached_paths_and_revisions)
+
+        log_timer.done()
+
+        for i, exists in zip(uncached, files_exist):
+            path, revision = paths_and_revisions[i]
+
+            checked_file_exists.send(sender=self,
+                                     path=path,
+                                     revision=revision,
+                                     base_commit_id=base_commit_id,
+                                     request=request,
+                                     exists=exists)
+
+            if exists:
+                cache_memoize(
+                    self._make_file_exists_cache_key(path, revision,
+                                                     base_commit_id),
+                    lambda: '1')
+
+            results[i] = exists
+
+        return results
+
     def get_branches(self):
         """Returns a list of branches."""
         hosting_service = self.hosting_service
@@ -235,25 +510,52 @@ class Repository(models.Model):
 
         This is paginated via the 'start' parameter. Any exceptions are
         expected to be handled by the caller.
-        """
-        hosting_service = self.hosting_service
 
-        cache_key = make_cache_key('repository-commits:%s:%s' % (self.pk, start))
-        if hosting_service:
-            commits_callable = lambda: hosting_service.get_commits(self, start)
-        else:
-            commits_callable = lambda: self.get_scmtool().get_commits(start)
-
-        # We cache both the entire list for 'start', as well as each individual
-        # commit. This allows us to reduce API load when people are looking at
-        # the "new review request" page more frequently than they're pushing
-        # code, and will usually save 1 API request when they go to actually
-        # create a new review request.
-        commits = cache_memoize(cache_key, commits_callable)
+        Every commit fetched from the repository is cached individually,
+        forming an index of the repository's history. A page is built by
+        following each commit's parent through the index, and only the
+        commits missing from it are fetched from the repository. After a
+        push, that means fetching just the new commits.
 
-        for commit in commits:
-            cache.set(self.get_commit_cache_key(commit.id),
-                      commit, self.COMMITS_CACHE_PERIOD)
+        Without a 'start', the history is listed from the head of the
+        default branch, if the repository can list its branches.
+        """
+        if not start:
+            start = self._get_default_branch_head()
+
+        if not start:
+            # There's no way of knowing where this page starts until the
+            # repository has been asked, so the page can only be cached as
+            # long as the list of branches.
+            commits = cache_memoize(
+                'repository-commits:%s:%s' % (self.pk, start),
+                lambda: self._get_commits_uncached(start),
+                self.BRANCHES_CACHE_PERIOD)
+            self._add_commits_to_index(commits)
+
+            return commits
+
+        commits = []
+        commit_id = start
+
+        while commit_id and len(commits) < self.COMMITS_PAGE_SIZE:
+            commit = cache.get(self.get_commit_cache_key(commit_id))
+
+            if commit is None:
+                fetched_commits = self._get_commits_uncached(commit_id)
+                self._add_commits_to_index(fetched_commits)
+
+                for fetched_commit in fetched_commits:
+                    if fetched_commit.id == commit_id:
+                        commit = fetched_commit
+                        break
+                else:
+                    # The repository doesn't know about this commit, which
+                    # means we've reached the start of the history.
+                    break
+
+            commits.append(commit)
+            commit_id = commit.parent
 
         return commits
 
@@ -297,6 +599,55 @@ class Repository(models.Model):
     def __unicode__(self):
         return self.name
 
+    def _make_scmtool_serial_cache_key(self):
+        """Makes a cache key for the serial number of the SCMTools.
+
+        The serial number is changed whenever the repository is saved.
+        """
+        return make_cache_key('repository-scmtool-serial:%s' % self.pk)
+
+    def _get_scmtool_config(self):
+        """Returns the configuration used to set up an SCMTool."""
+        return (self.tool_id, self.path, self.mirror_path, self.raw_file_url,
+                self.username, self.password, self.encoding,
+                self.local_site_id, self.hosting_account_id,
+                json.dumps(self.extra_data or {}, sort_keys=True))
+
+    def _get_commits_uncached(self, start):
+        """Fetches a page of commits from the repository."""
+        hosting_service = self.hosting_service
+
+        if hosting_service:
+            return hosting_service.get_commits(self, start)
+        else:
+            return self.get_scmtool().get_commits(start)
+
+    def _add_commits_to_index(self, commits):
+        """Adds commits to the cached index of the repository's history.
+
+        Each commit is cached individually, which also saves a request when
+        one is used to create a new review request.
+        """
+        for commit in commits:
+            cache.set(self.get_commit_cache_key(commit.id),
+                      commit, self.COMMITS_CACHE_PERIOD)
+
+    def _get_default_branch_head(self):
+        """Returns the ID of the commit at the head of the default branch.
+
+        This returns None if the repository can't list its branches.
+        """
+        try:
+            branches = self.get_branches()
+        except NotImplementedError:
+            return None
+
+        for branch in branches:
+            if branch.default:
+                return branch.commit
+
+        return None
+
     def _make_file_cache_key(self, path, revision, base_commit_id):
         """Makes a cache key for fetched files."""
         return "file:%s:%s:%s:%s" % (self.pk, urlquote(path),
@@ -351,6 +702,50 @@ class Repository(models.Model):
 
         return data
 
+    def _check_files_exist_concurrently(self, file_exists,
+                                        paths_and_revisions):
+        """Checks whether several files exist, using a pool of threads.
+
+        file_exists is called with the path and revision of each file, and
+        the results are returned in the same order as paths_and_revisions.
+
+        At most FILE_EXISTS_MAX_WORKERS_PER_HOST checks are made against
+        the repository's host at once. Checks waiting on a busy host don't
+        hold any threads, so they never hold up checks for other hosts.
+
+        If any checks fail, the error for the first of those files is
+        raised, regardless of the order the checks finished in.
+        """
+        if len(paths_and_revisions) < 2:
+            return [
+                file_exists(path, revision)
+                for path, revision in paths_and_revisions
+            ]
+
+        results = _file_exists_pool.map(
+            self._get_host(),
+            _check_file_exists_in_thread,
+            [
+                (file_exists, path, revision)
+                for path, revision in paths_and_revisions
+            ])
+
+        for exists, error in results:
+            if error is not None:
+                raise error
+
+        return [exists for exists, error in results]
+
+    def _get_host(self):
+        """Returns the host that the repository is accessed through."""
+        hosting_account = self.hosting_account
+
+        if hosting_account:
+            return (hosting_account.service_name,
+                    hosting_account.hosting_url or '')
+
+        return urlparse.urlparse(self.path)[1] or self.path
+
     def _get_file_exists_uncached(self, path, revision, base_commit_id,
                                   request):
         """Internal function for checking that a file exists.
@@ -403,3 +798,22 @@ class Repository(models.Model):
         # the tables and enforce it in code whenever visible=True
         unique_together = (('name', 'local_site'),
                            ('path', 'local_site'))
+
+
+def _check_file_exists_in_thread(args):
+    """Checks whether a file exists, within a thread pool worker.
+
+    This returns a tuple of the result and any error raised, so that errors
+    can be raised in a predictable order once all the checks have finished.
+    """
+    file_exists, path, revision = args
+
+    try:
+        return file_exists(path, revision), None
+    except Exception, e:
+        return False, e
+    finally:
+        # Each thread opens its own database connections, which would
+        # otherwise stay open for the life of the thread.
+        for connection in connections.all():
+            connection.close()
@@ -6,13 +6,15 @@ import signal
 import socket
 import subprocess
 import tempfile
+import threading
 import time
 
 from djblets.util.filesystem import is_exe_in_path
 try:
     from P4 import P4Exception
 except ImportError:
-    pass
+    class P4Exception(Exception):
+        pass
 
 from reviewboard.diffviewer.parser import DiffParser
 from reviewboard.scmtools.certs import Certificate
@@ -20,12 +22,25 @@ from reviewboard.scmtools.core import (SCMTool, ChangeSet,
                                        HEAD, PRE_CREATION)
 from reviewboard.scmtools.errors import (SCMError, EmptyChangeSetError,
                                          AuthenticationError,
+                                         FileNotFoundError,
                                          RepositoryNotFoundError,
                                          UnverifiedCertificateError)
 
 
 STUNNEL_SERVER, STUNNEL_CLIENT = (0, 1)
 
+# The maximum number of idle connections kept for each Perforce server and
+# user.
+PERFORCE_MAX_IDLE_CONNECTIONS = 4
+
+# The number of seconds an idle connection is kept around before it's
+# closed.
+PERFORCE_IDLE_TIMEOUT = 300
+
+# The number of seconds an idle connection can go unused before we make
+# sure it still works before using it again.
+PERFORCE_HEALTH_CHECK_INTERVAL = 30
+
 
 class STunnelProxy(object):
     def __init__(self, mode, target):
@@ -68,6 +83,17 @@ class STunnelProxy(object):
             os.kill(self.pid, signal.SIGTERM)
             self.pid = None
 
+    def is_running(self):
+        """Returns whether the stunnel process is still running."""
+        if not self.pid:
+            return False
+
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
     def _find_port(self):
         """Find an available port."""
         # This is slightly racy but shouldn't be too bad.
@@ -83,9 +109,16 @@ class STunnelProxy(object):
                 pass
 
 
-class PerforceClient(object):
-    def __init__(self, p4port, username, password, encoding, use_stunnel=False,
-                 use_ticket_auth=False):
+class PerforceConnection(object):
+    """A connection to a Perforce server.
+
+    This wraps a P4 object, along with the stunnel proxy it connects
+    through, if any. Connections are kept open in a PerforceConnectionPool
+    and reused between commands.
+    """
+    def __init__(self, p4, p4port, username, password, encoding,
+                 use_stunnel=False, use_ticket_auth=False):
+        self.p4 = p4
         self.p4port = p4port
         self.username = username
         self.password = password
@@ -93,15 +126,10 @@ class PerforceClient(object):
         self.use_stunnel = use_stunnel
         self.use_ticket_auth = use_ticket_auth
         self.proxy = None
+        self.logged_in = False
+        self.last_used = time.time()
 
-        import P4
-        self.p4 = P4.P4()
-
-        if use_stunnel and not is_exe_in_path('stunnel'):
-            raise AttributeError('stunnel proxy was requested, but stunnel '
-                                 'binary is not in the exec path.')
-
-    def _connect(self):
+    def connect(self):
         """
         Connect to the perforce server.
 
@@ -124,9 +152,14 @@ class PerforceClient(object):
         self.p4.connect()
 
         if self.use_ticket_auth:
-            self.p4.run_login()
+            self.login()
+
+    def login(self):
+        """Logs in, getting a ticket used by the following commands."""
+        self.p4.run_login()
+        self.logged_in = True
 
-    def _disconnect(self):
+    def disconnect(self):
         """
         Disconnect from the perforce server, and also shut down the stunnel
         proxy (if it exists).
@@ -134,7 +167,7 @@ class PerforceClient(object):
         try:
             if self.p4.connected():
                 self.p4.disconnect()
-        except AttributeError:
+        except (AttributeError, P4Exception):
             pass
 
         if self.proxy:
@@ -144,6 +177,173 @@ class PerforceClient(object):
                 pass
             self.proxy = None
 
+    def is_alive(self):
+        """Returns whether the connection can still be used.
+
+        If the connection has been idle for longer than
+        PERFORCE_HEALTH_CHECK_INTERVAL, the server is asked for its info to
+        make sure it's still responding.
+        """
+        if self.proxy and not self.proxy.is_running():
+            return False
+
+        try:
+            if not self.p4.connected():
+                return False
+
+            if time.time() - self.last_used >= PERFORCE_HEALTH_CHECK_INTERVAL:
+                self.p4.run_info()
+        except P4Exception:
+            return False
+
+        return True
+
+    def matches(self, client):
+        """Returns whether the connection was made with a client's settings."""
+        return (self.password == client.password and
+                self.use_stunnel == client.use_stunnel and
+                self.use_ticket_auth == client.use_ticket_auth and
+                isinstance(self.p4, client.p4_cls))
+
+
+class PerforceConnectionPool(object):
+    """A pool of open connections to Perforce servers.
+
+    Connections are kept for each combination of server, user and charset.
+    A connection is only used by one thread at a time. Once a command has
+    finished, the connection is returned to the pool, so that later commands
+    don't have to connect, start an stunnel proxy or log in again.
+
+    Connections that have been idle for longer than PERFORCE_IDLE_TIMEOUT
+    are closed, and at most PERFORCE_MAX_IDLE_CONNECTIONS are kept per key.
+    """
+    def __init__(self):
+        self._idle_connections = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def get_connection(self, client):
+        """Returns a connection for the client.
+
+        An idle connection is reused if there's a working one with the
+        client's settings. Otherwise, a new connection is made.
+        """
+        key = self._make_key(client)
+        closed_connections = self._remove_expired()
+        connection = None
+
+        try:
+            while True:
+                with self._lock:
+                    connections = self._idle_connections.get(key)
+
+                    if not connections:
+                        break
+
+                    idle_connection = connections.pop()
+
+                if (idle_connection.matches(client) and
+                        idle_connection.is_alive()):
+                    connection = idle_connection
+                    break
+
+                closed_connections.append(idle_connection)
+        finally:
+            for closed_connection in closed_connections:
+                closed_connection.disconnect()
+
+        if connection is None:
+            connection = PerforceConnection(client.p4_cls(),
+                                            client.p4port,
+                                            client.username,
+                                            client.password,
+                                            client.encoding,
+                                            client.use_stunnel,
+                                            client.use_ticket_auth)
+
+            try:
+                connection.connect()
+            except:
+                connection.disconnect()
+                raise
+
+        return connection
+
+    def release_connection(self, connection):
+        """Returns a connection to the pool once it's no longer being used."""
+        connection.last_used = time.time()
+        key = (connection.p4port, connection.username, connection.encoding)
+
+        with self._lock:
+            connections = self._idle_connections.setdefault(key, [])
+
+            if len(connections) < PERFORCE_MAX_IDLE_CONNECTIONS:
+                connections.append(connection)
+                connection = None
+
+        if connection is not None:
+            connection.disconnect()
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._lock:
+            idle_connections = self._idle_connections
+            self._idle_connections = {}
+
+        for connections in idle_connections.itervalues():
+            for connection in connections:
+                connection.disconnect()
+
+    def _make_key(self, client):
+        return (client.p4port, client.username, client.encoding)
+
+    def _remove_expired(self):
+        """Removes expired connections from the pool.
+
+        This returns the connections that were removed, so they can be
+        closed once the lock is released.
+        """
+        expired_connections = []
+        now = time.time()
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # We've been forked. The connections belong to the parent.
+                self._idle_connections = {}
+                self._pid = os.getpid()
+
+            for connections in self._idle_connections.itervalues():
+                for connection in list(connections):
+                    if now - connection.last_used >= PERFORCE_IDLE_TIMEOUT:
+                        connections.remove(connection)
+                        expired_connections.append(connection)
+
+        return expired_connections
+
+
+_connection_pool = PerforceConnectionPool()
+
+
+class PerforceClient(object):
+    def __init__(self, p4port, username, password, encoding, use_stunnel=False,
+                 use_ticket_auth=False, p4_cls=None):
+        self.p4port = p4port
+        self.username = username
+        self.password = password
+        self.encoding = encoding
+        self.use_stunnel = use_stunnel
+        self.use_ticket_auth = use_ticket_auth
+
+        if p4_cls is None:
+            import P4
+            p4_cls = P4.P4
+
+        self.p4_cls = p4_cls
+
+        if use_stunnel and not is_exe_in_path('stunnel'):
+            raise AttributeError('stunnel proxy was requested, but stunnel '
+                                 'binary is not in the exec path.')
+
     @staticmethod
     def _convert_p4exception_to_scmexception(e):
         error = str(e)
@@ -164,56 +364,88 @@ class PerforceClient(object):
         else:
             raise SCMError(error)
 
+    @staticmethod
+    def _is_session_expired(e):
+        """Returns whether an error was caused by an expired ticket."""
+        error = str(e)
+
+        return ('Your session has expired' in error or
+                'Perforce password (P4PASSWD) invalid or unset' in error)
+
     def _run_worker(self, worker):
-        result = None
+        """Runs a function with a connection to the Perforce server.
 
-        # TODO: Move to using with: when we require a minimum of Python 2.5.
-        #       We should make it auto-disconnect.
+        The function is passed the connected P4 object. The connection comes
+        from the connection pool, and is returned to it afterward, unless
+        the command failed.
+
+        If the login ticket has expired, we log in again and retry once.
+        """
         try:
-            self._connect()
-            result = worker()
-            self._disconnect()
+            connection = _connection_pool.get_connection(self)
         except P4Exception, e:
-            self._disconnect()
+            self._convert_p4exception_to_scmexception(e)
+
+        try:
+            try:
+                result = worker(connection.p4)
+            except P4Exception, e:
+                if not (connection.logged_in and
+                        self._is_session_expired(e)):
+                    raise
+
+                connection.login()
+                result = worker(connection.p4)
+        except P4Exception, e:
+            connection.disconnect()
             self._convert_p4exception_to_scmexception(e)
         except:
-            self._disconnect()
+            connection.disconnect()
             raise
 
+        _connection_pool.release_connection(connection)
+
         return result
 
-    def _get_changeset(self, changesetid):
-        return self.p4.run_describe('-s', str(changesetid))
+    def _get_changeset(self, p4, changesetid):
+        return p4.run_describe('-s', str(changesetid))
 
     def get_changeset(self, changesetid):
         """
         Get the contents of a changeset description.
         """
-        return self._run_worker(lambda: self._get_changeset(changesetid))
+        return self._run_worker(
+            lambda p4: self._get_changeset(p4, changesetid))
 
     def get_info(self):
-        return self._run_worker(self.p4.run_info)
+        return self._run_worker(lambda p4: p4.run_info())
 
-    def _get_pending_changesets(self, userid):
-        changesets = self.p4.run_changes('-s', 'pending', '-u', userid)
-        return map(self._get_changeset, [x.split()[1] for x in changesets])
+    def _get_pending_changesets(self, p4, userid):
+        changesets = p4.run_changes('-s', 'pending', '-u', userid)
+        return [
+            self._get_changeset(p4, x.split()[1])
+            for x in changesets
+        ]
 
     def get_pending_changesets(self, userid):
         """
         Get a list of changeset descriptions for all pending changesets for a
         given user.
         """
-        return self._run_worker(lambda: self._get_pending_changesets(userid))
+        return self._run_worker(
+            lambda p4: self._get_pending_changesets(p4, userid))
 
-    def _get_file(self, path, revision):
+    def _get_depot_path(self, path, revision):
+        if revision == HEAD:
+            return path
+        else:
+            return '%s#%s' % (path, revision)
+
+    def _get_file(self, p4, path, revision):
         if revision == PRE_CREATION:
             return ''
-        elif revision == HEAD:
-            depot_path = path
-        else:
-            depot_path = '%s#%s' % (path, revision)
 
-        res = self.p4.run_print('-q', depot_path)
+        res = p4.run_print('-q', self._get_depot_path(path, revision))
         if res:
             return res[-1]
 
@@ -221,10 +453,75 @@ class PerforceClient(object):
         """
         Get the contents of a file, at a specific revision.
         """
-        return self._run_worker(lambda: self._get_file(path, revision))
+        return self._run_worker(lambda p4: self._get_file(p4, path, revision))
+
+    def _get_files(self, p4, paths_and_revisions):
+        results = [None] * len(paths_and_revisions)
+        indexes = []
+
+        for i, (path, revision) in enumerate(paths_and_revisions):
+            if revision == PRE_CREATION:
+                results[i] = ''
+            elif path.startswith('//'):
+                indexes.append(i)
+            else:
+                # We can only match up the results for depot paths.
+                results[i] = self._get_file(p4, path, revision)
+
+        if not indexes:
+            return results
+
+        res = p4.run_print('-q', *[
+            self._get_depot_path(*paths_and_revisions[i])
+            for i in indexes
+        ])
+
+        # The results contain a dictionary describing each file that was
+        # printed, followed by its contents. Files that couldn't be found
+        # are left out, so each file is matched up with the next result.
+        printed_files = []
+
+        for item in res:
+            if isinstance(item, dict):
+                printed_files.append((item, []))
+            elif printed_files:
+                printed_files[-1][1].append(item)
 
-    def _get_files_at_revision(self, revision_str):
-        return self.p4.run_files(revision_str)
+        printed_files.reverse()
+
+        for i in indexes:
+            path, revision = paths_and_revisions[i]
+
+            if not printed_files:
+                break
+
+            info, data = printed_files[-1]
+
+            if (info.get('depotFile') == path and
+                (revision == HEAD or info.get('rev') == str(revision))):
+                results[i] = ''.join(data)
+                printed_files.pop()
+
+        return results
+
+    def get_files(self, paths_and_revisions):
+        """
+        Get the contents of several files with a single 'p4 print'.
+        """
+        results = self._run_worker(
+            lambda p4: self._get_files(p4, paths_and_revisions))
+
+        # Depot files left out of the printed results don't exist. This is
+        # checked once the connection is back in the pool, since a missing
+        # file is no reason to drop it.
+        for (path, revision), data in zip(paths_and_revisions, results):
+            if data is None and path.startswith('//'):
+                raise FileNotFoundError(path, revision)
+
+        return results
+
+    def _get_files_at_revision(self, p4, revision_str):
+        return p4.run_files(revision_str)
 
     def get_files_at_revision(self, revision_str):
         """
@@ -232,7 +529,7 @@ class PerforceClient(object):
         to 'p4 files'
         """
         return self._run_worker(
-            lambda: self._get_files_at_revision(revision_str))
+            lambda p4: self._get_files_at_revision(p4, revision_str))
 
 
 class PerforceTool(SCMTool):
@@ -320,6 +617,9 @@ class PerforceTool(SCMTool):
     def get_file(self, path, revision=HEAD):
         return self.client.get_file(path, revision)
 
+    def get_files(self, paths_and_revisions):
+        return self.client.get_files(paths_and_revisions)
+
     def parse_diff_revision(self, file_str, revision_str, *args, **kwargs):
         # Perforce has this lovely idiosyncracy that diffs show revision #1 both
         # for pre-creation and when there's an actual revision.
@@ -16,11 +16,13 @@ except ImportError:
     pass
 
 from django.core.cache import cache
+from django.utils.http import urlquote
 from django.utils.translation import ugettext as _
+from djblets.util.misc import cache_memoize
 
 from reviewboard.diffviewer.parser import DiffParser
 from reviewboard.scmtools.certs import Certificate
-from reviewboard.scmtools.core import (Branch, Commit, SCMTool,
+from reviewboard.scmtools.core import (Branch, Commit, LRUCache, SCMTool,
                                        HEAD, PRE_CREATION, UNKNOWN)
 from reviewboard.scmtools.errors import (AuthenticationError,
                                          FileNotFoundError,
@@ -36,6 +38,14 @@ sshutils.ssh_uri_schemes.append('svn+ssh')
 sshutils.register_rbssh('SVN_SSH')
 
 
+# The maximum number of compiled regexes for collapsing keywords kept
+# around, one for each set of keywords.
+MAX_KEYWORD_REGEX_CACHE_SIZE = 32
+
+
+_keyword_regexes = LRUCache(MAX_KEYWORD_REGEX_CACHE_SIZE)
+
+
 class SVNCertificateFailures:
     """SVN HTTPS certificate failure codes.
 
@@ -185,22 +195,40 @@ class SVNTool(SCMTool):
             # Find out if this file has any keyword expansion set.
             # If it does, collapse these keywords. This is because SVN
             # will return the file expanded to us, which would break patching.
-            keywords = self.client.propget("svn:keywords", normpath, normrev,
-                                           recurse=True)
-            if normpath in keywords:
-                data = self.collapse_keywords(data, keywords[normpath])
+            keywords = self._get_keywords(normpath, normrev)
+
+            if keywords:
+                data = self.collapse_keywords(data, keywords)
 
             return data
 
         return self._do_on_path(get_file_data, path, revision)
 
     def get_keywords(self, path, revision=HEAD):
-        def get_file_keywords(normpath, normrev):
+        return self._do_on_path(self._get_keywords, path, revision)
+
+    def _get_keywords(self, normpath, normrev):
+        """Returns the svn:keywords property for a file.
+
+        The keywords for a particular revision of a file never change, so
+        they're cached. They're looked up when fetching the file, which means
+        the lookup made when patching the file (through normalize_patch)
+        won't need another round trip to the server.
+        """
+        def fetch_keywords():
             keywords = self.client.propget("svn:keywords", normpath, normrev,
                                            recurse=True)
-            return keywords.get(normpath)
 
-        return self._do_on_path(get_file_keywords, path, revision)
+            # The empty string is cached for files without keywords, since
+            # cache_memoize can't tell a cached None from a cache miss.
+            return keywords.get(normpath) or ''
+
+        if normrev.kind != opt_revision_kind.number:
+            return fetch_keywords() or None
+
+        return cache_memoize('svn-keywords:%s:%s' % (urlquote(normpath),
+                                                     normrev.number),
+                             fetch_keywords) or None
 
     def get_branches(self):
         """Returns a list of branches.
@@ -352,12 +380,22 @@ class SVNTool(SCMTool):
             return "$%s$" % m.group(1)
 
         # Get any aliased keywords
-        keywords = [keyword
-                    for name in re.split(r'\W+', keyword_str)
-                    for keyword in self.keywords.get(name, [])]
-
-        return re.sub(r"\$(%s):(:?)([^\$\n\r]*)\$" % '|'.join(keywords),
-                      repl, data)
+        keywords = tuple(sorted(set([
+            keyword
+            for name in re.split(r'\W+', keyword_str)
+            for keyword in self.keywords.get(name, [])
+        ])))
+
+        # The same few sets of keywords are used by most files, so the
+        # regexes for them are only built once.
+        regex = _keyword_regexes.get(keywords)
+
+        if regex is None:
+            regex = re.compile(r"\$(%s):(:?)([^\$\n\r]*)\$"
+                               % '|'.join(keywords))
+            _keyword_regexes.set(keywords, regex)
+
+        return regex.sub(repl, data)
 
     def parse_diff_revision(self, file_str, revision_str, *args, **kwargs):
         # Some diffs have additional tabs between the parts of the file
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""A fake interactive cleartool, used by the ClearCase unit tests.
+
+This understands just enough of the commands run by ClearCaseTool to test
+it without ClearCase installed. The current directory acts as a snapshot
+view, and fetched files contain the extended path they were fetched from.
+"""
+
+import os
+import shlex
+import sys
+
+
+def run_command(args):
+    cmd = args[0]
+
+    if cmd == 'lsview':
+        return 0, 'Properties: snapshot readwrite\n'
+    elif cmd == 'describe' and args[1:] == ['-short', 'vob:.']:
+        return 0, '/vobs/test\n'
+    elif cmd == 'describe' and args[1:3] == ['-fmt', '%En@@%Vn']:
+        return 0, os.path.join(os.getcwd(), 'file-%s@@/main/1'
+                               % args[3][len('oid:'):])
+    elif cmd == 'lsvob':
+        return 0, ('Tag: %s\n'
+                   'Vob family uuid:  12345678.9abcdef0.12345678.9abcdef0\n'
+                   % args[-1])
+    elif cmd == 'desc' and args[1:3] == ['-fmt', '%m']:
+        path = args[3].rsplit('@@', 1)[0]
+
+        if os.path.isdir(path):
+            return 0, 'directory element'
+        elif os.path.isfile(path):
+            return 0, 'file element'
+    elif cmd == 'get' and args[1] == '-to':
+        path = args[3].rsplit('@@', 1)[0]
+
+        if os.path.isfile(path):
+            fp = open(args[2], 'w')
+            fp.write('%s\n' % args[3])
+            fp.close()
+
+            return 0, ''
+
+    return 1, ('cleartool: Error: Unable to access "%s": No such file or '
+               'directory.\n' % args[-1])
+
+
+def main():
+    if sys.argv[1:] != ['-status']:
+        sys.stderr.write('Only interactive mode is supported.\n')
+        sys.exit(1)
+
+    num_commands = 0
+
+    while True:
+        sys.stdout.write('cleartool> ')
+        sys.stdout.flush()
+
+        line = sys.stdin.readline()
+
+        if not line or line.strip() in ('quit', 'exit'):
+            break
+
+        num_commands += 1
+        status, output = run_command(shlex.split(line))
+
+        sys.stdout.write(output)
+        sys.stdout.write('Command %d returned status %d\n'
+                         % (num_commands, status))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
 import os
+import shutil
+import sys
+import threading
+import time
 from errno import ECONNREFUSED
 from hashlib import md5
+from StringIO import StringIO
 from socket import error as SocketError
 from tempfile import mkdtemp
 
@@ -20,15 +25,24 @@ from reviewboard.hostingsvcs.service import (HostingService,
                                              register_hosting_service,
                                              unregister_hosting_service)
 from reviewboard.reviews.models import Group
-from reviewboard.scmtools.core import (Branch, ChangeSet, Commit, Revision,
+from reviewboard.scmtools import models as scmtools_models
+from reviewboard.scmtools.clearcase import ClearCaseTool, CleartoolSession
+from reviewboard.scmtools.core import (Branch, ChangeSet, Commit,
+                                       KeyedThreadPool, Revision, SCMTool,
                                        HEAD, PRE_CREATION)
 from reviewboard.scmtools.errors import (SCMError, FileNotFoundError,
                                          RepositoryNotFoundError,
                                          AuthenticationError)
 from reviewboard.scmtools.forms import RepositoryForm
-from reviewboard.scmtools.git import ShortSHA1Error
-from reviewboard.scmtools.models import Repository, Tool
-from reviewboard.scmtools.perforce import STunnelProxy, STUNNEL_SERVER
+from reviewboard.scmtools.git import (CAT_FILE_IDLE_TIMEOUT, ShortSHA1Error,
+                                     get_cat_file_pool)
+from reviewboard.scmtools.hg import get_hg_client
+from reviewboard.scmtools.models import (FILE_EXISTS_MAX_WORKERS,
+                                        FILE_EXISTS_MAX_WORKERS_PER_HOST,
+                                        Repository, Tool)
+from reviewboard.scmtools import perforce
+from reviewboard.scmtools.perforce import (P4Exception, PerforceClient,
+                                           STunnelProxy, STUNNEL_SERVER)
 from reviewboard.scmtools.signals import (checked_file_exists,
                                           checking_file_exists,
                                           fetched_file, fetching_file)
@@ -148,6 +162,49 @@ class CoreTests(DjangoTestCase):
         self.assertTrue(len(cs.bugs_closed) == 0)
         self.assertTrue(len(cs.files) == 0)
 
+    def test_keyed_thread_pool(self):
+        """Testing KeyedThreadPool limiting tasks per key"""
+        def task(name):
+            with lock:
+                running.append(name)
+                max_running[0] = max(max_running[0], len(running))
+
+            release.wait(5)
+
+            with lock:
+                running.remove(name)
+
+            if name == 'error':
+                raise ValueError(name)
+
+            return name.upper()
+
+        lock = threading.Lock()
+        release = threading.Event()
+        running = []
+        max_running = [0]
+
+        pool = KeyedThreadPool(max_workers=4, max_workers_per_key=2)
+        results = [
+            pool.apply_async('busy', task, (name,))
+            for name in ('a', 'b', 'c', 'error')
+        ]
+
+        # The tasks queued for the busy key don't keep other keys waiting.
+        other_result = pool.apply_async('other', lambda: 'other')
+        self.assertEqual(other_result.get(), 'other')
+        self.assertFalse(results[2].ready())
+
+        release.set()
+        self.assertEqual([result.get() for result in results[:3]],
+                         ['A', 'B', 'C'])
+        self.assertRaises(ValueError, results[3].get)
+        self.assertEqual(max_running[0], 2)
+
+        self.assertEqual(pool.map('busy', task, ['d', 'e']), ['D', 'E'])
+        self.assertEqual(pool._num_running, {})
+        self.assertEqual(pool._queued, {})
+
 
 class RepositoryTests(DjangoTestCase):
     fixtures = ['test_scmtools']
@@ -162,12 +219,16 @@ class RepositoryTests(DjangoTestCase):
         self.scmtool_cls = self.repository.get_scmtool().__class__
         self.old_get_file = self.scmtool_cls.get_file
         self.old_file_exists = self.scmtool_cls.file_exists
+        self.old_files_exist = self.scmtool_cls.files_exist
+        self.old_get_files = self.scmtool_cls.get_files
 
     def tearDown(self):
         cache.clear()
 
         self.scmtool_cls.get_file = self.old_get_file
         self.scmtool_cls.file_exists = self.old_file_exists
+        self.scmtool_cls.files_exist = self.old_files_exist
+        self.scmtool_cls.get_files = self.old_get_files
 
     def test_get_file_caching(self):
         """Testing Repository.get_file caches result"""
@@ -217,6 +278,284 @@ class RepositoryTests(DjangoTestCase):
         self.assertEqual(found_signals[1],
                          ('fetched_file', path, revision, request))
 
+    def test_get_files_exist_concurrently(self):
+        """Testing Repository.get_files_exist checks files concurrently for SCMTools without batch support"""
+        def file_exists(self, path, revision):
+            threads.add(threading.current_thread())
+            return path != 'missing'
+
+        threads = set()
+
+        self.scmtool_cls.files_exist = SCMTool.files_exist.im_func
+        self.scmtool_cls.file_exists = file_exists
+
+        self.assertEqual(
+            self.repository.get_files_exist([
+                ('readme', 'e965047'),
+                ('missing', 'e965047'),
+                ('readme', 'd6613f5'),
+            ]),
+            [True, False, True])
+        self.assertTrue(threads)
+        self.assertFalse(threading.current_thread() in threads)
+
+    def test_get_files_exist_concurrently_with_busy_host(self):
+        """Testing Repository.get_files_exist doesn't wait on other hosts' checks"""
+        def slow_file_exists(path, revision):
+            started.release()
+            release.wait(5)
+            finished.append(path)
+            return True
+
+        started = threading.Semaphore(0)
+        release = threading.Event()
+        finished = []
+        other_repository = Repository(name='Other repo',
+                                      path='http://example.com/repo',
+                                      tool=Tool.objects.get(name='Git'))
+
+        thread = threading.Thread(
+            target=self.repository._check_files_exist_concurrently,
+            args=(slow_file_exists, [
+                ('file%d' % i, 'e965047')
+                for i in xrange(FILE_EXISTS_MAX_WORKERS)
+            ]))
+        thread.start()
+
+        try:
+            # Wait until the first host's checks are all underway.
+            for i in xrange(FILE_EXISTS_MAX_WORKERS_PER_HOST):
+                started.acquire()
+
+            self.assertEqual(
+                other_repository._check_files_exist_concurrently(
+                    lambda path, revision: True,
+                    [('readme', 'e965047'), ('readme', 'd6613f5')]),
+                [True, True])
+            self.assertEqual(finished, [])
+        finally:
+            release.set()
+            thread.join()
+
+    def test_get_files_exist_concurrently_with_errors(self):
+        """Testing Repository.get_files_exist raises the first file's error when checking concurrently"""
+        def file_exists(self, path, revision):
+            if path == 'slow-error':
+                time.sleep(0.1)
+                raise SCMError('slow-error')
+            elif path == 'fast-error':
+                raise SCMError('fast-error')
+
+            return True
+
+        self.scmtool_cls.files_exist = SCMTool.files_exist.im_func
+        self.scmtool_cls.file_exists = file_exists
+
+        try:
+            self.repository.get_files_exist([
+                ('readme', 'e965047'),
+                ('slow-error', 'e965047'),
+                ('fast-error', 'e965047'),
+            ])
+            self.fail('Expected SCMError to be raised')
+        except SCMError, e:
+            self.assertEqual(str(e), 'slow-error')
+
+    def test_get_commits_index(self):
+        """Testing Repository.get_commits only fetches new commits"""
+        repository = self._create_commits_repository()
+
+        commits = repository.get_commits('5')
+        self.assertEqual([commit.id for commit in commits],
+                         ['5', '4', '3', '2', '1'])
+        self.assertEqual(self.fetched_starts, ['5', '2'])
+
+        # After a push, only the new commits should be fetched.
+        commits = repository.get_commits('7')
+        self.assertEqual([commit.id for commit in commits],
+                         ['7', '6', '5', '4', '3', '2', '1'])
+        self.assertEqual(self.fetched_starts, ['5', '2', '7'])
+
+        commits = repository.get_commits('4')
+        self.assertEqual([commit.id for commit in commits],
+                         ['4', '3', '2', '1'])
+        self.assertEqual(self.fetched_starts, ['5', '2', '7'])
+
+    def test_get_commits_without_start(self):
+        """Testing Repository.get_commits without a start commit"""
+        repository = self._create_commits_repository()
+
+        commits = repository.get_commits()
+        self.assertEqual(commits[0].id, '5')
+        self.assertEqual(self.fetched_starts, ['5', '2'])
+
+    def _create_commits_repository(self):
+        """Creates a repository with a fake history of 7 commits.
+
+        Each request to the repository returns a page of 3 commits, and the
+        start of each request is recorded in self.fetched_starts.
+        """
+        def get_commits(tool, start):
+            self.fetched_starts.append(start)
+
+            return [
+                Commit('user%d' % i, str(i), '2013-01-01T%02d:00:00' % i,
+                       'Commit %d' % i, str(i - 1) if i > 1 else '')
+                for i in xrange(int(start), max(int(start) - 3, 0), -1)
+            ]
+
+        self.fetched_starts = []
+        repository = Repository(name='Test', path=self.local_repo_path,
+                                tool=Tool.objects.get(name='Test'))
+
+        tool_cls = repository.get_scmtool().__class__
+        self.addCleanup(setattr, tool_cls, 'get_commits',
+                        tool_cls.get_commits)
+        tool_cls.get_commits = get_commits
+
+        return repository
+
+    def test_get_scmtool_caching(self):
+        """Testing Repository.get_scmtool reuses SCMTools until the repository changes"""
+        def init(tool, repository):
+            num_calls['init'] += 1
+            old_init(tool, repository)
+
+        num_calls = {
+            'init': 0,
+        }
+        old_init = self.scmtool_cls.__init__
+        self.repository.save()
+        self.scmtool_cls.__init__ = init
+
+        try:
+            tool = self.repository.get_scmtool()
+
+            for i in range(5):
+                self.assertTrue(self.repository.get_scmtool() is tool)
+                self.assertTrue(
+                    Repository.objects.get(pk=self.repository.pk)
+                    .get_scmtool() is tool)
+
+            self.assertEqual(num_calls['init'], 1)
+
+            # Another thread gets its own SCMTool.
+            tools = []
+            t = threading.Thread(
+                target=lambda: tools.append(self.repository.get_scmtool()))
+            t.start()
+            t.join()
+            self.assertFalse(tools[0] is tool)
+            self.assertEqual(num_calls['init'], 2)
+
+            # Changing the configuration creates a new SCMTool.
+            self.repository.encoding = 'latin-1'
+            new_tool = self.repository.get_scmtool()
+            self.assertFalse(new_tool is tool)
+            self.assertEqual(num_calls['init'], 3)
+
+            # Saving the repository discards the SCMTools.
+            self.repository.save()
+            self.assertFalse(self.repository.get_scmtool() is new_tool)
+            self.assertEqual(num_calls['init'], 4)
+
+            # So does saving it in another process, which changes the
+            # serial number in the cache.
+            tool = self.repository.get_scmtool()
+            cache.incr(self.repository._make_scmtool_serial_cache_key())
+            self.assertFalse(self.repository.get_scmtool() is tool)
+            self.assertEqual(num_calls['init'], 5)
+        finally:
+            self.scmtool_cls.__init__ = old_init
+
+    def test_get_scmtool_closes_discarded(self):
+        """Testing Repository.get_scmtool closes SCMTools it discards"""
+        closed = []
+
+        self.repository.save()
+        tool = self.repository.get_scmtool()
+        tool.close = lambda: closed.append(tool)
+
+        self.repository.save()
+        self.assertEqual(closed, [tool])
+
+        # Tools evicted to make room for others are closed as well.
+        old_max_size = scmtools_models._scmtool_cache.max_size
+        scmtools_models._scmtool_cache.max_size = 1
+
+        try:
+            tool = self.repository.get_scmtool()
+            tool.close = lambda: closed.append(tool)
+
+            other_repository = Repository.objects.create(
+                name='Other repo', path='/other',
+                tool=Tool.objects.get(name='Git'))
+            scmtools_models._scmtool_cache.set(
+                (other_repository.pk, 0), (None, SCMTool(other_repository)))
+            self.assertEqual(closed[1:], [tool])
+        finally:
+            scmtools_models._scmtool_cache.max_size = old_max_size
+
+    def test_get_files_caching(self):
+        """Testing Repository.get_files only fetches uncached files"""
+        def get_files(self, paths_and_revisions):
+            fetched.append(list(paths_and_revisions))
+
+            return [
+                '%s data' % revision
+                for path, revision in paths_and_revisions
+            ]
+
+        fetched = []
+
+        self.scmtool_cls.get_files = get_files
+
+        self.assertEqual(
+            self.repository.get_files([('readme', 'e965047')]),
+            ['e965047 data'])
+        self.assertEqual(
+            self.repository.get_files([
+                ('readme', 'e965047'),
+                ('readme', 'd6613f5'),
+                ('readme', 'd6613f5'),
+            ]),
+            ['e965047 data', 'd6613f5 data', 'd6613f5 data'])
+        self.assertEqual(fetched, [
+            [('readme', 'e965047')],
+            [('readme', 'd6613f5')],
+        ])
+
+        # The files should be cached for get_file as well.
+        self.assertEqual(self.repository.get_file('readme', 'd6613f5'),
+                         'd6613f5 data')
+        self.assertEqual(len(fetched), 2)
+
+    def test_get_files_signals(self):
+        """Testing Repository.get_files emits signals"""
+        def on_fetching_file(sender, path, revision, request, **kwargs):
+            found_signals.append(('fetching_file', path, revision, request))
+
+        def on_fetched_file(sender, path, revision, request, **kwargs):
+            found_signals.append(('fetched_file', path, revision, request))
+
+        found_signals = []
+
+        fetching_file.connect(on_fetching_file, sender=self.repository)
+        fetched_file.connect(on_fetched_file, sender=self.repository)
+
+        request = {}
+
+        self.repository.get_files([('readme', 'e965047'),
+                                   ('readme', 'd6613f5')],
+                                  request=request)
+
+        self.assertEqual(found_signals, [
+            ('fetching_file', 'readme', 'e965047', request),
+            ('fetching_file', 'readme', 'd6613f5', request),
+            ('fetched_file', 'readme', 'e965047', request),
+            ('fetched_file', 'readme', 'd6613f5', request),
+        ])
+
     def test_get_file_exists_caching_when_exists(self):
         """Testing Repository.get_file_exists caches result when exists"""
         def file_exists(self, path, revision):
@@ -327,6 +666,57 @@ class RepositoryTests(DjangoTestCase):
         self.assertEqual(found_signals[1],
                          ('checked_file_exists', path, revision, request))
 
+    def test_get_files_exist_caching(self):
+        """Testing Repository.get_files_exist only checks uncached files"""
+        def files_exist(self, paths_and_revisions):
+            checked.append(list(paths_and_revisions))
+
+            return [
+                revision == 'e965047'
+                for path, revision in paths_and_revisions
+            ]
+
+        checked = []
+        paths_and_revisions = [
+            ('readme', 'e965047'),
+            ('readme', '12345'),
+        ]
+
+        self.scmtool_cls.files_exist = files_exist
+
+        exists1 = self.repository.get_files_exist(paths_and_revisions)
+        exists2 = self.repository.get_files_exist(paths_and_revisions)
+
+        self.assertEqual(exists1, [True, False])
+        self.assertEqual(exists2, [True, False])
+        self.assertEqual(checked, [
+            paths_and_revisions,
+            [('readme', '12345')],
+        ])
+
+    def test_get_files_exist_with_fetched_file(self):
+        """Testing Repository.get_files_exist uses get_file's cached result"""
+        def get_file(self, path, revision):
+            return 'file data'
+
+        def files_exist(self, paths_and_revisions):
+            num_calls['files_exist'] += 1
+            return [True] * len(paths_and_revisions)
+
+        num_calls = {
+            'files_exist': 0,
+        }
+
+        self.scmtool_cls.get_file = get_file
+        self.scmtool_cls.files_exist = files_exist
+
+        self.repository.get_file('readme', 'e965047')
+
+        self.assertEqual(
+            self.repository.get_files_exist([('readme', 'e965047')]),
+            [True])
+        self.assertEqual(num_calls['files_exist'], 0)
+
 
 class BZRTests(SCMTestCase):
     """Unit tests for bzr."""
@@ -434,6 +824,67 @@ class CVSTests(SCMTestCase):
         self.assertRaises(FileNotFoundError,
                           lambda: self.tool.get_file('hello', PRE_CREATION))
 
+    def test_get_files(self):
+        """Testing CVSTool.get_files"""
+        def cat_specific_files(filenames, revision):
+            calls.append((filenames, revision))
+            return old_cat_specific_files(filenames, revision)
+
+        calls = []
+        client = self.tool.client
+        old_cat_specific_files = client._cat_specific_files
+        client._cat_specific_files = cat_specific_files
+        rev = Revision('1.1')
+
+        self.assertEqual(
+            self.tool.get_files([
+                ('test/testfile', rev),
+                (self.tool.repopath + '/test/otherfile,v', rev),
+                ('test/testfile,v', rev),
+            ]),
+            ['test content\n', 'other content\n', 'test content\n'])
+        self.assertEqual(calls, [(['test/testfile', 'test/otherfile'], '1.1')])
+
+        self.assertEqual(
+            self.tool.files_exist([
+                ('test/testfile', rev),
+                ('test/testfile2', rev),
+                ('test/otherfile', Revision('2.1')),
+                ('', rev),
+            ]),
+            [True, False, False, False])
+        self.assertRaises(
+            FileNotFoundError,
+            lambda: self.tool.get_files([('test/otherfile', rev),
+                                         ('test/testfile2', rev)]))
+
+    def test_get_files_with_cvs_messages(self):
+        """Testing CVSTool.get_files ignores contents ending in cvs messages"""
+        class FakeProcess(object):
+            def __init__(self, output):
+                self.stdout = StringIO(output)
+
+            def wait(self):
+                return 0
+
+        def make_header(filename):
+            return ('%s\nChecking out %s\nRCS:  /cvs/%s,v\nVERS: 1.1\n'
+                    '***************\n' % ('=' * 67, filename, filename))
+
+        client = self.tool.client
+        client._popen = lambda *args, **kwargs: FakeProcess(
+            make_header('a') +
+            'a content\n' +
+            'cvs checkout: warning: something went wrong\n' +
+            make_header('b') +
+            'b content\n' +
+            make_header('c') +
+            'c content' +
+            'cvs checkout: warning: something went wrong\n')
+
+        self.assertEqual(client._cat_specific_files(['a', 'b', 'c'], '1.1'),
+                         {'b': 'b content\n'})
+
     def test_revision_parsing(self):
         """Testing revision number parsing"""
         self.assertEqual(self.tool.parse_diff_revision('', 'PRE-CREATION')[1],
@@ -589,6 +1040,126 @@ class CVSTests(SCMTestCase):
         self._test_ssh_with_site(self.cvs_ssh_path, 'CVSROOT/modules')
 
 
+class ClearCaseTests(DjangoTestCase):
+    """Unit tests for ClearCase."""
+    fixtures = ['test_scmtools']
+
+    def setUp(self):
+        self.old_command = CleartoolSession.command
+        CleartoolSession.command = [
+            sys.executable,
+            os.path.join(os.path.dirname(__file__), 'testdata',
+                         'fake_cleartool.py'),
+            '-status',
+        ]
+
+        self.view_path = os.path.realpath(mkdtemp(prefix='rb-tests-view-'))
+        os.mkdir(os.path.join(self.view_path, 'src'))
+
+        for filename in ('a.c', 'b.c'):
+            fp = open(os.path.join(self.view_path, 'src', filename), 'w')
+            fp.write('int main() {}\n')
+            fp.close()
+
+        # The test_scmtools fixture's Test tool replaces ClearCase, since
+        # they share a primary key.
+        tool, is_new = Tool.objects.get_or_create(
+            name='ClearCase',
+            class_name='reviewboard.scmtools.clearcase.ClearCaseTool')
+
+        self.repository = Repository(name='ClearCase',
+                                     path=self.view_path,
+                                     tool=tool)
+        self.tool = self.repository.get_scmtool()
+
+    def tearDown(self):
+        self.tool.session.close()
+        CleartoolSession.command = self.old_command
+        shutil.rmtree(self.view_path)
+
+    def test_get_repository_info(self):
+        """Testing ClearCaseTool.get_repository_info"""
+        self.assertEqual(self.tool.viewtype, ClearCaseTool.VIEW_SNAPSHOT)
+        self.assertEqual(self.tool.get_repository_info(), {
+            'repopath': self.view_path,
+            'uuid': '12345678.9abcdef0.12345678.9abcdef0',
+        })
+
+    def test_get_file(self):
+        """Testing ClearCaseTool.get_file"""
+        path = os.path.join(self.view_path, 'src', 'a.c') + '@@/main/1'
+
+        self.assertEqual(self.tool.get_file(path, '/main/1'), path + '\n')
+        self.assertEqual(self.tool.get_file(path, PRE_CREATION), '')
+        self.assertRaises(
+            SCMError,
+            lambda: self.tool.get_file(
+                os.path.join(self.view_path, 'src') + '@@/main/1',
+                '/main/1'))
+        self.assertRaises(FileNotFoundError,
+                          lambda: self.tool.get_file('', '/main/1'))
+
+    def test_get_files(self):
+        """Testing ClearCaseTool.get_files uses one cleartool process"""
+        pid = self.tool.session.process.pid
+        paths = [
+            os.path.join(self.view_path, 'src', 'a.c') + '@@/main/2',
+            os.path.join(self.view_path, 'src', 'b.c') + '@@/main/4',
+        ]
+
+        self.assertEqual(
+            self.tool.get_files([
+                (paths[0], '/main/2'),
+                (paths[1], '/main/4'),
+                (paths[0], PRE_CREATION),
+            ]),
+            [paths[0] + '\n', paths[1] + '\n', ''])
+        self.tool.get_repository_info()
+        self.assertEqual(self.tool.session.process.pid, pid)
+
+    def test_session_restart(self):
+        """Testing CleartoolSession starts a new cleartool after a crash"""
+        path = os.path.join(self.view_path, 'src', 'a.c') + '@@/main/1'
+        process = self.tool.session.process
+        process.kill()
+        process.wait()
+
+        self.assertEqual(self.tool.get_file(path, '/main/1'), path + '\n')
+        self.assertNotEqual(self.tool.session.process.pid, process.pid)
+
+    def test_oid_to_filename(self):
+        """Testing parsing ClearCase diffs translates oids using the session"""
+        parser = self.tool.get_parser('')
+
+        self.assertTrue(parser.session is self.tool.session)
+        self.assertEqual(parser._oid2filename('1234'), 'file-1234@@/main/1')
+
+    def test_close(self):
+        """Testing ClearCaseTool.close shuts down cleartool"""
+        path = os.path.join(self.view_path, 'src', 'a.c') + '@@/main/1'
+        process = self.tool.session.process
+
+        self.tool.close()
+        self.assertTrue(self.tool.session.process is None)
+        self.assertNotEqual(process.poll(), None)
+
+        # The tool is still usable after being closed.
+        self.assertEqual(self.tool.get_file(path, '/main/1'), path + '\n')
+        self.assertNotEqual(self.tool.session.process.pid, process.pid)
+
+    def test_close_on_cache_discard(self):
+        """Testing Repository.save closes the cached ClearCaseTool"""
+        self.repository.save()
+        tool = self.repository.get_scmtool()
+        process = tool.session.process
+
+        self.assertTrue(self.repository.get_scmtool() is tool)
+
+        self.repository.save()
+        self.assertTrue(tool.session.process is None)
+        self.assertNotEqual(process.poll(), None)
+
+
 class SubversionTests(SCMTestCase):
     """Unit tests for subversion."""
     fixtures = ['test_scmtools']
@@ -753,6 +1324,51 @@ class SubversionTests(SCMTestCase):
         file = self.tool.get_file(filename, rev)
         patch(diff, file, filename)
 
+    def test_get_keywords_after_get_file(self):
+        """Testing SVNTool.get_keywords uses the keywords looked up by get_file"""
+        class CountingClient(object):
+            def __init__(self, client):
+                self.client = client
+
+            def propget(self, *args, **kwargs):
+                num_calls['propget'] += 1
+                return self.client.propget(*args, **kwargs)
+
+            def __getattr__(self, name):
+                return getattr(self.client, name)
+
+        num_calls = {
+            'propget': 0,
+        }
+        filename = 'trunk/doc/misc-docs/Makefile'
+        rev = Revision('4')
+        self.tool.client = CountingClient(self.tool.client)
+
+        self.tool.get_file(filename, rev)
+        self.assertEqual(num_calls['propget'], 1)
+
+        keywords = self.tool.get_keywords(filename, rev)
+        self.assertEqual(num_calls['propget'], 1)
+        self.assertEqual(keywords,
+                         self.repository.get_scmtool().get_keywords(filename,
+                                                                   rev))
+
+    def test_collapse_keywords(self):
+        """Testing SVNTool.collapse_keywords"""
+        data = ('# $Id: Makefile 4 2008-04-24 chipx86 $\n'
+                '# $Rev: 4 $\n'
+                '# $Revision:: 4  $\n'
+                '# $Author: chipx86 $\n')
+        expected = ('# $Id$\n'
+                    '# $Rev$\n'
+                    '# $Revision::    $\n'
+                    '# $Author: chipx86 $\n')
+
+        self.assertEqual(self.tool.collapse_keywords(data, 'Id Rev'), expected)
+        self.assertEqual(self.tool.collapse_keywords(data, 'Rev Id'), expected)
+        self.assertEqual(self.tool.collapse_keywords(data, 'Author'),
+                         data.replace('$Author: chipx86 $', '$Author$'))
+
     def test_svn16_property_diff(self):
         """Testing parsing SVN 1.6 diff with property changes"""
         prop_diff = (
@@ -1083,6 +1699,213 @@ class PerforceTests(SCMTestCase):
         self.assertEqual(files[1].delete_count, 1)
 
 
+class FakeP4(object):
+    """A stand-in for P4.P4 that doesn't talk to a server.
+
+    This records the connections made and the commands run, so that
+    PerforceClient's connection handling can be tested offline.
+    """
+    instances = []
+
+    def __init__(self):
+        self.user = None
+        self.password = None
+        self.charset = None
+        self.port = None
+        self.exception_level = None
+        self.is_connected = False
+        self.num_connects = 0
+        self.num_logins = 0
+        self.commands = []
+        self.fail_next = None
+        self.missing_files = set()
+
+        FakeP4.instances.append(self)
+
+    def connect(self):
+        self.is_connected = True
+        self.num_connects += 1
+
+    def connected(self):
+        return self.is_connected
+
+    def disconnect(self):
+        self.is_connected = False
+
+    def run_login(self):
+        self.num_logins += 1
+
+    def run_info(self):
+        return self._run('info', [{'serverAddress': self.port}])
+
+    def run_print(self, *args):
+        result = []
+
+        for depot_path in args[1:]:
+            path, rev = depot_path.split('#')
+
+            if path not in self.missing_files:
+                result += [
+                    {
+                        'depotFile': path,
+                        'rev': rev,
+                    },
+                    'data for %s' % depot_path,
+                ]
+
+        return self._run('print', result)
+
+    def _run(self, command, result):
+        self.commands.append(command)
+
+        if self.fail_next:
+            error = self.fail_next
+            self.fail_next = None
+            raise P4Exception(error)
+
+        return result
+
+
+class PerforceClientTests(DjangoTestCase):
+    """Unit tests for PerforceClient, using a fake P4."""
+    def setUp(self):
+        FakeP4.instances = []
+        perforce._connection_pool.close()
+
+        self.old_idle_timeout = perforce.PERFORCE_IDLE_TIMEOUT
+        self.old_health_check_interval = \
+            perforce.PERFORCE_HEALTH_CHECK_INTERVAL
+
+    def tearDown(self):
+        perforce._connection_pool.close()
+        perforce.PERFORCE_IDLE_TIMEOUT = self.old_idle_timeout
+        perforce.PERFORCE_HEALTH_CHECK_INTERVAL = \
+            self.old_health_check_interval
+
+    def _create_client(self, username='user', **kwargs):
+        return PerforceClient('perforce.example.com:1666', username,
+                              'password', '', p4_cls=FakeP4, **kwargs)
+
+    def test_reuses_connections(self):
+        """Testing PerforceClient reuses connections"""
+        client = self._create_client()
+
+        self.assertEqual(client.get_file('//depot/foo', 1),
+                         'data for //depot/foo#1')
+        self.assertEqual(client.get_file('//depot/bar', 2),
+                         'data for //depot/bar#2')
+        self.assertEqual(self._create_client().get_file('//depot/foo', 3),
+                         'data for //depot/foo#3')
+
+        self.assertEqual(len(FakeP4.instances), 1)
+
+        p4 = FakeP4.instances[0]
+        self.assertEqual(p4.num_connects, 1)
+        self.assertEqual(p4.commands, ['print', 'print', 'print'])
+        self.assertEqual(p4.port, 'perforce.example.com:1666')
+        self.assertTrue(p4.is_connected)
+
+    def test_separate_connections_per_user(self):
+        """Testing PerforceClient uses separate connections for each user"""
+        self._create_client(username='user1').get_info()
+        self._create_client(username='user2').get_info()
+        self._create_client(username='user1').get_info()
+
+        self.assertEqual(len(FakeP4.instances), 2)
+        self.assertEqual(FakeP4.instances[0].user, 'user1')
+        self.assertEqual(FakeP4.instances[0].commands, ['info', 'info'])
+        self.assertEqual(FakeP4.instances[1].user, 'user2')
+
+    def test_replaces_dropped_connections(self):
+        """Testing PerforceClient replaces dropped connections"""
+        client = self._create_client()
+        client.get_info()
+        FakeP4.instances[0].is_connected = False
+
+        client.get_info()
+
+        self.assertEqual(len(FakeP4.instances), 2)
+        self.assertEqual(FakeP4.instances[1].commands, ['info'])
+
+    def test_health_check(self):
+        """Testing PerforceClient checks the health of idle connections"""
+        perforce.PERFORCE_HEALTH_CHECK_INTERVAL = 0
+
+        client = self._create_client()
+        client.get_info()
+
+        FakeP4.instances[0].fail_next = 'Connection dropped'
+        client.get_info()
+
+        self.assertEqual(len(FakeP4.instances), 2)
+        self.assertFalse(FakeP4.instances[0].is_connected)
+
+    def test_closes_idle_connections(self):
+        """Testing PerforceClient closes connections after the idle timeout"""
+        perforce.PERFORCE_IDLE_TIMEOUT = 0
+
+        client = self._create_client()
+        client.get_info()
+        client.get_info()
+
+        self.assertEqual(len(FakeP4.instances), 2)
+        self.assertFalse(FakeP4.instances[0].is_connected)
+        self.assertTrue(FakeP4.instances[1].is_connected)
+
+    def test_discards_connections_after_errors(self):
+        """Testing PerforceClient doesn't reuse connections after errors"""
+        client = self._create_client()
+        client.get_info()
+
+        FakeP4.instances[0].fail_next = 'Something went wrong'
+        self.assertRaises(SCMError, client.get_info)
+        self.assertFalse(FakeP4.instances[0].is_connected)
+
+        client.get_info()
+        self.assertEqual(len(FakeP4.instances), 2)
+
+    def test_get_files(self):
+        """Testing PerforceClient.get_files"""
+        client = self._create_client()
+        client.get_info()
+        FakeP4.instances[0].missing_files.add('//depot/missing')
+
+        self.assertEqual(
+            client.get_files([
+                ('//depot/foo', 1),
+                ('//depot/foo', PRE_CREATION),
+                ('//depot/bar', 2),
+            ]),
+            ['data for //depot/foo#1', '', 'data for //depot/bar#2'])
+        self.assertEqual(FakeP4.instances[0].commands, ['info', 'print'])
+
+        self.assertRaises(FileNotFoundError, client.get_files, [
+            ('//depot/foo', 1),
+            ('//depot/missing', 1),
+            ('//depot/bar', 2),
+        ])
+        self.assertEqual(FakeP4.instances[0].commands,
+                         ['info', 'print', 'print'])
+        self.assertTrue(FakeP4.instances[0].is_connected)
+
+    def test_ticket_reuse(self):
+        """Testing PerforceClient logs in once for reused connections"""
+        client = self._create_client(use_ticket_auth=True)
+        client.get_info()
+        client.get_info()
+
+        p4 = FakeP4.instances[0]
+        self.assertEqual(len(FakeP4.instances), 1)
+        self.assertEqual(p4.num_logins, 1)
+
+        p4.fail_next = 'Your session has expired, please login again.'
+        client.get_info()
+
+        self.assertEqual(len(FakeP4.instances), 1)
+        self.assertEqual(p4.num_logins, 2)
+        self.assertEqual(p4.commands, ['info', 'info', 'info', 'info'])
+
+
 class PerforceStunnelTests(SCMTestCase):
     """
     Unit tests for perforce running through stunnel.
@@ -1377,6 +2200,44 @@ class MercurialTests(SCMTestCase):
         self.assertRaises(FileNotFoundError,
                           lambda: self.tool.get_file('hello', PRE_CREATION))
 
+    def test_client_cache(self):
+        """Testing HgTool shares clients for the same repository"""
+        tool = self.repository.get_scmtool()
+        self.assertTrue(tool.client is self.tool.client)
+
+        path = 'http://hg.example.com/repo'
+        client = get_hg_client(path, username='user', password='pass1')
+
+        self.assertTrue(
+            get_hg_client(path, username='user', password='pass1') is client)
+        self.assertFalse(
+            get_hg_client(path, username='user', password='pass2') is client)
+
+    def test_changectx_cache(self):
+        """Testing HgClient remembers changeset contexts for changeset IDs"""
+        client = self.tool.client
+        client._changectxs.clear()
+
+        self.tool.get_file('doc/readme', Revision('661e5dd3c493'))
+        self.tool.get_file('doc/readme', HEAD)
+
+        self.assertNotEqual(client._changectxs.get('661e5dd3c493'), None)
+        self.assertEqual(client._changectxs.get('tip'), None)
+        self.assertEqual(len(client._changectxs), 1)
+
+    def test_get_files(self):
+        """Testing HgTool.get_files"""
+        rev = Revision('661e5dd3c493')
+
+        self.assertEqual(
+            self.tool.get_files([('doc/readme', rev), ('doc/readme', rev)]),
+            ['Hello\n\ngoodbye\n', 'Hello\n\ngoodbye\n'])
+
+        self.assertRaises(
+            FileNotFoundError,
+            lambda: self.tool.get_files([('doc/readme', rev),
+                                         ('doc/readme2', rev)]))
+
     def test_interface(self):
         """Testing basic HgTool API"""
         self.assertTrue(self.tool.get_diffs_use_absolute_paths())
@@ -1817,6 +2678,87 @@ class GitTests(SCMTestCase):
         self.assertTrue(not self.tool.file_exists("readme", "a62df6c"))
         self.assertTrue(not self.tool.file_exists("readme2", "ccffbb4"))
 
+    def test_files_exist(self):
+        """Testing GitTool.files_exist"""
+        self.assertEqual(
+            self.tool.files_exist([
+                ('readme', 'e965047'),
+                ('readme', 'd6613f5'),
+                ('readme', PRE_CREATION),
+                ('readme', 'fffffff'),
+                ('readme2', 'fffffff'),
+                ('readme', 'a62df6c'),
+                ('readme2', 'ccffbb4'),
+            ]),
+            [True, True, False, False, False, False, False])
+
+    def test_get_files(self):
+        """Testing GitTool.get_files"""
+        self.assertEqual(
+            self.tool.get_files([
+                ('readme', 'e965047'),
+                ('readme', PRE_CREATION),
+                ('readme', 'd6613f5'),
+            ]),
+            ['Hello\n', '', 'Hello there\n'])
+
+        self.assertRaises(
+            FileNotFoundError,
+            lambda: self.tool.get_files([('readme', 'e965047'),
+                                         ('readme', '0000000')]))
+        self.assertRaises(
+            SCMError,
+            lambda: self.tool.get_files([('readme', 'a62df6c')]))
+
+    def test_cat_file_pool_reuses_processes(self):
+        """Testing GitTool reuses git cat-file processes"""
+        self.assertEqual(self.tool.get_file('readme', 'e965047'), 'Hello\n')
+
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        self.assertEqual(len(pool._idle_workers), 1)
+        process = pool._idle_workers[0].process
+
+        self.assertEqual(self.tool.get_file('readme', 'd6613f5'),
+                         'Hello there\n')
+        self.assertEqual(len(pool._idle_workers), 1)
+        self.assertTrue(pool._idle_workers[0].process is process)
+
+    def test_cat_file_pool_discards_stderr(self):
+        """Testing GitTool doesn't pipe git cat-file's errors"""
+        self.assertEqual(self.tool.get_file('readme', 'e965047'), 'Hello\n')
+
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        self.assertEqual(pool._idle_workers[0].process.stderr, None)
+
+    def test_cat_file_pool_close_expired(self):
+        """Testing GitCatFilePool.close_expired shutting down idle processes"""
+        self.assertEqual(self.tool.get_file('readme', 'e965047'), 'Hello\n')
+
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        worker = pool._idle_workers[0]
+
+        pool.close_expired()
+        self.assertEqual(pool._idle_workers, [worker])
+
+        worker.last_used -= CAT_FILE_IDLE_TIMEOUT
+        pool.close_expired()
+        self.assertEqual(pool._idle_workers, [])
+        self.assertFalse(worker.is_alive())
+
+    def test_cat_file_pool_restarts_crashed_process(self):
+        """Testing GitTool restarts crashed git cat-file processes"""
+        self.assertEqual(self.tool.get_file('readme', 'e965047'), 'Hello\n')
+
+        pool = get_cat_file_pool(self.tool.client.git_dir, '--batch')
+        process = pool._idle_workers[0].process
+        process.kill()
+        process.wait()
+
+        self.assertEqual(self.tool.get_file('readme', 'd6613f5'),
+                         'Hello there\n')
+        self.assertEqual(len(pool._idle_workers), 1)
+        self.assertFalse(pool._idle_workers[0].process is process)
+
     def test_get_file(self):
         """Testing GitTool.get_file"""
 
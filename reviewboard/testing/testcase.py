@@ -15,11 +15,13 @@ from djblets.testing.testcases import TestCase as DjbletsTestCase
 
 from reviewboard import scmtools
 from reviewboard.attachments.models import FileAttachment
+from reviewboard.diffviewer import diffutils
 from reviewboard.diffviewer.models import DiffSet, DiffSetHistory, FileDiff
 from reviewboard.reviews.models import (Comment, FileAttachmentComment,
                                         Group, Review, ReviewRequest,
                                         ReviewRequestDraft, Screenshot,
                                         ScreenshotComment)
+from reviewboard.scmtools import models as scmtools_models
 from reviewboard.scmtools.models import Repository, Tool
 from reviewboard.site.models import LocalSite
 
@@ -45,8 +47,10 @@ class TestCase(DjbletsTestCase):
     def setUp(self):
         super(TestCase, self).setUp()
 
-        # Clear the cache so that previous tests don't impact this one.
+        # Clear the caches so that previous tests don't impact this one.
         cache.clear()
+        diffutils._file_buffer_cache.clear()
+        scmtools_models._scmtool_cache.clear()
 
     def shortDescription(self):
         """Returns the description of the current test.